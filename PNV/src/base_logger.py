@@ -1,14 +1,21 @@
 from typing import Union
+import atexit
+import multiprocessing
 import os
 from pathlib import Path
 import datetime as dt
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from PNV.paths.paths import OUTPUT_PATH
 
+_listener = None
+
 
 def get_logger(user_path: Union[str, Path, None]):
     """
-    Set up and configure a logger for logging messages.
+    Set up and configure a logger for logging messages. Records are put into a queue and written to the log file and
+    the console by a background listener thread, such that logging does not block the computation. Forked worker
+    processes put their records into the same queue, such that only the listener writes to the log file.
     :param user_path: Information to log
     :return: logged message
     """
@@ -31,11 +38,37 @@ def get_logger(user_path: Union[str, Path, None]):
         )
         handler = logging.FileHandler(filepath, 'a+')
         handler.setFormatter(formatter)
-        Logger.addHandler(handler)
 
         console = logging.StreamHandler()
         console.setLevel(logging.INFO)
         console_formatter = logging.Formatter('%(name)-10s: %(levelname)-10s %(message)s')
         console.setFormatter(console_formatter)
-        Logger.addHandler(console)
+
+        Logger.addHandler(QueueHandler(multiprocessing.Queue()))
+        start_listener(Logger, handler, console)
     return Logger
+
+
+def start_listener(logger: logging.Logger, *handlers: logging.Handler):
+    """
+    Starts the listener thread writing the queued records of the logger to the handlers. The listener is stopped at
+    exit before the queue is closed.
+    :param logger: Logger with a QueueHandler.
+    :param handlers: Handlers writing the records (log file and console).
+    """
+    global _listener
+    queue_handler = next(handler for handler in logger.handlers if isinstance(handler, QueueHandler))
+    _listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_listener)
+
+
+def stop_listener():
+    """
+    Writes all queued records and stops the listener thread. Called at exit.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
@@ -0,0 +1,143 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
+
+from PNV.paths.paths import INPUT_RAW_DATA_PATH, PREPROCESSED_DATA_PATH, OUTPUT_PATH
+from PNV.user_input.default_parameters import USER_INPUT, TOOLBOX_INPUT, SRC_CRS, DST_CRS
+from PNV.src.base_logger import get_logger
+
+JOB_KEYS = ['name', 'plot_fig', 'src_crs', 'dst_crs', 'user_input', 'toolbox_input']
+
+
+def load_job_file(job_file: str) -> dict:
+    """
+    Reads a job file (TOML or YAML) and merges its entries with the default parameters. A job file may hold the keys
+    'name', 'plot_fig', 'src_crs', 'dst_crs' and the tables 'user_input' and 'toolbox_input', which overwrite single
+    entries of USER_INPUT and TOOLBOX_INPUT.
+    :param job_file: Path to the job file (.toml, .yaml or .yml).
+    :return: Dictionary with the complete job configuration.
+    """
+    extension = os.path.splitext(job_file)[1].lower()
+    if extension == '.toml':
+        with open(job_file, 'rb') as file:
+            job = tomllib.load(file)
+    elif extension in ['.yaml', '.yml']:
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError(f"PyYAML is required to read the job file {job_file} (pip install -e .[yaml]).")
+        with open(job_file, 'r') as file:
+            job = yaml.safe_load(file) or {}
+    else:
+        raise ValueError(f"Invalid job file {job_file}. Must be a .toml, .yaml or .yml file.")
+
+    unknown_keys = [key for key in job if key not in JOB_KEYS]
+    if unknown_keys:
+        raise ValueError(f"Invalid keys {unknown_keys} in job file {job_file}. Must be one of {JOB_KEYS}.")
+
+    return {
+        'name': job.get('name', os.path.splitext(os.path.basename(job_file))[0]),
+        'plot_fig': job.get('plot_fig', False),
+        'src_crs': job.get('src_crs', SRC_CRS),
+        'dst_crs': job.get('dst_crs', DST_CRS),
+        'user_input': {**USER_INPUT, **job.get('user_input', {})},
+        'toolbox_input': {**TOOLBOX_INPUT, **job.get('toolbox_input', {})},
+    }
+
+
+def run_job(job: dict, input_path: str, preprocessed_path: str, output_root: str) -> str:
+    """
+    Runs the processing of a single job and, if requested, the toolbox. All results of the job are saved in their own
+    output directory named after the job.
+    :param job: Job configuration as returned by load_job_file.
+    :param input_path: Directory of the raw tif files.
+    :param preprocessed_path: Directory of the preprocessed tif files.
+    :param output_root: Directory in which the output directory of the job is created.
+    :return: Output directory of the job.
+    """
+    from PNV.src.logic import ProcessingArea
+    from PNV.toolbox.data_analysis import PnvDataAnalysis
+
+    output_path = os.path.join(output_root, job['name'])
+    os.makedirs(output_path, exist_ok=True)
+
+    processing = ProcessingArea(user_input=job['user_input'], src_crs=job['src_crs'], dst_crs=job['dst_crs'],
+                                input_path=input_path, preprocessed_path=preprocessed_path, output_path=output_path)
+    processing.run_processing()
+
+    if job['plot_fig']:
+        pnv_data = processing.result_table(job['toolbox_input']['SELECT_PNV_CLASS'])
+        if pnv_data is None:
+            processing.wait_for_exports()  # the toolbox reads the results from the output directory
+        pnv_analysis = PnvDataAnalysis(user_input=job['toolbox_input'], input_path=input_path,
+                                       output_path=output_path, pnv_data=pnv_data)
+        pnv_analysis.toolbox_plot()
+    processing.wait_for_exports()
+    return output_path
+
+
+def run_batch(job_files: list, workers: int = 1, input_path: str = INPUT_RAW_DATA_PATH,
+              preprocessed_path: str = PREPROCESSED_DATA_PATH, output_root: str = OUTPUT_PATH) -> dict:
+    """
+    Runs all jobs in a process pool. Jobs which fail are logged and do not stop the remaining jobs.
+    :param job_files: List of paths to job files.
+    :param workers: Number of worker processes.
+    :param input_path: Directory of the raw tif files.
+    :param preprocessed_path: Directory of the preprocessed tif files.
+    :param output_root: Directory in which the output directories of all jobs are created.
+    :return: Dictionary mapping job names to their output directory (None if the job failed).
+    """
+    logger = get_logger(user_path=None)
+    jobs = [load_job_file(job_file) for job_file in job_files]
+
+    job_names = [job['name'] for job in jobs]
+    duplicated_names = sorted(set([name for name in job_names if job_names.count(name) > 1]))
+    if duplicated_names:
+        raise ValueError(f"Job names {duplicated_names} are not unique. Output directories must be isolated.")
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_job, job, input_path, preprocessed_path, output_root): job['name']
+                   for job in jobs}
+        for future in as_completed(futures):
+            job_name = futures[future]
+            try:
+                results[job_name] = future.result()
+                logger.info(f"Job {job_name} finished, results saved to {results[job_name]}")
+            except Exception as e:
+                results[job_name] = None
+                logger.error(f"Job {job_name} failed: {e}")
+    return results
+
+
+def main(argv: list = None):
+    """
+    Command-line entry point to process several configurations in one invocation.
+    :param argv: List of command-line arguments (defaults to sys.argv).
+    """
+    parser = argparse.ArgumentParser(description="Run PNV processing jobs defined in TOML or YAML job files.")
+    parser.add_argument('job_files', nargs='+', help="Job files (.toml, .yaml or .yml).")
+    parser.add_argument('--workers', type=int, default=1, help="Number of jobs processed in parallel.")
+    parser.add_argument('--input-dir', default=INPUT_RAW_DATA_PATH, help="Directory of the raw tif files.")
+    parser.add_argument('--preprocessed-dir', default=PREPROCESSED_DATA_PATH,
+                        help="Directory of the preprocessed tif files.")
+    parser.add_argument('--output-dir', default=OUTPUT_PATH,
+                        help="Directory in which one output directory per job is created.")
+    args = parser.parse_args(argv)
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1.")
+
+    results = run_batch(args.job_files, workers=args.workers, input_path=args.input_dir,
+                        preprocessed_path=args.preprocessed_dir, output_root=args.output_dir)
+    failed_jobs = [job_name for job_name, output_path in results.items() if output_path is None]
+    return 1 if failed_jobs else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,30 +1,237 @@
 import rasterio
+from rasterio.vrt import WarpedVRT
 from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.windows import Window
+from affine import Affine
+import datetime as dt
+import hashlib
+import json
 import os
 import zipfile
+import numpy as np
 from tqdm import tqdm
 
+MANIFEST_NAME = 'preprocessing_manifest.json'
+MANIFEST_VERSION = 1
+WARP_INDEX_VERSION = 1
+CLASS_METADATA_TAG = 'PNV_CLASS_METADATA'
+CLASS_METADATA_VERSION = 1
+MAX_CLASS_VALUE = 65535  # Rasters with larger values (or negative or float values) hold no classes
 
-def epsg_reproject(input_tif: str, output_tif: str, src_crs: str, dst_crs: str):
+
+def partial_path(output_path: str) -> str:
+    """
+    Temporary path under which an output is written before it is renamed to its final name. The suffix ensures that
+    incomplete files are never picked up as tif or zip files.
+    :param output_path: Final output path.
+    :return: Temporary output path.
+    """
+    return f"{output_path}.partial"
+
+
+def file_checksum(file_path: str, chunk_size: int = 16 * 1024 * 1024) -> str:
+    """
+    Computes the checksum of the file content.
+    :param file_path: Path of the file.
+    :param chunk_size: Number of bytes read at once.
+    :return: Hexadecimal BLAKE2b checksum.
     """
-    Uses rasterio to re-project tif files from one coordinate system to another.
+    checksum = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def load_manifest(output_dir: str) -> dict:
+    """
+    Reads the manifest recording which preprocessing outputs are complete.
+    :param output_dir: Destination directory of the preprocessed files.
+    :return: Manifest dictionary (empty if no valid manifest exists).
+    """
+    manifest = {'version': MANIFEST_VERSION, 'sources': {}, 'outputs': {}}
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, 'r') as file:
+                saved_manifest = json.load(file)
+        except ValueError:
+            print(f"Manifest {manifest_path} is corrupted, all files are processed again.")
+            return manifest
+        if saved_manifest.get('version') == MANIFEST_VERSION:
+            manifest.update(saved_manifest)
+    return manifest
+
+
+def save_manifest(output_dir: str, manifest: dict):
+    """
+    Writes the manifest atomically, such that an interruption never leaves a truncated manifest.
+    :param output_dir: Destination directory of the preprocessed files.
+    :param manifest: Manifest dictionary.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(partial_path(manifest_path), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(partial_path(manifest_path), manifest_path)
+
+
+def source_fingerprint(input_path: str, manifest: dict) -> str:
+    """
+    Fingerprint of the source file content. The checksum is reused from the manifest as long as size and modification
+    time of the source file are unchanged.
+    :param input_path: Path of the source tif file.
+    :param manifest: Manifest dictionary, updated with the checksum of the source file.
+    :return: Checksum of the source file.
+    """
+    stat = os.stat(input_path)
+    filename = os.path.basename(input_path)
+    source = manifest['sources'].get(filename, {})
+    if source.get('size') != stat.st_size or source.get('mtime_ns') != stat.st_mtime_ns:
+        source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'checksum': file_checksum(input_path)}
+        manifest['sources'][filename] = source
+    return source['checksum']
+
+
+def preprocessing_key(source_checksum: str, src_crs: str, dst_crs: str, resampling: Resampling) -> str:
+    """
+    Key identifying a preprocessing output by its source content and all settings of the reprojection.
+    :param source_checksum: Checksum of the source file.
+    :param src_crs: Source coordinate system (e.g., 4326).
+    :param dst_crs: Destination reference coordinate system (e.g., 8857).
+    :param resampling: Resampling method of the reprojection.
+    :return: Hexadecimal key.
+    """
+    settings = json.dumps([source_checksum, str(src_crs), str(dst_crs), Resampling(resampling).name])
+    return hashlib.blake2b(settings.encode(), digest_size=20).hexdigest()
+
+
+def is_complete(output_path: str, entry: dict, key: str) -> bool:
+    """
+    Checks whether a preprocessing output is complete and was produced with the same key.
+    :param output_path: Path of the reprojected tif file.
+    :param entry: Manifest entry of the output.
+    :param key: Preprocessing key of the current run.
+    :return: True if tif and zip file are complete and up to date.
+    """
+    if entry.get('key') != key:
+        return False
+    for file_path, size in [(output_path, entry.get('tif_size')), (f"{output_path[:-4]}.zip", entry.get('zip_size'))]:
+        if not os.path.exists(file_path) or os.path.getsize(file_path) != size:
+            return False
+    return True
+
+
+def add_class_counts(histogram, values: np.ndarray):
+    """
+    Adds the pixel count of each class value of a block to the class histogram of a raster band.
+    :param histogram: Pixel counts of the classes 0, 1, ... counted so far (None if the band holds no classes).
+    :param values: Pixel values of the block.
+    :return: Updated histogram (None if the band holds no classes).
+    """
+    if histogram is None or not np.issubdtype(values.dtype, np.integer):
+        return None
+    if values.size and (values.min() < 0 or values.max() > MAX_CLASS_VALUE):
+        return None
+    counts = np.bincount(values.ravel().astype(np.int64), minlength=len(histogram))
+    counts[:len(histogram)] += histogram
+    return counts
+
+
+def write_class_metadata(dst, histograms: list):
+    """
+    Stores the class histogram of each band together with the grid in the GeoTIFF tags of a raster, such that the
+    class counts are read without scanning the raster (see read_class_metadata). Nothing is stored if a band holds no
+    classes.
+    :param dst: Raster opened for writing.
+    :param histograms: Class histogram of each band (see add_class_counts).
+    """
+    if any(histogram is None for histogram in histograms):
+        return
+    metadata = {
+        'version': CLASS_METADATA_VERSION,
+        'width': dst.width,
+        'height': dst.height,
+        'transform': list(dst.transform)[:6],
+        'res': list(dst.res),
+        'histograms': [[int(count) for count in histogram] for histogram in histograms]
+    }
+    dst.update_tags(**{CLASS_METADATA_TAG: json.dumps(metadata)})
+
+
+def read_class_metadata(dataset):
+    """
+    Reads the class histograms and grid stored in the GeoTIFF tags of a raster by the preprocessing.
+    :param dataset: Opened rasterio dataset.
+    :return: Dictionary with width, height, transform, res and the class histogram of each band (numpy arrays), None
+     if the metadata are missing or stale (other version or grid, or counts not summing up to the pixels).
+    """
+    try:
+        metadata = json.loads(dataset.tags().get(CLASS_METADATA_TAG, 'null'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(metadata, dict) or metadata.get('version') != CLASS_METADATA_VERSION:
+        return None
+    try:
+        histograms = [np.asarray(histogram, dtype=np.int64) for histogram in metadata['histograms']]
+        if (metadata['width'] != dataset.width or metadata['height'] != dataset.height or
+                not Affine(*metadata['transform']).almost_equals(dataset.transform) or
+                len(histograms) != dataset.count or
+                any(histogram.sum() != dataset.width * dataset.height for histogram in histograms)):
+            return None
+    except (KeyError, TypeError, ValueError):
+        return None
+    metadata['histograms'] = histograms
+    return metadata
+
+
+def scan_class_metadata(dst, block_rows: int = 1024):
+    """
+    Computes the class histograms of a written raster block of rows by block of rows and stores them in its tags.
+    Used where the pixels are written by GDAL and never pass through NumPy.
+    :param dst: Raster opened in update mode ('r+').
+    :param block_rows: Number of rows read at once.
+    """
+    histograms = [np.zeros(0, dtype=np.int64) for _ in range(dst.count)]
+    for row_start in range(0, dst.height, block_rows):
+        window = Window(0, row_start, dst.width, min(block_rows, dst.height - row_start))
+        for i in range(dst.count):
+            histograms[i] = add_class_counts(histograms[i], dst.read(i + 1, window=window))
+    write_class_metadata(dst, histograms)
+
+
+def epsg_reproject(input_tif: str, output_tif: str, src_crs: str, dst_crs: str,
+                   resampling: Resampling = Resampling.nearest, index_dir: str = None):
+    """
+    Uses rasterio to re-project tif files from one coordinate system to another. The output is written to a temporary
+    file which is renamed when complete. The class histograms are stored in the tags of the output (see
+    read_class_metadata).
     :param input_tif: Original tif file.
     :param output_tif: Re-projected tif file.
     :param src_crs: Source coordinate system (e.g., 4326).
     :param dst_crs: Destination reference coordinate system (e.g., 8857).
+    :param resampling: Resampling method of the reprojection.
+    :param index_dir: Directory of warp indices (see load_warp_index). If given, nearest-neighbour reprojections
+     gather the pixels through the warp index of the source grid instead of warping each file.
     """
+    if index_dir is not None and resampling == Resampling.nearest:
+        with rasterio.open(input_tif) as src:
+            index = load_warp_index(src, src_crs, dst_crs, index_dir)
+            gather_reproject(src, partial_path(output_tif), index, dst_crs)
+        os.replace(partial_path(output_tif), output_tif)
+        return
+
     with rasterio.open(input_tif) as src:
-        transform, width, height = calculate_default_transform(
-            src.crs, dst_crs, src.width, src.height, *src.bounds)
+        transform, width, height = reprojected_grid(src, dst_crs)
         kwargs = src.meta.copy()
         kwargs.update({
+            'driver': 'GTiff',
             'crs': dst_crs,
             'transform': transform,
             'width': width,
             'height': height
         })
 
-        with rasterio.open(output_tif, 'w', **kwargs) as dst:
+        with rasterio.open(partial_path(output_tif), 'w', **kwargs) as dst:
             for i in range(1, src.count + 1):
                 reproject(
                     source=rasterio.band(src, i),
@@ -33,12 +240,211 @@ def epsg_reproject(input_tif: str, output_tif: str, src_crs: str, dst_crs: str):
                     src_crs=src_crs,
                     dst_transform=transform,
                     dst_crs=dst_crs,
-                    resampling=Resampling.nearest)
+                    resampling=resampling)
+    with rasterio.open(partial_path(output_tif), 'r+') as dst:
+        scan_class_metadata(dst)
+    os.replace(partial_path(output_tif), output_tif)
+
+
+def warp_index_path(src, src_crs: str, dst_crs: str, index_dir: str) -> str:
+    """
+    Path of the warp index of a source grid, identified by the source grid and both coordinate systems.
+    :param src: Opened rasterio dataset on the source grid.
+    :param src_crs: Source coordinate system (e.g., 4326).
+    :param dst_crs: Destination reference coordinate system (e.g., 8857).
+    :param index_dir: Directory of warp indices.
+    :return: Path of the warp index (.npy file).
+    """
+    grid = json.dumps([WARP_INDEX_VERSION, src.width, src.height, list(src.transform)[:6], str(src_crs), str(dst_crs)])
+    return os.path.join(index_dir, f"{hashlib.blake2b(grid.encode(), digest_size=20).hexdigest()}.npy")
+
+
+def load_warp_index(src, src_crs: str, dst_crs: str, index_dir: str, block_rows: int = 1024) -> np.ndarray:
+    """
+    Provides the nearest-neighbour warp index of a source grid: for each pixel of the reprojected grid (see
+    reprojected_grid), the flat offset of its source pixel (-1 if it has no source pixel). The index is computed once
+    by warping a raster of the source pixel offsets, such that it is the mapping of epsg_reproject, and stored as a
+    memory-mapped array for all further rasters on the same grid. gather_reproject pages in one block of rows of the
+    index at a time.
+    :param src: Opened rasterio dataset on the source grid.
+    :param src_crs: Source coordinate system (e.g., 4326).
+    :param dst_crs: Destination reference coordinate system (e.g., 8857).
+    :param index_dir: Directory of warp indices.
+    :param block_rows: Number of rows of the offset raster written at once.
+    :return: Memory-mapped array (height x width of the reprojected grid) of source pixel offsets.
+    """
+    index_path = warp_index_path(src, src_crs, dst_crs, index_dir)
+    if os.path.exists(index_path):
+        return np.load(index_path, mmap_mode='r')
+
+    os.makedirs(index_dir, exist_ok=True)
+    print(f"Building warp index {index_path}")
+    transform, width, height = reprojected_grid(src, dst_crs)
+    dtype = np.int32 if src.width * src.height < np.iinfo(np.int32).max else np.int64
+    offsets_tif = f"{index_path[:-4]}_offsets.tif"
+    profile = {'driver': 'GTiff', 'dtype': np.dtype(dtype).name, 'width': src.width, 'height': src.height,
+               'count': 1, 'crs': src.crs, 'transform': src.transform, 'compress': 'deflate', 'predictor': 2}
+    try:
+        with rasterio.open(offsets_tif, 'w', **profile) as offsets:
+            for row_start in range(0, src.height, block_rows):
+                rows = min(block_rows, src.height - row_start)
+                block = np.arange(row_start * src.width, (row_start + rows) * src.width, dtype=dtype)
+                offsets.write(block.reshape(rows, src.width), 1, window=Window(0, row_start, src.width, rows))
+
+        index = np.lib.format.open_memmap(partial_path(index_path), mode='w+', dtype=dtype, shape=(height, width))
+        index[:] = -1
+        with rasterio.open(offsets_tif) as offsets:
+            reproject(source=rasterio.band(offsets, 1), destination=index, src_transform=src.transform,
+                      src_crs=src_crs, dst_transform=transform, dst_crs=dst_crs, dst_nodata=-1,
+                      resampling=Resampling.nearest)
+        index.flush()
+        del index
+        os.replace(partial_path(index_path), index_path)
+    finally:
+        if os.path.exists(offsets_tif):
+            os.remove(offsets_tif)
+    return np.load(index_path, mmap_mode='r')
+
+
+def gather_reproject(src, output_tif: str, index: np.ndarray, dst_crs: str, block_rows: int = 256):
+    """
+    Reprojects a raster with a warp index (see load_warp_index) as a pure NumPy gather, block of rows by block of
+    rows. Each block reads only the range of source rows it refers to. Pixels without source pixel are nodata, as for
+    epsg_reproject. The class histograms are counted from the gathered blocks and stored in the tags.
+    :param src: Opened rasterio dataset on the source grid of the index.
+    :param output_tif: Re-projected tif file.
+    :param index: Warp index of the source grid.
+    :param dst_crs: Destination reference coordinate system (e.g., 8857).
+    :param block_rows: Number of rows gathered at once.
+    """
+    transform, width, height = reprojected_grid(src, dst_crs)
+    if index.shape != (height, width):
+        raise ValueError(f"Warp index of shape {index.shape} does not match the reprojected grid {(height, width)}.")
+    kwargs = src.meta.copy()
+    kwargs.update({'driver': 'GTiff', 'crs': dst_crs, 'transform': transform, 'width': width, 'height': height})
+    fill_value = src.nodata if src.nodata is not None else 0
+    histograms = [np.zeros(0, dtype=np.int64) for _ in range(src.count)]
+
+    with rasterio.open(output_tif, 'w', **kwargs) as dst:
+        for row_start in range(0, height, block_rows):
+            rows = min(block_rows, height - row_start)
+            offsets = np.asarray(index[row_start:row_start + rows])
+            valid = offsets >= 0
+            window = Window(0, row_start, width, rows)
+            if not valid.any():
+                for i in range(1, src.count + 1):
+                    values = np.full((rows, width), fill_value, dtype=src.dtypes[i - 1])
+                    histograms[i - 1] = add_class_counts(histograms[i - 1], values)
+                    dst.write(values, i, window=window)
+                continue
+
+            source_offsets = offsets[valid]
+            first_row, last_row = source_offsets.min() // src.width, source_offsets.max() // src.width
+            source_offsets = source_offsets - first_row * src.width
+            source_window = Window(0, first_row, src.width, last_row - first_row + 1)
+            for i in range(1, src.count + 1):
+                values = np.full((rows, width), fill_value, dtype=src.dtypes[i - 1])
+                values[valid] = src.read(i, window=source_window).ravel()[source_offsets]
+                histograms[i - 1] = add_class_counts(histograms[i - 1], values)
+                dst.write(values, i, window=window)
+        write_class_metadata(dst, histograms)
+
+
+def reprojected_grid(src, dst_crs: str):
+    """
+    Grid of a raster reprojected to another coordinate system.
+    :param src: Opened rasterio dataset.
+    :param dst_crs: Destination reference coordinate system (e.g., 8857).
+    :return: Affine transform, width and height of the reprojected raster.
+    """
+    return calculate_default_transform(src.crs, dst_crs, src.width, src.height, *src.bounds)
+
+
+class WarpedRaster(WarpedVRT):
+    """
+    Virtual raster reprojecting a source raster on the fly when read (window by window). The source raster is closed
+    together with the virtual raster.
+    """
+
+    def close(self):
+        super().close()
+        self.src_dataset.close()
+
+
+def open_warped(input_tif: str, src_crs: str, dst_crs: str,
+                resampling: Resampling = Resampling.nearest) -> WarpedRaster:
+    """
+    Opens a raster reprojected on the fly onto the grid of epsg_reproject, without writing a reprojected file.
+    :param input_tif: Original tif file (path readable by rasterio).
+    :param src_crs: Source coordinate system (e.g., 4326).
+    :param dst_crs: Destination reference coordinate system (e.g., 8857).
+    :param resampling: Resampling method of the reprojection.
+    :return: Opened virtual raster in the destination coordinate system.
+    """
+    src = rasterio.open(input_tif)
+    try:
+        transform, width, height = reprojected_grid(src, dst_crs)
+        return WarpedRaster(src, src_crs=src_crs, crs=dst_crs, transform=transform, width=width, height=height,
+                            resampling=resampling)
+    except Exception:
+        src.close()
+        raise
+
+
+def pyramid_dir(factor: int) -> str:
+    """
+    Name of the subdirectory holding the pyramid level of the given aggregation factor.
+    :param factor: Aggregation factor relative to the native resolution (e.g., 5 for 5 km at 1 km native resolution).
+    :return: Directory name.
+    """
+    return f"pyramid_{factor}x"
+
+
+def mode_aggregate(input_tif: str, output_tif: str, factor: int):
+    """
+    Aggregates a class raster to a coarser resolution. Each block of factor x factor pixels is assigned its most
+    frequent class (ties are resolved towards the lower class value). The raster is processed in strips of factor
+    rows. The output is written to a temporary file which is renamed when complete. The class histograms of the
+    aggregated raster are stored in its tags.
+    :param input_tif: Reprojected class raster at native resolution.
+    :param output_tif: Aggregated class raster.
+    :param factor: Aggregation factor.
+    """
+    with rasterio.open(input_tif) as src:
+        width = -(-src.width // factor)
+        height = -(-src.height // factor)
+        kwargs = src.meta.copy()
+        kwargs.update({
+            'driver': 'GTiff',
+            'transform': src.transform * Affine.scale(factor, factor),
+            'width': width,
+            'height': height
+        })
+
+        histograms = [np.zeros(0, dtype=np.int64) for _ in range(src.count)]
+        with rasterio.open(partial_path(output_tif), 'w', **kwargs) as dst:
+            for row in range(height):
+                window = Window(0, row * factor, src.width, min(factor, src.height - row * factor))
+                for band in range(1, src.count + 1):
+                    strip = src.read(band, window=window).astype(np.int64)
+                    # Pad the strip to full blocks with a sentinel class which is dropped before selecting the mode
+                    sentinel = int(strip.max()) + 1
+                    padded = np.full((factor, width * factor), sentinel, dtype=np.int64)
+                    padded[:strip.shape[0], :strip.shape[1]] = strip
+                    block_id = np.arange(width * factor) // factor
+                    counts = np.bincount((block_id[np.newaxis, :] * (sentinel + 1) + padded).ravel(),
+                                         minlength=width * (sentinel + 1)).reshape(width, sentinel + 1)
+                    block_mode = np.argmax(counts[:, :sentinel], axis=1).astype(kwargs['dtype'])
+                    histograms[band - 1] = add_class_counts(histograms[band - 1], block_mode)
+                    dst.write(block_mode[np.newaxis, :], band, window=Window(0, row, width, 1))
+            write_class_metadata(dst, histograms)
+    os.replace(partial_path(output_tif), output_tif)
 
 
 def zip_epsg_reproject(output_tif: str):
     """
-    Transforms reprojected tif files into zip files. Deletes tif files after transformation.
+    Transforms reprojected tif files into zip files. The zip file is written to a temporary file which is renamed
+    when complete.
     :param output_tif: Reprojected tif files.
     """
 
@@ -46,9 +452,10 @@ def zip_epsg_reproject(output_tif: str):
         print(f"File {output_tif} does not exist, skipping zipping.")
         return
 
-    output_tif = output_tif[:-4]
-    output_zip = output_tif.split('\\')[-1]
-    zipfile.ZipFile(f'{output_tif}.zip', 'w', zipfile.ZIP_DEFLATED).write(f'{output_tif}.tif', arcname=f'{output_zip}.tif')
+    output_zip = f"{output_tif[:-4]}.zip"
+    with zipfile.ZipFile(partial_path(output_zip), 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.write(output_tif, arcname=os.path.basename(output_tif))
+    os.replace(partial_path(output_zip), output_zip)
 
     #try:
     #    os.remove(f"{output_tif}.tif")
@@ -56,14 +463,41 @@ def zip_epsg_reproject(output_tif: str):
     #    pass
 
 
-def process_all_files(input_dir: str, output_dir: str, src_crs: str, dst_crs: str):
+def record_output(manifest: dict, output_id: str, source: str, key: str, output_path: str):
+    """
+    Records a complete output (tif and zip file) in the manifest.
+    :param manifest: Manifest dictionary.
+    :param output_id: Identifier of the output in the manifest (path relative to the preprocessed directory).
+    :param source: Name of the source file.
+    :param key: Preprocessing key of the output.
+    :param output_path: Path of the output tif file.
+    """
+    manifest['outputs'][output_id] = {
+        'source': source,
+        'key': key,
+        'tif_size': os.path.getsize(output_path),
+        'zip_size': os.path.getsize(f"{output_path[:-4]}.zip"),
+        'completed': dt.datetime.now().isoformat(timespec='seconds')
+    }
+
+
+def process_all_files(input_dir: str, output_dir: str, src_crs: str, dst_crs: str,
+                      resampling: Resampling = Resampling.nearest, pyramid_levels: list = None,
+                      warp_index: bool = False):
     """
-    Copies saved tif files in the preprocessed directory. Skips tif files when the name is already available in the
-    preprocessed directory.
+    Reprojects and zips all tif files into the preprocessed directory. Completed outputs are recorded in a manifest
+    together with a key of the source content and the reprojection settings. Files are skipped when their outputs are
+    complete and up to date, such that interrupted runs resume without redoing finished files.
     :param input_dir: Origin directory of tif files.
     :param output_dir: Destination directory of tif files.
     :param src_crs: Source coordinate system (e.g., 4326).
     :param dst_crs: Destination reference coordinate system (e.g., 8857).
+    :param resampling: Resampling method of the reprojection.
+    :param pyramid_levels: Aggregation factors of mode-aggregated pyramid levels built from each reprojected file
+     (e.g., [2, 5, 10]). Each level is saved in its own subdirectory (see pyramid_dir).
+    :param warp_index: If True, the nearest-neighbour mapping of the source grid is computed once and stored in the
+     subdirectory warp_index; all further files on the same grid are reprojected by gathering their pixels (see
+     load_warp_index).
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -78,15 +512,40 @@ def process_all_files(input_dir: str, output_dir: str, src_crs: str, dst_crs: st
     ]
     print(f"Total .tif files to process: {len(all_files)}")
 
+    manifest = load_manifest(output_dir)
+
     for filename in tqdm(all_files, desc="Processing .tif raw files"):
         input_path = os.path.join(input_dir, filename)
         output_filename = filename.replace('4326', '8857')
         output_path = os.path.join(output_dir, output_filename)
 
-        if os.path.exists(output_path):
+        key = preprocessing_key(source_fingerprint(input_path, manifest), src_crs, dst_crs, resampling)
+        if is_complete(output_path, manifest['outputs'].get(output_filename, {}), key):
             print(f"File {output_path} already exists, skipping.")
-            continue
+        else:
+            manifest['outputs'].pop(output_filename, None)
+            save_manifest(output_dir, manifest)
+
+            epsg_reproject(input_path, output_path, src_crs, dst_crs, resampling,
+                           index_dir=os.path.join(output_dir, 'warp_index') if warp_index else None)
+            zip_epsg_reproject(output_path)
+
+            record_output(manifest, output_filename, filename, key, output_path)
+            save_manifest(output_dir, manifest)
+
+        for factor in pyramid_levels or []:
+            level_id = f"{pyramid_dir(factor)}/{output_filename}"
+            level_path = os.path.join(output_dir, pyramid_dir(factor), output_filename)
+            level_key = hashlib.blake2b(f"{key}_mode_{factor}".encode(), digest_size=20).hexdigest()
+            if is_complete(level_path, manifest['outputs'].get(level_id, {}), level_key):
+                continue
+
+            os.makedirs(os.path.dirname(level_path), exist_ok=True)
+            manifest['outputs'].pop(level_id, None)
+            save_manifest(output_dir, manifest)
 
-        epsg_reproject(input_path, output_path, src_crs, dst_crs)
-        zip_epsg_reproject(output_path)
+            mode_aggregate(output_path, level_path, factor)
+            zip_epsg_reproject(level_path)
 
+            record_output(manifest, level_id, filename, level_key, level_path)
+            save_manifest(output_dir, manifest)
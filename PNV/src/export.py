@@ -0,0 +1,121 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import pandas as pd
+import xlsxwriter
+
+from PNV.src.datapreprocces import partial_path
+
+# Header format of pandas.DataFrame.to_excel
+HEADER_FORMAT = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+
+
+def write_excel(output_file: str, sheets: list, chunk_size: int = 10000) -> str:
+    """
+    Writes dataframes to an Excel workbook in the constant memory mode of xlsxwriter. Sheets are taken from the
+    iterable one after another and their rows are streamed to the file, such that the memory of the workbook does not
+    grow with the number of rows. The workbook is written to a temporary file which is renamed when complete.
+    :param output_file: Path of the Excel file.
+    :param sheets: Iterable of tuples (sheet name, dataframe), e.g. a DataFrameGroupBy. Sheet names are cut to 31
+     characters.
+    :param chunk_size: Number of rows converted at once.
+    :return: Path of the Excel file.
+    """
+    workbook = xlsxwriter.Workbook(partial_path(output_file), {'constant_memory': True, 'nan_inf_to_errors': True})
+    try:
+        header_format = workbook.add_format(HEADER_FORMAT)
+        for sheet_name, df in sheets:
+            worksheet = workbook.add_worksheet(str(sheet_name)[:31])
+            worksheet.write_row(0, 0, [str(column) for column in df.columns], header_format)
+            for chunk_start in range(0, len(df), chunk_size):
+                chunk = df.iloc[chunk_start:chunk_start + chunk_size].astype(object)
+                chunk = chunk.where(pd.notna(chunk), None)
+                for row_index, row in enumerate(chunk.itertuples(index=False, name=None), start=chunk_start + 1):
+                    worksheet.write_row(row_index, 0, row)
+    finally:
+        workbook.close()
+    os.replace(partial_path(output_file), output_file)
+    return output_file
+
+
+def write_pickle(output_file: str, df: pd.DataFrame) -> str:
+    """
+    Pickles a dataframe to a temporary file which is renamed when complete, such that readers never pick up an
+    incomplete file.
+    :param output_file: Path of the pickle file.
+    :param df: Dataframe.
+    :return: Path of the pickle file.
+    """
+    df.to_pickle(partial_path(output_file), compression=None)
+    os.replace(partial_path(output_file), output_file)
+    return output_file
+
+
+class ExcelExport:
+    def __init__(self, max_workers: int = 3, logger=None):
+        """
+        Initialization of the class ExcelExport. Workbooks and pickles are written by a bounded pool of background
+        threads while the processing continues. At most max_workers exports are held by the pool; further submissions
+        wait for a free worker, such that the exported dataframes do not build up. The exported dataframes must not be
+        modified until the export is finished.
+        :param max_workers: Number of files written at once (3: both workbooks and the pickle of save_results).
+        :param logger: Logger reporting finished and failed exports.
+        """
+        if max_workers < 1:
+            raise ValueError("Invalid number of export workers. Must be at least 1.")
+        self.logger = logger
+        self.futures = []
+        self.max_workers = max_workers
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def submit(self, output_file: str, sheets):
+        """
+        Starts writing a workbook in a background thread.
+        :param output_file: Path of the Excel file.
+        :param sheets: Iterable of tuples (sheet name, dataframe), e.g. a DataFrameGroupBy, taken one after another
+         while writing.
+        :return: Future of the export returning the path of the Excel file.
+        """
+        return self._start(output_file, write_excel, output_file, sheets)
+
+    def submit_pickle(self, output_file: str, df: pd.DataFrame):
+        """
+        Starts pickling a dataframe in a background thread.
+        :param output_file: Path of the pickle file.
+        :param df: Dataframe.
+        :return: Future of the export returning the path of the pickle file.
+        """
+        return self._start(output_file, write_pickle, output_file, df)
+
+    def _start(self, output_file: str, function, *args):
+        self._slots.acquire()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="PNV-ExcelExport")
+        future = self._executor.submit(function, *args)
+        future.add_done_callback(lambda done: self._report(output_file, done))
+        self.futures.append(future)
+        return future
+
+    def _report(self, output_file: str, future):
+        self._slots.release()
+        if self.logger is None:
+            return
+        if future.exception() is not None:
+            self.logger.error(f"Export to {output_file} failed: {future.exception()}")
+        else:
+            self.logger.info(f"Results saved to {output_file}")
+
+    def wait(self) -> list:
+        """
+        Waits until all submitted workbooks and pickles are written and shuts the worker threads down (they are started
+        again by the next submission).
+        :return: Paths of the written files. The first error of a failed export is raised.
+        """
+        futures, self.futures = self.futures, []
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        wait(futures)
+        return [future.result() for future in futures]
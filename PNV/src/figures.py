@@ -0,0 +1,85 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+import matplotlib.pyplot as plt
+
+from PNV.src.datapreprocces import partial_path
+
+
+def write_figure(fig, output_file: str, savefig_kwargs: dict) -> str:
+    """
+    Renders a figure to a temporary file which is renamed when complete, such that readers never pick up an
+    incomplete file.
+    :param fig: Matplotlib figure.
+    :param output_file: Path of the image file (the format is given by the extension).
+    :param savefig_kwargs: Further arguments of Figure.savefig (e.g., dpi and bbox_inches).
+    :return: Path of the image file.
+    """
+    image_format = os.path.splitext(output_file)[1][1:] or None
+    fig.savefig(partial_path(output_file), format=image_format, **savefig_kwargs)
+    os.replace(partial_path(output_file), output_file)
+    return output_file
+
+
+class FigureExport:
+    def __init__(self, max_workers: int = 2, logger=None):
+        """
+        Initialization of the class FigureExport. Finished figures are rendered and written in the background while
+        the computation continues. Figures are closed in pyplot when submitted, and at most max_workers figures are
+        held for rendering; further submissions wait for a free slot, such that the memory of the figures does not
+        build up. The figures must not be modified after submission.
+        Matplotlib is not thread-safe, hence all figures are rendered one after the other by a single dedicated
+        thread: renderings never overlap each other, and the calling thread only builds new figures through pyplot
+        (whose registry of open figures no longer holds the submitted ones) while a closed figure is rendered.
+        :param max_workers: Number of figures held for rendering at once (0: figures are written immediately on
+         submission, on the calling thread).
+        :param logger: Logger reporting finished and failed exports.
+        """
+        if max_workers < 0:
+            raise ValueError("Invalid number of figure workers. Must be at least 0.")
+        self.logger = logger
+        self.futures = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PNV-FigureExport")
+        self._slots = threading.BoundedSemaphore(max(max_workers, 1))
+        self._immediate = max_workers == 0
+
+    def submit(self, fig, output_file: str, **savefig_kwargs):
+        """
+        Closes a finished figure in pyplot and queues it for rendering on the export thread.
+        :param fig: Matplotlib figure.
+        :param output_file: Path of the image file.
+        :param savefig_kwargs: Further arguments of Figure.savefig (e.g., dpi and bbox_inches).
+        :return: Future of the export returning the path of the image file.
+        """
+        plt.close(fig)
+        self._slots.acquire()
+        if self._immediate:
+            future = Future()
+            try:
+                future.set_result(write_figure(fig, output_file, savefig_kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            future = self._executor.submit(write_figure, fig, output_file, savefig_kwargs)
+        future.add_done_callback(lambda done: self._report(output_file, done))
+        self.futures.append(future)
+        return future
+
+    def _report(self, output_file: str, future):
+        self._slots.release()
+        if self.logger is None:
+            return
+        if future.exception() is not None:
+            self.logger.error(f"Export of figure {output_file} failed: {future.exception()}")
+        else:
+            self.logger.debug(f"Figure saved to {output_file}")
+
+    def wait(self) -> list:
+        """
+        Waits until all submitted figures are written.
+        :return: Paths of the written image files. The first error of a failed export is raised.
+        """
+        futures, self.futures = self.futures, []
+        wait(futures)
+        return [future.result() for future in futures]
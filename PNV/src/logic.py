@@ -7,77 +7,353 @@ import os
 import glob
 import pandas as pd
 import datetime as dt
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
 
-from rasterio.mask import mask
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.features import geometry_window as dataset_window
+from rasterio.io import MemoryFile
+from rasterio.mask import mask, raster_geometry_mask
 from shapely.geometry import mapping
 from tqdm import tqdm
 
 from PNV.src.datamanager import colors_6, labels_6, colors_20, labels_20
-from PNV.src.datapreprocces import process_all_files
-from PNV.user_input.default_parameters import USER_INPUT, TOOLBOX_INPUT, SRC_CRS, DST_CRS
+from PNV.src.datapreprocces import process_all_files, pyramid_dir, open_warped, read_class_metadata
+from PNV.src.prefetch import RasterPrefetcher
+from PNV.src.probability import stack_path, layer_class, band_classes
+from PNV.src.sampling import ZonalSample, estimate_table
+from PNV.src.export import ExcelExport
+from PNV.src.figures import FigureExport
+from PNV.src.occupancy import TileOccupancy, OccupiedRaster
+from PNV.src.sharding import ShardedZonalStatistics
+from PNV.src.tilecache import TileHistogramCache
+from PNV.src.zonal import CountryCoverage, histogram_to_table, geometry_window, coverage_key, compact_parts
+from PNV.user_input.default_parameters import USER_INPUT, SRC_CRS, DST_CRS
 from PNV.src.base_logger import get_logger
 from PNV.paths.paths import INPUT_RAW_DATA_PATH, PREPROCESSED_DATA_PATH, OUTPUT_PATH
 
 
 class ProcessingArea:
-    def __init__(self):
+    def __init__(self, user_input: dict = USER_INPUT, src_crs: str = SRC_CRS, dst_crs: str = DST_CRS,
+                 input_path: str = INPUT_RAW_DATA_PATH, preprocessed_path: str = PREPROCESSED_DATA_PATH,
+                 output_path: str = OUTPUT_PATH):
         """
-        Initialization of the class ProcessingArea. Read in and preprocess input file to calculate the country-specific
-        area for different classes (IUCN and biomes).
+        Initialization of the class ProcessingArea. The configuration is passed explicitly so that several
+        configurations can be processed side by side (see PNV.src.batch).
+        :param user_input: Dictionary of input parameters (see USER_INPUT in default_parameters.py).
+        :param src_crs: Source coordinate system of the raw data (e.g., 4326).
+        :param dst_crs: Destination reference coordinate system (e.g., 8857).
+        :param input_path: Directory of the raw tif files.
+        :param preprocessed_path: Directory of the preprocessed tif files.
+        :param output_path: Directory in which all results are saved.
         """
         self.logger = get_logger(user_path=None)
         self.time_stamp = dt.datetime.now().strftime("%Y%m%dT%H-%M-%S")
-        self.class_selection = USER_INPUT['CLASS_SELECTION']
-        self.zipped_data = USER_INPUT['ZIPPED_DATA']
+        self.user_input = user_input
+        class_selection = user_input['CLASS_SELECTION']
+        self.class_selections = list(class_selection) if isinstance(class_selection, (list, tuple)) else [
+            class_selection]
+        self.class_selection = self.class_selections[0] if self.class_selections else None
+        self.warped_reads = user_input.get('WARPED_READS', False)
+        self.zipped_data = user_input['ZIPPED_DATA'] and not self.warped_reads  # raw rasters are tif files
+        self.prefetch_rasters = user_input.get('PREFETCH_RASTERS', 0)
+        self.pyramid_levels = user_input.get('PYRAMID_LEVELS', [])
+        self.warp_index = user_input.get('WARP_INDEX', False)
+        self.resolution_level = user_input.get('RESOLUTION_LEVEL', 1)
+        self.src_crs = src_crs
+        self.dst_crs = dst_crs
+        self.input_path = input_path
+        self.preprocessed_path = preprocessed_path
+        self.output_path = output_path
+        self.zonal_method = user_input.get('ZONAL_METHOD', 'mask')
+        self.stacked_rasters = user_input.get('STACKED_RASTERS', False)
+        self.shard_workers = user_input.get('SHARD_WORKERS', 0)
+        self.shard_tile_rows = user_input.get('SHARD_TILE_ROWS', 1024)
+        self.shard_dir = user_input.get('SHARD_DIR', None)
+        self.tile_cache = user_input.get('TILE_CACHE', False)
+        self.mask_threads = user_input.get('MASK_THREADS', 0)
+        self.country_subset = user_input.get('COUNTRY_SUBSET', None)
+        self.subset_merge = user_input.get('SUBSET_MERGE', True)
+        self.subset_base = user_input.get('SUBSET_BASE', None)
+        self.occupancy_index = user_input.get('OCCUPANCY_INDEX', False)
+        self.sample_fraction = user_input.get('SAMPLE_FRACTION', None)
+        self.sample_design = user_input.get('SAMPLE_DESIGN', 'random')
+        self.probability_rasters = user_input.get('PROBABILITY_RASTERS', False)
+        self.probability_scale = user_input.get('PROBABILITY_SCALE', 100)
+        # Estimates and expected areas are saved apart from the hard class results
+        self.result_name = ('class_probability' if self.probability_rasters else
+                            'class_estimate' if self.sample_fraction else 'class')
+        self.resolution_deviation = None
+        self.error_summaries = {}
+        self.results = {}
+        self.complete_results = {}
+        self._countries = None
+        self._coverage = {}
+        self._occupancy = {}
+        self._occupancy_lock = threading.Lock()
+        self._probability_stacks = {}
+        self.excel_export = ExcelExport(logger=self.logger)
+        self.figure_export = FigureExport(max_workers=user_input.get('FIGURE_WORKERS', 2), logger=self.logger)
 
-        if self.class_selection not in [6, 20]:
-            raise ValueError("Invalid class selection. Must be 6 or 20.")
-        self.logger.info(f"Class selection set to: {self.class_selection}")
+        if (not self.class_selections or any(selection not in [6, 20] for selection in self.class_selections) or
+                len(set(self.class_selections)) != len(self.class_selections)):
+            raise ValueError("Invalid class selection. Must be 6 or 20, or a list of both.")
+        self.logger.info(f"Class selection set to: {', '.join(str(x) for x in self.class_selections)}")
+
+        if self.zonal_method not in ['mask', 'coverage']:
+            raise ValueError("Invalid zonal method. Must be 'mask' or 'coverage'.")
+
+        if self.sample_fraction is not None and not 0 < self.sample_fraction <= 1:
+            raise ValueError("Invalid sample fraction. Must be greater than 0 and at most 1, or None.")
+        if self.sample_fraction and self.sample_design not in ['random', 'lattice']:
+            raise ValueError("Invalid sample design. Must be 'random' or 'lattice'.")
+        if self.sample_fraction and self.prefetch_rasters > 0:
+            self.logger.info(f"Read-ahead disabled for the estimate mode, only sampled pixels are read")
+            self.prefetch_rasters = 0
 
-        if USER_INPUT['PROCESS_DATA']:
+        if self.probability_rasters:
+            if self.sample_fraction:
+                raise ValueError("Invalid sample fraction. The estimate mode is not available for probability rasters.")
+            if not self.probability_scale or self.probability_scale <= 0:
+                raise ValueError("Invalid probability scale. Must be greater than 0.")
+            if self.prefetch_rasters > 0:
+                self.logger.info(f"Read-ahead disabled for probability rasters, layers are read strip by strip")
+                self.prefetch_rasters = 0
+
+        if self.country_subset is not None and (isinstance(self.country_subset, str) or not self.country_subset):
+            raise ValueError("Invalid country subset. Must be a non-empty list of ISO3 codes, country names or "
+                             "continents, or None.")
+        if (self.subset_base is not None and not isinstance(self.subset_base, dict) and
+                len(self.class_selections) > 1):
+            raise ValueError("Invalid subset base. Must be a dictionary mapping each class selection to its results "
+                             "file if several class selections are processed.")
+        if self.country_subset and self.prefetch_rasters > 0:
+            self.logger.info(f"Read-ahead disabled for the country subset, rasters are read window by window")
+            self.prefetch_rasters = 0
+
+        if self.warped_reads:
+            if self.resolution_level != 1:
+                raise ValueError("Invalid resolution level. Warped reads are only available at resolution level 1.")
+            self.data_path = self.input_path
+            self.logger.info(f"Raw rasters are reprojected to {self.dst_crs} on the fly")
+        elif self.resolution_level == 1:
+            self.data_path = self.preprocessed_path
+        elif self.resolution_level in self.pyramid_levels:
+            self.data_path = os.path.join(self.preprocessed_path, pyramid_dir(self.resolution_level))
+            self.logger.info(f"Resolution level set to: {self.resolution_level}x native resolution")
+        else:
+            raise ValueError(f"Invalid resolution level. Must be 1 or one of the pyramid levels {self.pyramid_levels}.")
+
+    def run_processing(self) -> Union[pd.DataFrame, dict]:
+        """
+        Read in and preprocess input files to calculate the country-specific area for different classes (IUCN and
+        biomes). Results are saved in the output directory. If several class selections are given, countries, zones
+        and, for stacked or sharded processing, the pass over the grid are shared by the rasters of all selections.
+        :return: Dataframe with km² values for every category and country (dictionary of dataframes for each class
+         selection if CLASS_SELECTION is a list).
+        """
+        if self.user_input['PROCESS_DATA'] and not self.warped_reads:
             self.logger.info(f"Processing data...")
-            process_all_files(INPUT_RAW_DATA_PATH, PREPROCESSED_DATA_PATH, SRC_CRS, DST_CRS)
+            process_all_files(self.input_path, self.preprocessed_path, self.src_crs, self.dst_crs,
+                              pyramid_levels=self.pyramid_levels, warp_index=self.warp_index)
             self.logger.info(f"Data processing complete.")
 
-        self.tif_files = self.filter_tif_files_by_selection()
-        self.logger.info(f"Found {len(self.tif_files)} relevant TIF files for class selection {self.class_selection}.")
+        tif_files = {}
+        for class_selection in self.class_selections:
+            tif_files[class_selection] = self.filter_tif_files_by_selection(class_selection)
+            self.logger.info(f"Found {len(tif_files[class_selection])} relevant TIF files for class selection "
+                             f"{class_selection}.")
+            if self.probability_rasters:
+                tif_files[class_selection] = self.group_probability_stacks(tif_files[class_selection],
+                                                                           class_selection)
+
+        os.makedirs(self.output_path, exist_ok=True)
+        zonal_values = self.get_zonal_values(tif_files)
+
+        results, complete_results = {}, {}
+        for class_selection in self.class_selections:
+            self.class_selection = class_selection
+            self.tif_files = tif_files[class_selection]
+            combined_df = self.process_files(self.tif_files, self.output_path, zonal_values=zonal_values)
+            # A country subset only covers all countries if it is merged into complete results
+            complete_results[class_selection] = not self.country_subset or (
+                    self.subset_merge and self.subset_base_complete())
+            if self.country_subset and self.subset_merge:
+                combined_df = self.merge_results(combined_df)
+            self.save_results(combined_df)
 
-        combined_df = self.process_files(self.tif_files, OUTPUT_PATH)
-        self.save_results(combined_df)
+            if self.resolution_level != 1:
+                self.resolution_deviation = self.report_resolution_deviation()
+            results[class_selection] = combined_df
 
-    def filter_tif_files_by_selection(self):
+        self.results = results
+        self.complete_results = complete_results
+        if isinstance(self.user_input['CLASS_SELECTION'], (list, tuple)):
+            return results
+        return results[self.class_selection]
+
+    def result_table(self, class_selection: int = None) -> pd.DataFrame:
+        """
+        Result table of the last run_processing, to be handed over to PnvDataAnalysis without reading it from disk.
+        Only hard class results covering all countries are handed over; estimates, expected areas and country subsets
+        which were not merged into complete results differ from the table layout of the toolbox. The table is exported
+        in the background and must not be modified until wait_for_exports returns.
+        :param class_selection: Number of classes (6 or 20, default: current class selection).
+        :return: Dataframe with km² values for every category and country (None if the class selection was not
+         processed or its table is not handed over, such that the toolbox reads the results from disk).
+        """
+        class_selection = class_selection or self.class_selection
+        if self.result_name != 'class' or not self.complete_results.get(class_selection, False):
+            return None
+        return self.results.get(class_selection)
+
+    def filter_tif_files_by_selection(self, class_selection: int = None):
         """
         Filters the TIF files to match the selected class based on class_selection.
-        :return: List of filtered TIF files relevant to the selected class.
+        :param class_selection: Number of classes (6 or 20, default: current class selection).
+        :return: List of filtered TIF files relevant to the selected class (per-class probability layers if
+         PROBABILITY_RASTERS is set).
         """
-        data_path = PREPROCESSED_DATA_PATH
-        if self.class_selection == 6:
+        class_selection = class_selection or self.class_selection
+        data_path = self.data_path
+        layers = '*_p_*' if self.probability_rasters else 'hcl*'
+        if class_selection == 6:
             if self.zipped_data:
-                pattern = os.path.join(data_path, 'biomes_iucn.hcl*.zip')
+                pattern = os.path.join(data_path, f'biomes_iucn.{layers}.zip')
             else:
-                pattern = os.path.join(data_path, 'biomes_iucn.hcl*.tif')
-        elif self.class_selection == 20:
+                pattern = os.path.join(data_path, f'biomes_iucn.{layers}.tif')
+        elif class_selection == 20:
             if self.zipped_data:
-                pattern = os.path.join(data_path, 'biomes_biome6k.hcl*.zip')
+                pattern = os.path.join(data_path, f'biomes_biome6k.{layers}.zip')
             else:
-                pattern = os.path.join(data_path, 'biomes_biome6k.hcl*.tif')
+                pattern = os.path.join(data_path, f'biomes_biome6k.{layers}.tif')
         else:
             raise ValueError("Invalid class selection. Must be 6 or 20.")
 
         all_tif_files = glob.glob(pattern)
         self.logger.debug(f"Total tif files found: {len(all_tif_files)}")
 
-        if self.class_selection == 6:
+        if class_selection == 6:
             return [file for file in all_tif_files if 'iucn' in file.lower()]
-        elif self.class_selection == 20:
+        elif class_selection == 20:
             return [file for file in all_tif_files if 'biome6k' in file.lower()]
         return []
 
-    def plot_tif(self, tif_file: str, output_path: str):
+    def group_probability_stacks(self, tif_files: list, class_selection: int = None) -> list:
+        """
+        Groups per-class probability layers into one stack per scenario and period (see PNV.src.probability). A stack
+        is either a multi-band raster with one band per class or a set of single-band rasters, one per class, named
+        by class label or class number. Every class of the class selection must be covered exactly once.
+        :param tif_files: List of probability layers (TIFF or zip files).
+        :param class_selection: Number of classes (6 or 20, default: current class selection).
+        :return: List of stack paths, standing for their layers in process_files.
+        """
+        labels = self.class_labels(class_selection or self.class_selection)
+        stacks = {}
+        for tif_file in sorted(tif_files):
+            if stack_path(tif_file) is None:
+                raise ValueError(f"The probability layer {tif_file} does not follow the naming "
+                                 f"biomes_<classes>.<layer>[.<rcp>]_p_<period>.")
+            stack_file, layer = stack_path(tif_file)
+            with self.open_raster(tif_file) as src:
+                band_count = src.count
+            if band_count > 1:
+                layers = [(tif_file, band, class_index) for band, class_index in
+                          band_classes(band_count, len(labels), name=tif_file)]
+            else:
+                class_index = layer_class(layer, labels)
+                if class_index is None:
+                    raise ValueError(f"The probability layer {tif_file} matches no class. The layer name must be a "
+                                     f"class label or number.")
+                layers = [(tif_file, 1, class_index)]
+            stacks.setdefault(stack_file, []).extend(layers)
+
+        for stack_file, layers in stacks.items():
+            classes = sorted(class_index for _, _, class_index in layers)
+            if classes != list(range(1, len(labels))):
+                missing = [labels[i] for i in range(1, len(labels)) if i not in classes]
+                raise ValueError(f"The probability stack {stack_file} must hold every class once (missing: {missing}, "
+                                 f"layers: {len(layers)}).")
+            self._probability_stacks[stack_file] = [(tif_file, band) for tif_file, band, _ in
+                                                    sorted(layers, key=lambda layer: layer[2])]
+        self.logger.info(f"{len(tif_files)} probability layers grouped into {len(stacks)} stacks")
+        return list(stacks)
+
+    def resolve_raster_path(self, tif_file: str) -> str:
+        """
+        Resolves the path of a TIFF file, which is read directly from the zip archive if the data are zipped.
+        :param tif_file: Path of the TIFF or zip file.
+        :return: Path readable by rasterio.
+        """
+        if self.zipped_data:
+            folder_name = os.path.normpath(tif_file)
+            folder_name = folder_name.split(os.sep)[-1]
+            return f"zip+file://{tif_file}!{folder_name[:-3]}tif"
+        return os.path.abspath(tif_file)
+
+    def open_raster(self, tif_file: Union[str, MemoryFile]):
+        """
+        Opens a TIFF file or a raster already decoded into memory. With warped reads, raw TIFF files are reprojected
+        on the fly (window by window) when read. With the occupancy index, reads of TIFF files skip empty tiles.
+        :param tif_file: Path of the TIFF or zip file, or a MemoryFile provided by read_raster_to_memory.
+        :return: Opened rasterio dataset.
         """
-        Transforms a TIFF file into a PNG format and saves it to the specified output path.
+        if isinstance(tif_file, MemoryFile):
+            return tif_file.open()
+        if self.warped_reads:
+            dataset = open_warped(self.resolve_raster_path(tif_file), self.src_crs, self.dst_crs)
+        else:
+            dataset = rasterio.open(self.resolve_raster_path(tif_file))
+        if self.occupancy_index:
+            return OccupiedRaster(dataset, self.load_occupancy(tif_file, dataset), logger=self.logger)
+        return dataset
+
+    def load_occupancy(self, tif_file: str, dataset) -> TileOccupancy:
+        """
+        Provides the index of the tiles of a raster which contain any non-zero class. The index is built on the first
+        read, stored next to the TIFF or zip file and reused until the file changes.
+        :param tif_file: Path of the TIFF or zip file.
+        :param dataset: Opened rasterio dataset of the file.
+        :return: TileOccupancy.
+        """
+        with self._occupancy_lock:
+            occupancy = self._occupancy.get(tif_file)
+            if occupancy is None or not occupancy.matches(dataset):
+                occupancy = TileOccupancy.load_or_build(tif_file, dataset, logger=self.logger)
+                self._occupancy[tif_file] = occupancy
+        return occupancy
+
+    def read_raster_to_memory(self, tif_file: str) -> MemoryFile:
+        """
+        Reads and decodes (decompresses) a TIFF file into an uncompressed in-memory raster. Used to read the next
+        raster in the background while the current one is processed.
+        :param tif_file: Path of the TIFF or zip file.
+        :return: MemoryFile holding the decoded raster.
+        """
+        with self.open_raster(tif_file) as src:
+            profile = src.profile
+            profile.update(driver='GTiff', compress=None)
+            tags = src.tags()
+            img = src.read()
+            memfile = MemoryFile(filename=os.path.basename(src.name))
+
+        with memfile.open(**profile) as dst:
+            dst.write(img)
+            dst.update_tags(**tags)
+        return memfile
+
+    def plot_tif(self, tif_file: Union[str, MemoryFile], output_path: str, max_size: int = 2000):
+        """
+        Transforms a TIFF file into a PNG format and saves it to the specified output path. The PNG is written in the
+        background (see wait_for_exports). The raster is read decimated (nearest neighbour) to at most max_size pixels
+        on its longer side, which exceeds the pixels of the PNG, such that a pending figure does not hold the full
+        resolution raster.
         :param tif_file: Reads a TIFF file based on the number of vegetation classes (either 6 or 20).
         :param output_path: String of the output folder.
+        :param max_size: Maximum number of rows and columns of the plotted image.
+        :return: Future of the export returning the path of the PNG file.
         """
         if self.class_selection == 20:
             colors = colors_20
@@ -90,47 +366,34 @@ class ProcessingArea:
 
         cmap = mcolors.ListedColormap(colors)
 
-        if self.zipped_data:
-            folder_name = os.path.normpath(tif_file)
-            folder_name = folder_name.split(os.sep)[-1]
-            tif_file = f"zip+file://{tif_file}!{folder_name[:-3]}tif"
-        else:
-            tif_file = os.path.abspath(tif_file)
-
-        with rasterio.open(tif_file) as src:
-            img = src.read(1)
+        with self.open_raster(tif_file) as src:
+            factor = max(1, -(-max(src.height, src.width) // max_size))
+            img = src.read(1, out_shape=(-(-src.height // factor), -(-src.width // factor)),
+                           resampling=Resampling.nearest)
             unique_values = np.unique(img)
 
             if len(unique_values) > len(colors):
                 raise ValueError(f"The image has more than {len(colors)} classes.")
 
-            plt.figure(figsize=(14, 10))
+            fig = plt.figure(figsize=(14, 10))
             plt.imshow(img, cmap=cmap, interpolation='nearest')
             cbar = plt.colorbar(ticks=range(len(colors)))
             cbar.ax.set_yticklabels(labels)
             cbar.ax.yaxis.set_tick_params(labelsize=10)
             cbar.ax.yaxis.set_ticks_position('right')
 
-            filename = os.path.splitext(os.path.basename(tif_file))[0]
+            filename = os.path.splitext(os.path.basename(src.name))[0]
             plt.title(filename)
             plt.tight_layout(rect=[0, 0, 0.85, 1])
-            plt.savefig(output_path)
-            plt.close()
+            return self.figure_export.submit(fig, output_path)
 
-    def calculate_area(self, tif_file: str):
+    def calculate_area(self, tif_file: Union[str, MemoryFile]):
         """
         The complete global area represented in the TIFF file is calculated.
         :param tif_file: Reads a TIFF file based on the number of vegetation classes (either 6 or 20).
         returns: Total area in km².
         """
-        if self.zipped_data:
-            folder_name = os.path.normpath(tif_file)
-            folder_name = folder_name.split(os.sep)[-1]
-            tif_file = f"zip+file://{tif_file}!{folder_name[:-3]}tif"
-        else:
-            tif_file = os.path.abspath(tif_file)
-
-        with rasterio.open(tif_file) as src:
+        with self.open_raster(tif_file) as src:
             resolution = src.res[0]
             width = src.width
             height = src.height
@@ -138,10 +401,11 @@ class ProcessingArea:
             self.logger.info(f"Total area (km^2): {total_area_km2}")
             return total_area_km2
 
-    def count_pixels_in_tif(self, tif_file: str):
+    def count_pixels_in_tif(self, tif_file: Union[str, MemoryFile]):
         """
         Calculates the number of pixel in the TIFF file for each category of vegetation area and provides the
-        corresponding percentage distribution.
+        corresponding percentage distribution. The counts are taken from the class histogram stored by the
+        preprocessing (see read_class_metadata); the raster is only scanned if the histogram is missing or stale.
         :param tif_file: Reads a TIFF file based on the number of vegetation classes (either 6 or 20).
         returns: Dataframe with km² for different classes.
         """
@@ -154,45 +418,63 @@ class ProcessingArea:
         else:
             raise ValueError("Invalid class selection. Must be 6 or 20.")
 
-        if self.zipped_data:
-            folder_name = os.path.normpath(tif_file)
-            folder_name = folder_name.split(os.sep)[-1]
-            tif_file = f"zip+file://{tif_file}!{folder_name[:-3]}tif"
-        else:
-            tif_file = os.path.abspath(tif_file)
-
-        with rasterio.open(tif_file) as src:
+        with self.open_raster(tif_file) as src:
             resolution = src.res
             pixel_area_km2 = (resolution[0] * resolution[1]) / 1e6
+            metadata = read_class_metadata(src)
+            if metadata is not None:
+                histogram = metadata['histograms'][0]
+                class_counts = [int(histogram[value]) if value < len(histogram) else 0 for value in range(len(colors))]
+                total_pixels = src.width * src.height
+                self.logger.debug(f"Pixel counts of {src.name} read from the raster metadata")
+                return self.pixel_count_table(class_counts, total_pixels, total_pixels - int(histogram[0]),
+                                              pixel_area_km2, labels)
+            if isinstance(src, OccupiedRaster):
+                # Empty tiles are not read, their pixels are class 0
+                class_counts, nonzero_pixels = src.class_counts(len(colors))
+                return self.pixel_count_table(class_counts, src.width * src.height, nonzero_pixels, pixel_area_km2,
+                                              labels)
             img = src.read(1)
-            total_pixels = np.prod(img.shape)
-            total_area_km2 = total_pixels * pixel_area_km2
 
-            results = []
+        class_counts = [np.count_nonzero(img == value) for value in range(len(colors))]
+        return self.pixel_count_table(class_counts, img.size, np.count_nonzero(img), pixel_area_km2, labels)
 
-            for value in range(len(colors)):
-                pixel_count = np.count_nonzero(img == value)
-                class_area_km2 = pixel_count * pixel_area_km2
+    @staticmethod
+    def pixel_count_table(class_counts, total_pixels: int, nonzero_pixels: int, pixel_area_km2: float,
+                          labels: list) -> pd.DataFrame:
+        """
+        Builds the table of count_pixels_in_tif from the pixel count of each class.
+        :param class_counts: Number of pixels of each class (including class 0).
+        :param total_pixels: Number of pixels of the raster.
+        :param nonzero_pixels: Number of pixels of the raster which are not 0.
+        :param pixel_area_km2: Area of a pixel in km².
+        :param labels: Class labels.
+        returns: Dataframe with km² for different classes.
+        """
+        results = []
 
-                percentage_include_0 = (pixel_count / total_pixels) * 100
-                percentage_exclude_0 = (
-                    (pixel_count / np.count_nonzero(img != 0)) * 100 if value != 0 else 0
-                )
+        for value, pixel_count in enumerate(class_counts):
+            class_area_km2 = pixel_count * pixel_area_km2
 
-                results.append({
-                    'Value': value,
-                    'Class Name': labels[value],
-                    'Pixel Count': pixel_count,
-                    'Class Area (km²)': class_area_km2,
-                    'Percentage (include 0)': percentage_include_0,
-                    'Percentage (exclude 0)': percentage_exclude_0
-                })
+            percentage_include_0 = (pixel_count / total_pixels) * 100
+            percentage_exclude_0 = (
+                (pixel_count / nonzero_pixels) * 100 if value != 0 else 0
+            )
 
-            results_df = pd.DataFrame(results)
+            results.append({
+                'Value': value,
+                'Class Name': labels[value],
+                'Pixel Count': pixel_count,
+                'Class Area (km²)': class_area_km2,
+                'Percentage (include 0)': percentage_include_0,
+                'Percentage (exclude 0)': percentage_exclude_0
+            })
 
-            return results_df
+        results_df = pd.DataFrame(results)
 
-    def get_pixel_values_by_country(self, raster_file: pd.DataFrame, log_enabled=False):
+        return results_df
+
+    def get_pixel_values_by_country(self, raster_file: Union[str, MemoryFile], log_enabled=False):
         """
         Calculates the pixels of the TIFF files for each category of vegetation area and each country on a global
         level.
@@ -207,88 +489,605 @@ class ProcessingArea:
         else:
             raise ValueError("Invalid number of classes. Must be 6 or 20.")
 
-        world = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
-        world = world.to_crs("EPSG:8857")
-        world['geometry'] = world['geometry'].simplify(tolerance=0.1)
+        if self.zonal_method == 'coverage':
+            return self.get_pixel_values_by_coverage(raster_file, labels)
+
+        world = self.load_countries()
         pixel_counts_df = pd.DataFrame(columns=['country', 'ISO'] + labels + ['Total Pixels', 'Total Area (km^2)'])
 
-        if self.zipped_data:
-            folder_name = os.path.normpath(raster_file)
-            folder_name = folder_name.split(os.sep)[-1]
-            raster_file = f"zip+file://{raster_file}!{folder_name[:-3]}tif"
+        failures = []
+        if self.mask_threads > 1:
+            rows = self.mask_countries_threaded(raster_file, world, labels, failures)
         else:
-            raster_file = os.path.abspath(raster_file)
+            with self.open_raster(raster_file) as src:
+                # Each country is read with its own window
+                rows = [self.mask_country(src, country, labels, failures) for index, country in world.iterrows()]
+        if failures:
+            self.summarize_failures(raster_file, failures)
+
+        for row_data in rows:
+            if row_data is not None:
+                pixel_counts_df = pd.concat([pixel_counts_df, pd.DataFrame([row_data])], ignore_index=True)
+
+        return pixel_counts_df
 
-        with rasterio.open(raster_file) as src:
+    def mask_country(self, src, country, labels: list, failures: list = None):
+        """
+        Calculates the area of each category of vegetation area of one country from the pixels whose center lies
+        within the country. Errors are collected in failures (logged if failures is None) and the country is skipped.
+        :param src: Opened rasterio dataset.
+        :param country: Row of the country layer.
+        :param labels: Class labels.
+        :param failures: List collecting the ISO3 code and exception of each failed country.
+        :return: Dictionary with km² for every class of the country (None if the country is skipped).
+        """
+        resolution = src.res
+        pixel_area_km2 = (resolution[0] * resolution[1]) / 1e6
+        iso_code = country['iso_a3']
+
+        try:
+            # Multi-part countries are masked part group by part group, each with its own tight window
+            masked_values = []
+            for part in self.country_parts(src, country['geometry']):
+                masked_img = self.mask_part(src, [mapping(part)])
+                if masked_img.size > 0:
+                    masked_values.append(masked_img[masked_img != 0])
+            if not masked_values:
+                return None
+
+            masked_img = np.ma.masked_equal(np.concatenate(masked_values), 0)
+
+            unique, counts = np.unique(masked_img.compressed(), return_counts=True)
+            pixel_count_dict = dict(zip(unique, counts))
+
+            row_data = {'country': country['name'], 'ISO': iso_code}
+            total_area = 0
+            for i, label in enumerate(labels):
+                pixel_count = pixel_count_dict.get(i, 0)
+                area = pixel_count * pixel_area_km2
+                row_data[label] = area
+                total_area += area
+
+            row_data['Total Pixels'] = masked_img.compressed().size
+            row_data['Total Area (km^2)'] = total_area
+            return row_data
+        except Exception as e:
+            if failures is None:
+                self.logger.error(f"Processing {country['name']} (ISO: {iso_code}): {e}")
+            else:
+                failures.append((iso_code, e))
+            return None
+
+    def summarize_failures(self, raster_file: Union[str, MemoryFile], failures: list) -> dict:
+        """
+        Aggregates the failed countries of a raster into one summary by error type, which is logged once and kept in
+        error_summaries.
+        :param raster_file: Path of the TIFF or zip file, or a MemoryFile provided by read_raster_to_memory.
+        :param failures: List of the ISO3 code and exception of each failed country.
+        :return: Dictionary mapping each error type to its number of countries, their ISO3 codes and the first
+         message.
+        """
+        summary = {}
+        for iso_code, error in failures:
+            entry = summary.setdefault(type(error).__name__, {'count': 0, 'iso': [], 'message': str(error)})
+            entry['count'] += 1
+            entry['iso'].append(iso_code)
+        for entry in summary.values():
+            entry['iso'].sort()
+
+        raster_name = os.path.basename(raster_file if isinstance(raster_file, str) else raster_file.name)
+        self.error_summaries[raster_name] = summary
+        self.logger.error(f"{len(failures)} countries skipped for {raster_name}: " + "; ".join(
+            f"{error_type} ({entry['count']}: {', '.join(entry['iso'])}; e.g., {entry['message']})"
+            for error_type, entry in summary.items()))
+        return summary
+
+    @staticmethod
+    def country_parts(src, geometry) -> list:
+        """
+        Splits a country into groups of nearby parts (see compact_parts) overlapping the raster.
+        :param src: Opened rasterio dataset.
+        :param geometry: Geometry of the country.
+        :return: List of geometries (the geometry itself if it has a single group or no group overlaps the raster).
+        """
+        def overlaps(part) -> bool:
+            try:
+                dataset_window(src, [mapping(part)])
+                return True
+            except WindowError:
+                return False
+
+        parts = compact_parts(geometry)
+        if len(parts) > 1:
+            parts = [part for part in parts if overlaps(part)]
+        return parts or [geometry]
+
+    @staticmethod
+    def mask_part(src, geometry: list) -> np.ndarray:
+        """
+        Masks the pixels whose center lies within a geometry, read from the window of the geometry.
+        :param src: Opened rasterio dataset.
+        :param geometry: List of GeoJSON-like geometries.
+        :return: Array of the window with 0 outside the geometry.
+        """
+        if isinstance(src, OccupiedRaster):
+            # Only the occupied tiles of the window are read
+            shape_mask, out_transform, window = raster_geometry_mask(src, geometry, crop=True)
+            masked_img = src.read(1, window=window)
+            if src.nodata is not None:
+                shape_mask = shape_mask | (masked_img == src.nodata)
+            masked_img[shape_mask] = 0
+            return masked_img
+        out_image, out_transform = mask(src, geometry, crop=True, nodata=0)
+        return out_image[0]
+
+    def mask_countries_threaded(self, raster_file: Union[str, MemoryFile], world: gpd.GeoDataFrame,
+                                labels: list, failures: list = None) -> list:
+        """
+        Runs mask_country for all countries in a thread pool. Each thread reads with its own dataset handle; windowed
+        reads and NumPy reductions release the GIL. The largest countries (by bounding box) are scheduled first, such
+        that they do not end up last on a single thread.
+        :param raster_file: Path of the TIFF or zip file, or a MemoryFile provided by read_raster_to_memory.
+        :param world: GeoDataFrame of countries.
+        :param labels: Class labels.
+        :param failures: List collecting the ISO3 code and exception of each failed country (see mask_country).
+        :return: Results of mask_country in the order of the countries.
+        """
+        handles = threading.local()
+        opened = []
+        opened_lock = threading.Lock()
+
+        def process_country(position: int):
+            if not hasattr(handles, 'src'):
+                handles.src = self.open_raster(raster_file)
+                with opened_lock:
+                    opened.append(handles.src)
+            return self.mask_country(handles.src, world.iloc[position], labels, failures)
+
+        largest_first = np.argsort(-world['geometry'].envelope.area.to_numpy(), kind='stable')
+        try:
+            with ThreadPoolExecutor(max_workers=self.mask_threads, thread_name_prefix="PNV-Mask") as executor:
+                futures = {position: executor.submit(process_country, position) for position in largest_first}
+                return [futures[position].result() for position in range(len(world))]
+        finally:
+            for src in opened:
+                src.close()
+
+    def load_countries(self) -> gpd.GeoDataFrame:
+        """
+        Reads the country layer (naturalearth_lowres from the geopandas package) in the coordinate system of the
+        preprocessed rasters. The layer is read once and reused for all rasters. If a country subset is selected, only
+        the selected countries are kept.
+        :return: GeoDataFrame of countries.
+        """
+        if self._countries is None:
+            world = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
+            world = world.to_crs(self.dst_crs)
+            world['geometry'] = world['geometry'].simplify(tolerance=0.1)
+            if self.country_subset:
+                world = self.select_countries(world, self.country_subset)
+                self.logger.info(f"Country subset: {len(world)} countries ({', '.join(world['iso_a3'])})")
+            self._countries = world
+        return self._countries
+
+    @staticmethod
+    def select_countries(world: gpd.GeoDataFrame, country_subset: list) -> gpd.GeoDataFrame:
+        """
+        Selects countries by ISO3 code, country name or continent.
+        :param world: GeoDataFrame of countries (columns 'name', 'iso_a3', 'continent').
+        :param country_subset: List of ISO3 codes, country names or continents (e.g., ['DEU', 'Africa']).
+        :return: GeoDataFrame of the selected countries.
+        """
+        unknown_entries = [entry for entry in country_subset
+                           if entry not in set(world['iso_a3']) | set(world['name']) | set(world['continent'])]
+        if unknown_entries:
+            raise ValueError(f"Invalid country subset {unknown_entries}. Must be ISO3 codes, country names or "
+                             f"continents ({', '.join(sorted(world['continent'].unique()))}).")
+        selected = (world['iso_a3'].isin(country_subset) | world['name'].isin(country_subset) |
+                    world['continent'].isin(country_subset))
+        return world[selected]
+
+    def load_coverage(self, shape: tuple, transform, method: str = 'coverage') -> CountryCoverage:
+        """
+        Provides the fractional coverage of the raster grid by the countries. The coverage is computed once per grid,
+        cached in the preprocessed directory and reused for every scenario, period and class selection.
+        :param shape: Raster shape (height, width).
+        :param transform: Affine transform of the raster.
+        :param method: 'coverage' for fractional coverage weights or 'mask' for the pixel centers of each country.
+        :return: CountryCoverage.
+        """
+        coverage = self._coverage.get(method)
+        if coverage is None or not coverage.matches(shape, transform):
+            coverage = CountryCoverage.load_or_build(self.load_countries(), shape, transform,
+                                                     cache_dir=os.path.join(self.preprocessed_path, 'coverage'),
+                                                     logger=self.logger, method=method)
+            self._coverage[method] = coverage
+        return coverage
+
+    def get_pixel_values_by_coverage(self, raster_file: Union[str, MemoryFile], labels: list) -> pd.DataFrame:
+        """
+        Calculates the area of each category of vegetation area and each country using fractional coverage weights.
+        Border pixels are split between countries according to their covered area fraction.
+        :param raster_file: Reads a TIFF file based on the number of vegetation classes (either 6 or 20).
+        :param labels: Class labels.
+        :return: Dataframe with km² for every country.
+        """
+        # Only the bounding window of the covered pixels is read
+        with self.open_raster(raster_file) as src:
             resolution = src.res
             pixel_area_km2 = (resolution[0] * resolution[1]) / 1e6
+            coverage = self.load_coverage(src.shape, src.transform)
+            window = coverage.bounding_window()
+            img = src.read(1, window=window) if window is not None else None
 
-            img = src.read(1)
-            total_pixels = img.size
-            total_area_km2 = total_pixels * pixel_area_km2
-
-            for index, country in world.iterrows():
-                geometry = [mapping(country['geometry'])]
-                iso_code = country['iso_a3']
-
-                try:
-                    out_image, out_transform = mask(src, geometry, crop=True, nodata=0)
-                    masked_img = out_image[0]
-                    if masked_img.size == 0:
-                        continue
-
-                    masked_img = np.ma.masked_equal(masked_img, 0)
-
-                    unique, counts = np.unique(masked_img.compressed(), return_counts=True)
-                    pixel_count_dict = dict(zip(unique, counts))
-
-                    row_data = {'country': country['name'], 'ISO': iso_code}
-                    total_area = 0
-                    for i, label in enumerate(labels):
-                        pixel_count = pixel_count_dict.get(i, 0)
-                        area = pixel_count * pixel_area_km2
-                        row_data[label] = area
-                        total_area += area
-
-                    row_data['Total Pixels'] = masked_img.compressed().size
-                    row_data['Total Area (km^2)'] = total_area
-                    pixel_counts_df = pd.concat([pixel_counts_df, pd.DataFrame([row_data])], ignore_index=True)
-                except Exception as e:
-                    self.logger.error(f"Processing {country['name']} (ISO: {iso_code}): {e}")
-                    continue
+        if window is None:
+            histogram = np.zeros((coverage.num_zones, len(labels)))
+        else:
+            histogram = coverage.zonal_histogram(img, num_classes=len(labels), window=window)
+        return histogram_to_table(histogram, coverage.names, coverage.iso, labels, pixel_area_km2)
 
-        return pixel_counts_df
+    def common_grid(self, tif_files: list):
+        """
+        Checks that the TIFF files are co-registered (same shape, coordinate system and transform).
+        :param tif_files: List of TIFF files.
+        :return: Shape, transform and resolution of the common grid (None if the files do not share a common grid).
+        """
+        with self.open_raster(tif_files[0]) as reference:
+            grid = (reference.shape, reference.transform, reference.res)
+            for tif_file in tif_files[1:]:
+                with self.open_raster(tif_file) as dataset:
+                    if (dataset.shape != reference.shape or dataset.crs != reference.crs or
+                            not dataset.transform.almost_equals(reference.transform)):
+                        self.logger.warning(f"Raster {dataset.name} is not on the grid of {reference.name}, rasters "
+                                            f"are processed one after another.")
+                        return None
+        return grid
+
+    def listed_zones(self, shape: tuple, transform):
+        """
+        Countries listed in the results of the zonal method. For the mask method, countries overlapping the raster are
+        listed even without pixels, as by rasterio.mask.mask.
+        :param shape: Raster shape (height, width).
+        :param transform: Affine transform of the raster.
+        :return: Boolean array selecting the countries (None: countries with covered pixels).
+        """
+        if self.zonal_method != 'mask':
+            return None
+        return np.array([geometry_window(geometry, shape, transform) is not None
+                         for geometry in self.load_countries()['geometry']])
+
+    @staticmethod
+    def class_labels(class_selection: int) -> list:
+        """
+        Class labels of a class selection.
+        :param class_selection: Number of classes (6 or 20).
+        :return: Class labels (including NA for class 0).
+        """
+        if class_selection == 20:
+            return labels_20
+        elif class_selection == 6:
+            return labels_6
+        raise ValueError("Invalid class selection. Must be 6 or 20.")
 
-    def process_files(self, tif_files: str, output_dir: str):
+    def split_histogram(self, tif_file: str, histogram: np.ndarray, num_classes: int) -> np.ndarray:
+        """
+        Cuts a histogram computed for several class selections down to the classes of one raster.
+        :param tif_file: Path of the TIFF file of the histogram.
+        :param histogram: Array (... x classes) of pixel counts with the classes as last axis.
+        :param num_classes: Number of classes of the raster (including class 0).
+        :return: Array (... x num_classes) of pixel counts.
+        """
+        if np.any(histogram[..., num_classes:]):
+            raise ValueError(f"The image {tif_file} has more than {num_classes} classes.")
+        return histogram[..., :num_classes]
+
+    def get_pixel_values_stacked(self, tif_files: list, class_selections: dict = None) -> dict:
+        """
+        Calculates the area of each category of vegetation area and each country for all co-registered TIFF files in a
+        single pass over the grid. The rasters are read window by window as a stack and the country histograms of all
+        rasters are updated together, such that the country geometries and windows are processed once per run. Pixels
+        are assigned to countries as selected by the zonal method.
+        :param tif_files: List of TIFF files on a common grid.
+        :param class_selections: Dictionary mapping each TIFF file to its class selection (default: current class
+         selection for all files).
+        :return: Dictionary mapping each TIFF file to its dataframe with km² for every country (None if the files do
+         not share a common grid).
+        """
+        labels = {tif_file: self.class_labels((class_selections or {}).get(tif_file, self.class_selection))
+                  for tif_file in tif_files}
+        num_classes = max(len(file_labels) for file_labels in labels.values())
+        grid = self.common_grid(tif_files)
+        if grid is None:
+            return None
+        shape, transform, resolution = grid
+
+        pixel_area_km2 = (resolution[0] * resolution[1]) / 1e6
+        coverage = self.load_coverage(shape, transform, method=self.zonal_method)
+        self.logger.info(f"Stacked processing of {len(tif_files)} rasters on grid {shape}")
+        datasets = [self.open_raster(tif_file) for tif_file in tif_files]
+        try:
+            histograms = coverage.stacked_histograms(datasets, num_classes=num_classes)
+        finally:
+            for dataset in datasets:
+                dataset.close()
+
+        zones = self.listed_zones(shape, transform)
+        return {tif_file: histogram_to_table(self.split_histogram(tif_file, histogram, len(labels[tif_file])),
+                                             coverage.names, coverage.iso, labels[tif_file], pixel_area_km2,
+                                             zones=zones)
+                for tif_file, histogram in zip(tif_files, histograms)}
+
+    def get_pixel_values_sharded(self, tif_files: list, class_selections: dict = None) -> dict:
+        """
+        Calculates the area of each category of vegetation area and each country for all co-registered TIFF files as a
+        tile-sharded map-reduce job (see PNV.src.sharding). Every tile of every raster is a task of a file-based queue
+        in the shard directory, processed by local worker processes and by additional workers started on other
+        machines sharing the directory. The partial histograms of the tiles are merged by summation. Failed tiles are
+        retried on their own; the shard directory is kept if tiles fail after all retries.
+        :param tif_files: List of TIFF files on a common grid.
+        :param class_selections: Dictionary mapping each TIFF file to its class selection (default: current class
+         selection for all files).
+        :return: Dictionary mapping each TIFF file to a tuple of its dataframe with km² for every country and its
+         dataframe of count_pixels_in_tif (None if the files do not share a common grid).
+        """
+        labels = {tif_file: self.class_labels((class_selections or {}).get(tif_file, self.class_selection))
+                  for tif_file in tif_files}
+        num_classes = max(len(file_labels) for file_labels in labels.values())
+        grid = self.common_grid(tif_files)
+        if grid is None:
+            return None
+        shape, transform, resolution = grid
+
+        pixel_area_km2 = (resolution[0] * resolution[1]) / 1e6
+        coverage = self.load_coverage(shape, transform, method=self.zonal_method)
+        work_dir = self.shard_dir or os.path.join(
+            self.output_path, f"{self.time_stamp}_{'_'.join(str(x) for x in self.class_selections)}_shards")
+        if self.occupancy_index:
+            for tif_file in tif_files:
+                with self.open_raster(tif_file):
+                    pass  # the occupancy index is built and stored on the first opening, then read by the workers
+        job = ShardedZonalStatistics(work_dir, tile_rows=self.shard_tile_rows, logger=self.logger)
+        job.prepare([self.resolve_raster_path(tif_file) for tif_file in tif_files], coverage,
+                    num_classes=num_classes,
+                    warp={'src_crs': self.src_crs, 'dst_crs': self.dst_crs} if self.warped_reads else None,
+                    occupancy=[os.path.abspath(tif_file) for tif_file in tif_files] if self.occupancy_index else None)
+        self.logger.info(f"Sharded processing of {len(tif_files)} rasters with {self.shard_workers} local workers "
+                         f"(additional workers: python -m PNV.src.sharding {work_dir})")
+        job.run(workers=self.shard_workers)
+        results = job.reduce()
+        job.clean()
+
+        zones = self.listed_zones(shape, transform)
+        pixel_values = {}
+        for tif_file, result in zip(tif_files, results):
+            file_labels = labels[tif_file]
+            histogram = self.split_histogram(tif_file, result['histogram'], len(file_labels))
+            class_counts = result['class_counts'][:len(file_labels)]
+            pixel_values[tif_file] = (
+                histogram_to_table(histogram, coverage.names, coverage.iso, file_labels, pixel_area_km2, zones=zones),
+                self.pixel_count_table([int(count) for count in class_counts], int(result['total_pixels']),
+                                       int(result['nonzero_pixels']), pixel_area_km2, file_labels))
+        return pixel_values
+
+    def get_pixel_values_tile_cached(self, tif_files: list, class_selections: dict = None) -> dict:
+        """
+        Calculates the area of each category of vegetation area and each country from partial histograms of tiles
+        (ranges of rows), cached under the checksum of the tile content in the preprocessed directory (see
+        PNV.src.tilecache). Only tiles whose content changed since a previous run, e.g., the corrected regions of a
+        re-released raster, are recomputed.
+        :param tif_files: List of TIFF files.
+        :param class_selections: Dictionary mapping each TIFF file to its class selection (default: current class
+         selection for all files).
+        :return: Dictionary mapping each TIFF file to a tuple of its dataframe with km² for every country and its
+         dataframe of count_pixels_in_tif.
+        """
+        pixel_values = {}
+        for tif_file in tif_files:
+            labels = self.class_labels((class_selections or {}).get(tif_file, self.class_selection))
+            with self.open_raster(tif_file) as src:
+                pixel_area_km2 = (src.res[0] * src.res[1]) / 1e6
+                coverage = self.load_coverage(src.shape, src.transform, method=self.zonal_method)
+                key = f"{self.zonal_method}_{coverage_key(self.load_countries(), src.shape, src.transform)}"
+                cache = TileHistogramCache(os.path.join(self.preprocessed_path, 'tile_cache'), key=key,
+                                           num_classes=len(labels))
+                result = cache.histograms(src, coverage)
+                zones = self.listed_zones(src.shape, src.transform)
+            self.logger.info(f"{result['recomputed_tiles']} of {result['tiles']} tiles recomputed for {tif_file}")
+
+            pixel_values[tif_file] = (
+                histogram_to_table(result['histogram'], coverage.names, coverage.iso, labels, pixel_area_km2,
+                                   zones=zones),
+                self.pixel_count_table([int(count) for count in result['class_counts']], result['total_pixels'],
+                                       result['nonzero_pixels'], pixel_area_km2, labels))
+        return pixel_values
+
+    def get_pixel_values_sampled(self, tif_files: list, class_selections: dict = None) -> dict:
+        """
+        Estimates the area of each category of vegetation area and each country from a stratified sample of the
+        pixels of each country (see PNV.src.sampling). Only the raster blocks holding sampled pixels are read. The same
+        pixels are sampled from all rasters on a grid. Pixels are assigned to countries as selected by the zonal
+        method.
+        :param tif_files: List of TIFF files.
+        :param class_selections: Dictionary mapping each TIFF file to its class selection (default: current class
+         selection for all files).
+        :return: Dictionary mapping each TIFF file to its dataframe with estimated km² for every country, including
+         standard errors and 95% confidence intervals.
+        """
+        samples = {}
+        pixel_values = {}
+        for tif_file in tif_files:
+            labels = self.class_labels((class_selections or {}).get(tif_file, self.class_selection))
+            with self.open_raster(tif_file) as src:
+                pixel_area_km2 = (src.res[0] * src.res[1]) / 1e6
+                coverage = self.load_coverage(src.shape, src.transform, method=self.zonal_method)
+                if id(coverage) not in samples:
+                    samples[id(coverage)] = ZonalSample.draw(coverage, self.sample_fraction, design=self.sample_design)
+                    self.logger.info(f"Sampled {len(samples[id(coverage)].indices)} pixels ({self.sample_design} "
+                                     f"design, fraction {self.sample_fraction}) on grid {src.shape}")
+                sample = samples[id(coverage)]
+                values = sample.read(src)
+                zones = self.listed_zones(src.shape, src.transform)
+            pixel_values[tif_file] = estimate_table(sample, values, coverage.names, coverage.iso, labels,
+                                                    pixel_area_km2, zones=zones, name=tif_file)
+        return pixel_values
+
+    def get_pixel_values_probability(self, stack_files: list, class_selections: dict = None) -> dict:
+        """
+        Calculates the expected area of each category of vegetation area and each country from per-class probability
+        rasters. All layers of all stacks on a grid are read strip by strip in a single pass and the probability-
+        weighted pixels are accumulated with float accumulators (see CountryCoverage.probability_histograms), such that
+        the memory does not grow with the grid. Pixels are assigned to countries as selected by the zonal method.
+        :param stack_files: List of probability stacks (see group_probability_stacks).
+        :param class_selections: Dictionary mapping each stack to its class selection (default: current class
+         selection for all stacks).
+        :return: Dictionary mapping each stack to its dataframe with expected km² for every country.
+        """
+        datasets = {}
+        try:
+            grids = {}
+            for stack_file in stack_files:
+                layers = []
+                for tif_file, band in self._probability_stacks[stack_file]:
+                    if tif_file not in datasets:
+                        datasets[tif_file] = self.open_raster(tif_file)
+                    layers.append((datasets[tif_file], band))
+                src = layers[0][0]
+                coverage = self.load_coverage(src.shape, src.transform, method=self.zonal_method)
+                grid = grids.setdefault(id(coverage), (coverage, src.shape, src.transform, src.res, {}))
+                grid[4][stack_file] = layers
+
+            pixel_values = {}
+            for coverage, shape, transform, resolution, stacks in grids.values():
+                self.logger.info(f"Expected areas of {len(stacks)} probability stacks on grid {shape}")
+                histograms = coverage.probability_histograms(list(stacks.values()), scale=self.probability_scale)
+                pixel_area_km2 = (resolution[0] * resolution[1]) / 1e6
+                zones = self.listed_zones(shape, transform)
+                for stack_file, histogram in zip(stacks, histograms):
+                    labels = self.class_labels((class_selections or {}).get(stack_file, self.class_selection))
+                    pixel_values[stack_file] = histogram_to_table(histogram, coverage.names, coverage.iso, labels,
+                                                                  pixel_area_km2, zones=zones)
+            return pixel_values
+        finally:
+            for dataset in datasets.values():
+                dataset.close()
+
+    def get_zonal_values(self, tif_files: dict) -> dict:
+        """
+        Calculates the country areas of the TIFF files of all class selections at once for probability rasters, the
+        estimate mode, or if sharded, tile-cached or stacked processing is selected. The rasters of all class
+        selections share the countries, the zones and (probability rasters, sharded or stacked processing) the pass
+        over the grid.
+        :param tif_files: Dictionary mapping each class selection to its list of TIFF files.
+        :return: Dictionary mapping each TIFF file to a tuple of its dataframe with km² for every country and its
+         dataframe of count_pixels_in_tif (None if not computed). Empty if the files are processed one after another.
+        """
+        class_selections = {tif_file: class_selection for class_selection, files in tif_files.items()
+                            for tif_file in files}
+        all_files = list(class_selections)
+        if not all_files:
+            return {}
+
+        if self.probability_rasters:
+            return {tif_file: (pixel_values_df, None) for tif_file, pixel_values_df in
+                    self.get_pixel_values_probability(all_files, class_selections).items()}
+        if self.sample_fraction:
+            return {tif_file: (pixel_values_df, None) for tif_file, pixel_values_df in
+                    self.get_pixel_values_sampled(all_files, class_selections).items()}
+        if self.shard_workers > 0:
+            sharded_values = self.get_pixel_values_sharded(all_files, class_selections)
+            if sharded_values is not None:
+                return sharded_values
+        if self.tile_cache:
+            return self.get_pixel_values_tile_cached(all_files, class_selections)
+        if self.stacked_rasters:
+            stacked_values = self.get_pixel_values_stacked(all_files, class_selections)
+            if stacked_values is not None:
+                return {tif_file: (pixel_values_df, None) for tif_file, pixel_values_df in stacked_values.items()}
+        return {}
+
+    def process_files(self, tif_files: str, output_dir: str, zonal_values: dict = None):
         """
         The function gathers all processing and calculation steps.
         :param tif_files: Reads a TIFF file based on the number of vegetation classes (either 6 or 20).
         :param output_dir: Output directory path.
+        :param zonal_values: Country areas computed in advance (see get_zonal_values). Computed for tif_files if None.
         :return: Dataframe with km² values for every category and country.
         """
         combined_df = pd.DataFrame()
+        if zonal_values is None:
+            zonal_values = self.get_zonal_values({self.class_selection: tif_files})
+
+        if self.prefetch_rasters > 0:
+            rasters = RasterPrefetcher(tif_files, self.read_raster_to_memory, max_prefetched=self.prefetch_rasters)
+        else:
+            rasters = [(tif_file_path, tif_file_path) for tif_file_path in tif_files]
 
-        for tif_file_path in tqdm(tif_files, desc="Processing TIFF files"):
+        for tif_file_path, raster in tqdm(rasters, total=len(tif_files), desc="Processing TIFF files"):
             original_name = os.path.splitext(os.path.basename(tif_file_path))[0]
             sheet_name = self.reduce_filename(original_name)
 
             self.logger.info(f"Processing {tif_file_path} with sheet name {sheet_name}")
 
-            plot_path = os.path.join(output_dir, f"{sheet_name}.png")
-            self.plot_tif(tif_file_path, plot_path)
+            # The global map and class counts are not redone for a country subset or estimates, and are not defined
+            # for probability stacks
+            full_pass = not self.country_subset and not self.sample_fraction and not self.probability_rasters
+            if full_pass:
+                plot_path = os.path.join(output_dir, f"{sheet_name}.png")
+                self.plot_tif(raster, plot_path)
 
-            area = self.calculate_area(tif_file_path)
-            self.logger.info(f"Calculated area for {tif_file_path}: {area} km^2")
+            if not self.probability_rasters:
+                area = self.calculate_area(raster)
+                self.logger.info(f"Calculated area for {tif_file_path}: {area} km^2")
 
-            pixel_count_df = self.count_pixels_in_tif(tif_file_path)
-            self.logger.info(f"Pixel counts calculated for {tif_file_path}")
+            pixel_values_df, pixel_count_df = zonal_values.get(tif_file_path, (None, None))
+            if pixel_count_df is None and full_pass:
+                pixel_count_df = self.count_pixels_in_tif(raster)
+                self.logger.info(f"Pixel counts calculated for {tif_file_path}")
 
-            pixel_values_df = self.get_pixel_values_by_country(tif_file_path)
+            if pixel_values_df is None:
+                pixel_values_df = self.get_pixel_values_by_country(raster)
             pixel_values_df['Sheet Name'] = sheet_name
 
             combined_df = pd.concat([combined_df, pixel_values_df], ignore_index=True)
         return combined_df
 
+    def report_resolution_deviation(self) -> pd.DataFrame:
+        """
+        Compares the class areas of the historic raster at the selected pyramid level with the native resolution to
+        report the area deviation caused by the coarser resolution. The deviation is logged and saved in the output
+        directory.
+        :return: Dataframe with native and coarse class areas and their relative deviation.
+        """
+        historic_files = [file for file in self.tif_files if 'rcp' not in os.path.basename(file).lower()]
+        if not historic_files:
+            self.logger.warning(f"No historic raster found, area deviation from native resolution not reported.")
+            return None
+
+        coarse_file = historic_files[0]
+        native_file = os.path.join(self.preprocessed_path, os.path.basename(coarse_file))
+        if not os.path.exists(native_file):
+            self.logger.warning(f"Native raster {native_file} not found, area deviation not reported.")
+            return None
+
+        native_df = self.count_pixels_in_tif(native_file)
+        coarse_df = self.count_pixels_in_tif(coarse_file)
+
+        deviation_df = native_df[['Value', 'Class Name']].copy()
+        deviation_df['Native Area (km²)'] = native_df['Class Area (km²)']
+        deviation_df[f'Area {self.resolution_level}x (km²)'] = coarse_df['Class Area (km²)']
+        deviation_df['Deviation (%)'] = ((coarse_df['Class Area (km²)'] - native_df['Class Area (km²)']) /
+                                         native_df['Class Area (km²)'].where(native_df['Class Area (km²)'] > 0) * 100)
+
+        land_native = native_df.loc[native_df['Value'] != 0, 'Class Area (km²)'].sum()
+        land_coarse = coarse_df.loc[coarse_df['Value'] != 0, 'Class Area (km²)'].sum()
+        self.logger.info(f"Area deviation at {self.resolution_level}x native resolution (historic raster): "
+                         f"{(land_coarse - land_native) / land_native * 100:.3f} % of the land area, max. class "
+                         f"deviation {deviation_df['Deviation (%)'].abs().max():.3f} %")
+
+        deviation_df.to_excel(os.path.join(
+            self.output_path, f'{self.time_stamp}_{self.class_selection}_class_resolution_deviation.xlsx'), index=False)
+        return deviation_df
+
     def reduce_filename(self, filename, length=31):
         """
         Reduces the filename to ensure it fits within the Excel sheet name limit.
@@ -302,27 +1101,94 @@ class ProcessingArea:
             reduced = filename[:length]
         return reduced[:length]
 
-    def save_results(self, combined_df: pd.DataFrame):
+    def subset_base_file(self) -> str:
         """
-        Saves the country-specific data of different classes in .xlsx and .pkl.
-        :param combined_df: Contains all the information about the classes for every country.
+        Results file given by SUBSET_BASE for the current class selection.
+        :return: Path of the results file (None if not given).
+        """
+        base_file = self.subset_base
+        if isinstance(base_file, dict):
+            base_file = base_file.get(self.class_selection, base_file.get(str(self.class_selection)))
+        return base_file
+
+    def subset_base_complete(self) -> bool:
+        """
+        Checks whether the results into which the country subset is merged (see load_subset_base) cover all
+        countries: a given results file is taken as complete, the results of a previous run only if they were complete.
+        :return: True if the merged results cover all countries.
+        """
+        if self.subset_base_file() is not None:
+            return True
+        return self.class_selection in self.results and self.complete_results.get(self.class_selection, False)
+
+    def load_subset_base(self) -> tuple:
+        """
+        Provides the results into which the country subset of the current class selection is merged: the results file
+        given by SUBSET_BASE or, if none is given, the results of a previous run_processing of this instance.
+        :return: Tuple of the results and their source (None and None if no results are given).
+        """
+        base_file = self.subset_base_file()
+        if base_file is not None:
+            return pd.read_pickle(base_file), base_file
+        if self.class_selection in self.results:
+            return self.results[self.class_selection], "the previous run"
+        return None, None
+
+    def merge_results(self, subset_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Merges the results of a country subset into the results of the class selection (see load_subset_base). Rows of
+        the selected countries are replaced in place; all other rows are kept. Rows are identified by sheet, country
+        name and ISO3 code, since several countries share the ISO3 code -99.
+        :param subset_df: Results of the country subset.
+        :return: Merged results (subset_df if no results are given).
         """
+        existing_df, source = self.load_subset_base()
+        if existing_df is None:
+            self.logger.warning(f"No results of class selection {self.class_selection} given to merge the country "
+                                f"subset into (SUBSET_BASE), only the country subset is saved.")
+            return subset_df
+
+        countries = self.load_countries()
+        selected = set(zip(countries['name'], countries['iso_a3']))
+        replaced = (existing_df['Sheet Name'].isin(subset_df['Sheet Name']) &
+                    pd.Series([key in selected for key in zip(existing_df['country'], existing_df['ISO'])],
+                              index=existing_df.index))
 
-        class_selection = self.class_selection
-        with pd.ExcelWriter(
-                os.path.join(OUTPUT_PATH, f'{self.time_stamp}_{class_selection}_class_different_sheets.xlsx'),
-                engine='xlsxwriter') as writer:
-            for sheet_name in combined_df['Sheet Name'].unique():
-                df_sheet = combined_df[combined_df['Sheet Name'] == sheet_name]
-                df_sheet.to_excel(writer, sheet_name=sheet_name[:31], index=False)
+        # Rows keep the position of the row they replace, new rows are placed after the last row of their sheet
+        position = {key: k for k, key in enumerate(zip(existing_df['Sheet Name'], existing_df['country'],
+                                                       existing_df['ISO']))}
+        sheet_end = {sheet: k + 0.5 for k, sheet in enumerate(existing_df['Sheet Name'])}
+        order = np.concatenate([
+            np.arange(len(existing_df), dtype=float)[~replaced.to_numpy()],
+            [position.get(key, sheet_end.get(key[0], len(existing_df))) for key in
+             zip(subset_df['Sheet Name'], subset_df['country'], subset_df['ISO'])]])
+        merged_df = pd.concat([existing_df[~replaced], subset_df], ignore_index=True)
+        merged_df = merged_df.iloc[np.argsort(order, kind='stable')].reset_index(drop=True)
 
-        with pd.ExcelWriter(
-                os.path.join(OUTPUT_PATH, f'{self.time_stamp}_{class_selection}_class_combined.xlsx'),
-                engine='xlsxwriter') as writer:
-            combined_df.to_excel(writer, sheet_name='Results', index=False)
+        self.logger.info(f"{replaced.sum()} rows of {source} replaced by {len(subset_df)} rows of the country subset")
+        return merged_df
+
+    def save_results(self, combined_df: pd.DataFrame):
+        """
+        Saves the country-specific data of different classes in .xlsx and .pkl. Both Excel files and the pickle are
+        written concurrently in background threads while the processing continues (see wait_for_exports). combined_df
+        must not be modified until the export is finished.
+        :param combined_df: Contains all the information about the classes for every country.
+        """
 
-        combined_df.to_pickle(os.path.join(OUTPUT_PATH, f'{self.time_stamp}_{class_selection}_class_combined.pkl'))
+        file_name = f'{self.time_stamp}_{self.class_selection}_{self.result_name}'
+        self.excel_export.submit(os.path.join(self.output_path, f'{file_name}_different_sheets.xlsx'),
+                                 sheets=combined_df.groupby('Sheet Name', sort=False))
+        self.excel_export.submit(os.path.join(self.output_path, f'{file_name}_combined.xlsx'),
+                                 sheets=[('Results', combined_df)])
+        self.excel_export.submit_pickle(os.path.join(self.output_path, f'{file_name}_combined.pkl'), combined_df)
+        self.logger.info(f"Results are written in the background to {self.output_path}")
 
-        self.logger.info(f"Results saved to Excel and pickle files in {OUTPUT_PATH}")
+    def wait_for_exports(self) -> list:
+        """
+        Waits until the Excel and pickle files of save_results and the PNG files of plot_tif are written.
+        :return: Paths of the written files.
+        """
+        return self.excel_export.wait() + self.figure_export.wait()
 
 
@@ -1,15 +1,20 @@
+import pandas as pd
+
 from PNV.user_input.default_parameters import USER_INPUT, TOOLBOX_INPUT, SRC_CRS, DST_CRS
+from PNV.paths.paths import OUTPUT_PATH
 from PNV.src.logic import ProcessingArea
 from PNV.toolbox.data_analysis import PnvDataAnalysis
 
 
-def launch_toolbox(user_input: dict):
+def launch_toolbox(user_input: dict, output_path: str = OUTPUT_PATH, pnv_data: pd.DataFrame = None):
     """
     Launches the toolbox to validate and visualize aggregated data.
     :param user_input: Dictionary holding all user inputs.
+    :param output_path: Directory holding the processed PNV data, in which the figures are saved.
+    :param pnv_data: Result table handed over from ProcessingArea (None: read from the output directory).
     """
 
-    pnv_analysis = PnvDataAnalysis(user_input=user_input)
+    pnv_analysis = PnvDataAnalysis(user_input=user_input, output_path=output_path, pnv_data=pnv_data)
     pnv_analysis.toolbox_plot()
 
 
@@ -18,11 +23,15 @@ def main(plot_fig: bool):
     Main entry point for PNV project.
     :param plot_fig: Flag indicating whether to validate and visualize aggregated data.
     """
-    preprocessing = ProcessingArea()
+    preprocessing = ProcessingArea(user_input=USER_INPUT, src_crs=SRC_CRS, dst_crs=DST_CRS)
+    preprocessing.run_processing()
     if plot_fig:
-        launch_toolbox(user_input=TOOLBOX_INPUT)
+        pnv_data = preprocessing.result_table(TOOLBOX_INPUT['SELECT_PNV_CLASS'])
+        if pnv_data is None:
+            preprocessing.wait_for_exports()  # the toolbox reads the results from the output directory
+        launch_toolbox(user_input=TOOLBOX_INPUT, pnv_data=pnv_data)
+    preprocessing.wait_for_exports()
 
 
 if __name__ == "__main__":
     main(plot_fig=True)
-
@@ -0,0 +1,249 @@
+import os
+
+import numpy as np
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from PNV.src.datapreprocces import partial_path
+
+OCCUPANCY_VERSION = 1
+
+
+def occupancy_path(source_path: str) -> str:
+    """
+    Path of the occupancy index stored next to a raster.
+    :param source_path: Path of the TIFF or zip file.
+    :return: Path of the occupancy index.
+    """
+    return f"{source_path}.occupancy.npz"
+
+
+class TileOccupancy:
+    def __init__(self, occupied: np.ndarray, shape: tuple, transform, tile_size: int):
+        """
+        Initialization of the class TileOccupancy. Index of the tiles (squares of tile_size pixels) of a raster grid
+        which contain any non-zero class. Empty tiles (ocean and nodata regions) hold class 0 only and are not read.
+        :param occupied: Boolean array (tile rows x tile columns), True for tiles with any non-zero pixel.
+        :param shape: Raster shape (height, width).
+        :param transform: Affine transform of the raster.
+        :param tile_size: Number of rows and columns of a tile.
+        """
+        self.occupied = occupied
+        self.shape = tuple(shape)
+        self.transform = transform
+        self.tile_size = tile_size
+
+    @property
+    def occupied_tiles(self) -> int:
+        return int(np.count_nonzero(self.occupied))
+
+    def matches(self, dataset) -> bool:
+        return self.shape == tuple(dataset.shape) and self.transform.almost_equals(dataset.transform)
+
+    @classmethod
+    def build(cls, dataset, tile_size: int = 256):
+        """
+        Builds the occupancy index of a raster by reading it once, band of tiles by band of tiles.
+        :param dataset: Opened rasterio dataset (band 1 holds the classes).
+        :param tile_size: Number of rows and columns of a tile.
+        :return: TileOccupancy.
+        """
+        if tile_size < 1:
+            raise ValueError("Invalid tile size. Must be at least 1.")
+        height, width = dataset.shape
+        tile_rows, tile_cols = -(-height // tile_size), -(-width // tile_size)
+        occupied = np.zeros((tile_rows, tile_cols), dtype=bool)
+        for tile_row in range(tile_rows):
+            row_start = tile_row * tile_size
+            values = dataset.read(1, window=Window(0, row_start, width, min(tile_size, height - row_start)))
+            columns = np.zeros(tile_cols * tile_size, dtype=bool)
+            columns[:width] = np.any(values != 0, axis=0)
+            occupied[tile_row] = columns.reshape(tile_cols, tile_size).any(axis=1)
+        return cls(occupied, dataset.shape, dataset.transform, tile_size)
+
+    def save(self, file_path: str, source_path: str):
+        """
+        Saves the occupancy index atomically together with the size and modification time of its raster.
+        :param file_path: Path of the occupancy index.
+        :param source_path: Path of the TIFF or zip file indexed.
+        """
+        source = os.stat(source_path)
+        with open(partial_path(file_path), 'wb') as file:
+            np.savez(file, version=OCCUPANCY_VERSION, occupied=self.occupied, shape=np.array(self.shape),
+                     transform=np.array(tuple(self.transform)[:6]), tile_size=self.tile_size,
+                     source_size=source.st_size, source_mtime=source.st_mtime_ns)
+        os.replace(partial_path(file_path), file_path)
+
+    @classmethod
+    def load(cls, file_path: str, source_path: str):
+        """
+        Loads an occupancy index.
+        :param file_path: Path of the occupancy index.
+        :param source_path: Path of the TIFF or zip file indexed.
+        :return: TileOccupancy (None if the index is missing, corrupted or older than its raster).
+        """
+        if not os.path.exists(file_path):
+            return None
+        source = os.stat(source_path)
+        try:
+            with np.load(file_path) as saved:
+                if (int(saved['version']) != OCCUPANCY_VERSION or int(saved['source_size']) != source.st_size or
+                        int(saved['source_mtime']) != source.st_mtime_ns):
+                    return None
+                return cls(saved['occupied'], tuple(int(x) for x in saved['shape']), Affine(*saved['transform']),
+                           int(saved['tile_size']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @classmethod
+    def load_or_build(cls, source_path: str, dataset, tile_size: int = 256, logger=None):
+        """
+        Loads the occupancy index stored next to a raster, or builds and stores it on the first read.
+        :param source_path: Path of the TIFF or zip file.
+        :param dataset: Opened rasterio dataset of the raster.
+        :param tile_size: Number of rows and columns of a tile.
+        :param logger: Logger.
+        :return: TileOccupancy.
+        """
+        file_path = occupancy_path(source_path)
+        occupancy = cls.load(file_path, source_path)
+        if occupancy is not None and occupancy.matches(dataset) and occupancy.tile_size == tile_size:
+            return occupancy
+
+        occupancy = cls.build(dataset, tile_size=tile_size)
+        occupancy.save(file_path, source_path)
+        if logger is not None:
+            logger.info(f"Occupancy index of {source_path}: {occupancy.occupied_tiles} of {occupancy.occupied.size} "
+                        f"tiles occupied")
+        return occupancy
+
+    def occupied_windows(self, window: Window = None) -> list:
+        """
+        Windows covering the occupied tiles within a window. Adjacent occupied tiles of a band of tiles are merged
+        into one window, such that strips of the raster are decoded as few times as possible.
+        :param window: Window of the raster (default: whole raster).
+        :return: List of windows, clipped to the window.
+        """
+        height, width = self.shape
+        if window is None:
+            window = Window(0, 0, width, height)
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        row_end, col_end = row_off + int(window.height), col_off + int(window.width)
+        size = self.tile_size
+
+        windows = []
+        if row_end <= row_off or col_end <= col_off:
+            return windows
+        first_col = col_off // size
+        for tile_row in range(row_off // size, (row_end - 1) // size + 1):
+            row_start, row_stop = max(tile_row * size, row_off), min((tile_row + 1) * size, row_end)
+            occupied = np.concatenate([[False], self.occupied[tile_row, first_col:(col_end - 1) // size + 1], [False]])
+            edges = np.flatnonzero(np.diff(occupied.astype(np.int8)))
+            for run_start, run_stop in zip(edges[::2] + first_col, edges[1::2] + first_col):
+                col_start, col_stop = max(run_start * size, col_off), min(run_stop * size, col_end)
+                windows.append(Window(col_start, row_start, col_stop - col_start, row_stop - row_start))
+        return windows
+
+    def read(self, dataset, window: Window = None) -> np.ndarray:
+        """
+        Reads band 1 of a window of a raster; only occupied tiles are read, empty tiles are filled with 0.
+        :param dataset: Opened rasterio dataset on the grid of the index.
+        :param window: Window of the raster (default: whole raster).
+        :return: Array of the pixel values of the window.
+        """
+        if window is None:
+            window = Window(0, 0, self.shape[1], self.shape[0])
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        values = np.zeros((int(window.height), int(window.width)), dtype=dataset.dtypes[0])
+        for tile_window in self.occupied_windows(window):
+            rows = slice(int(tile_window.row_off) - row_off, int(tile_window.row_off + tile_window.height) - row_off)
+            cols = slice(int(tile_window.col_off) - col_off, int(tile_window.col_off + tile_window.width) - col_off)
+            values[rows, cols] = dataset.read(1, window=tile_window)
+        return values
+
+    def read_decimated(self, dataset, out_shape: tuple, window: Window = None) -> np.ndarray:
+        """
+        Reads band 1 of a window of a raster resampled to a smaller shape (nearest neighbour, the pixel at the centre
+        of each output pixel as read by rasterio); only occupied tiles holding a sampled pixel are read, empty tiles
+        are filled with 0.
+        :param dataset: Opened rasterio dataset on the grid of the index.
+        :param out_shape: Shape (rows, columns) of the returned array.
+        :param window: Window of the raster (default: whole raster).
+        :return: Array of the resampled pixel values of the window.
+        """
+        if window is None:
+            window = Window(0, 0, self.shape[1], self.shape[0])
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        out_rows, out_cols = out_shape
+        rows = row_off + ((2 * np.arange(out_rows) + 1) * int(window.height)) // (2 * out_rows)
+        cols = col_off + ((2 * np.arange(out_cols) + 1) * int(window.width)) // (2 * out_cols)
+        values = np.zeros((out_rows, out_cols), dtype=dataset.dtypes[0])
+        for tile_window in self.occupied_windows(window):
+            row_start, col_start = int(tile_window.row_off), int(tile_window.col_off)
+            sampled_rows = np.flatnonzero((rows >= row_start) & (rows < row_start + int(tile_window.height)))
+            sampled_cols = np.flatnonzero((cols >= col_start) & (cols < col_start + int(tile_window.width)))
+            if len(sampled_rows) == 0 or len(sampled_cols) == 0:
+                continue
+            tile_values = dataset.read(1, window=tile_window)
+            values[np.ix_(sampled_rows, sampled_cols)] = tile_values[np.ix_(rows[sampled_rows] - row_start,
+                                                                            cols[sampled_cols] - col_start)]
+        return values
+
+
+class OccupiedRaster:
+    def __init__(self, dataset, occupancy: TileOccupancy, logger=None):
+        """
+        Initialization of the class OccupiedRaster. Opened rasterio dataset whose single-band reads, at full resolution
+        or decimated (nearest neighbour), skip the empty tiles of its occupancy index. All other attributes are those
+        of the dataset.
+        :param dataset: Opened rasterio dataset.
+        :param occupancy: TileOccupancy of the dataset.
+        :param logger: Logger for reads which cannot skip empty tiles.
+        """
+        self.dataset = dataset
+        self.occupancy = occupancy
+        self.logger = logger
+
+    def __getattr__(self, name):
+        return getattr(self.dataset, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.dataset.close()
+
+    def read(self, indexes=None, window: Window = None, out_shape: tuple = None,
+             resampling: Resampling = Resampling.nearest, **kwargs) -> np.ndarray:
+        if (kwargs or self.dataset.count != 1 or indexes not in [None, 1] or
+                (out_shape is not None and resampling != Resampling.nearest)):
+            if self.logger is not None:
+                self.logger.debug(f"Full read of {self.dataset.name} (arguments not supported by the occupancy index: "
+                                  f"{sorted(kwargs) + (['resampling'] if resampling != Resampling.nearest else [])})")
+            return self.dataset.read(indexes, window=window, out_shape=out_shape, resampling=resampling, **kwargs)
+        if out_shape is None:
+            values = self.occupancy.read(self.dataset, window)
+        else:
+            values = self.occupancy.read_decimated(self.dataset, tuple(out_shape)[-2:], window)
+        return values if indexes == 1 else values[np.newaxis]
+
+    def class_counts(self, num_classes: int) -> tuple:
+        """
+        Counts the pixels of each class from the occupied tiles; the pixels of empty tiles are added to class 0.
+        :param num_classes: Number of classes (including class 0).
+        :return: Tuple of the list of pixel counts of each class and the number of non-zero pixels.
+        """
+        class_counts = np.zeros(num_classes, dtype=np.int64)
+        nonzero_pixels, occupied_pixels = 0, 0
+        for window in self.occupancy.occupied_windows():
+            values = self.dataset.read(1, window=window)
+            class_values = values[(values >= 0) & (values < num_classes)].astype(np.int64)
+            class_counts += np.bincount(class_values, minlength=num_classes)
+            nonzero_pixels += int(np.count_nonzero(values))
+            occupied_pixels += values.size
+        class_counts[0] += self.dataset.width * self.dataset.height - occupied_pixels
+        return [int(count) for count in class_counts], nonzero_pixels
@@ -0,0 +1,82 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+class RasterPrefetcher:
+    def __init__(self, tif_files: list, read_raster, max_prefetched: int):
+        """
+        Initialization of the class RasterPrefetcher. Rasters are read and decoded in a background thread while the
+        previous raster is processed. At most max_prefetched decoded rasters are held in memory in addition to the
+        raster currently processed.
+        :param tif_files: List of TIFF files to read.
+        :param read_raster: Function reading a TIFF file into memory. The returned object must provide close().
+        :param max_prefetched: Number of rasters decoded ahead of the raster currently processed (at least 1).
+        """
+        if max_prefetched < 1:
+            raise ValueError("Invalid number of prefetched rasters. Must be at least 1.")
+        self.tif_files = list(tif_files)
+        self.read_raster = read_raster
+        self._slots = threading.BoundedSemaphore(max_prefetched + 1)
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read_all, name="PNV-RasterPrefetcher", daemon=True)
+
+    def __len__(self):
+        return len(self.tif_files)
+
+    def _read_all(self):
+        """
+        Reads all rasters one after another. Reading blocks while all slots are taken by decoded rasters.
+        """
+        for tif_file in self.tif_files:
+            self._slots.acquire()
+            if self._stop.is_set():
+                break
+            try:
+                raster = self.read_raster(tif_file)
+            except Exception as e:
+                self._queue.put((tif_file, None, e))
+                break
+            self._queue.put((tif_file, raster, None))
+        self._queue.put(_DONE)
+
+    def __iter__(self):
+        """
+        Yields the TIFF file and its decoded raster in the original order. The decoded raster is closed and its slot
+        released as soon as the next raster is requested.
+        """
+        self._thread.start()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _DONE:
+                    return
+                tif_file, raster, error = item
+                if error is not None:
+                    raise error
+                try:
+                    yield tif_file, raster
+                finally:
+                    raster.close()
+                    self._slots.release()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stops the background thread and releases all rasters which were decoded but not processed.
+        """
+        self._stop.set()
+        try:
+            self._slots.release()
+        except ValueError:
+            pass
+        while self._thread.is_alive() or not self._queue.empty():
+            try:
+                item = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is not _DONE and item[1] is not None:
+                item[1].close()
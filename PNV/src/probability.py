@@ -0,0 +1,65 @@
+import os
+import re
+
+# Per-class probability layers of the PNV product are marked by _p_ in the file name (hard classes: _c_), e.g.,
+# biomes_iucn.<class>.rcp26_p_1km_a_20400101_20601231_go_epsg.8857_v20230317.tif
+PROBABILITY_PATTERN = re.compile(r'^(?P<prefix>biomes_[^.]+)\.(?P<layer>.+?)(?P<scenario>\.rcp\d+)?_p_(?P<rest>.+)$')
+
+
+def layer_key(name: str) -> str:
+    """
+    Normalized name of a class or layer for matching layer names in file names with class labels.
+    :param name: Class label or layer name.
+    :return: Lower-case letters and digits of the name.
+    """
+    return re.sub(r'[^0-9a-z]', '', name.lower())
+
+
+def stack_path(file_path: str):
+    """
+    Path of the probability stack of a layer file. All layers of a scenario and period share the stack path, which is
+    the path of the hard class raster with _c_ replaced by _p_, such that the stacks get the sheet names of the hard
+    class rasters.
+    :param file_path: Path of the probability layer (TIFF or zip file).
+    :return: Tuple of the stack path and the layer name (None if the file is not a probability layer).
+    """
+    match = PROBABILITY_PATTERN.match(os.path.basename(file_path))
+    if match is None:
+        return None
+    name = f"{match['prefix']}.hcl{match['scenario'] or ''}_p_{match['rest']}"
+    return os.path.join(os.path.dirname(file_path), name), match['layer']
+
+
+def layer_class(layer: str, labels: list):
+    """
+    Class of a single-band probability layer, given by its class label (case, spaces and punctuation are ignored,
+    e.g., tropical.evergreen.broadleaf.forest) or its class number (e.g., class01).
+    :param layer: Layer name of the file (see stack_path).
+    :param labels: Class labels (including NA for class 0).
+    :return: Class number (None if the layer matches no class).
+    """
+    key = layer_key(layer)
+    for class_index, label in enumerate(labels):
+        if class_index > 0 and key == layer_key(label):
+            return class_index
+    number = re.fullmatch(r'[a-z]*0*(\d+)', key)
+    if number is not None and 0 < int(number[1]) < len(labels):
+        return int(number[1])
+    return None
+
+
+def band_classes(band_count: int, num_classes: int, name: str = "") -> list:
+    """
+    Classes of the bands of a multi-band probability raster. The bands hold the classes in order, with or without a
+    first band for class 0 (NA).
+    :param band_count: Number of bands.
+    :param num_classes: Number of classes (including class 0).
+    :param name: Name of the raster for error messages.
+    :return: List of tuples (band, class) of classes 1, 2, ...
+    """
+    if band_count == num_classes - 1:
+        return [(band, band) for band in range(1, num_classes)]
+    if band_count == num_classes:
+        return [(band, band - 1) for band in range(2, num_classes + 1)]
+    raise ValueError(f"The probability raster {name} has {band_count} bands. Must be {num_classes - 1} or "
+                     f"{num_classes} (including NA).")
@@ -0,0 +1,178 @@
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+from rasterio.windows import Window
+
+from PNV.src.zonal import histogram_to_table
+
+SAMPLE_DESIGNS = ['random', 'lattice']
+
+
+class ZonalSample:
+    def __init__(self, indices: np.ndarray, zones: np.ndarray, weights: np.ndarray, zone_pixels: np.ndarray,
+                 zone_samples: np.ndarray, shape: tuple):
+        """
+        Initialization of the class ZonalSample. Stratified sample of the pixels of a coverage, with the countries
+        (zones) as strata. Class areas are estimated per country from the sampled pixels, with standard errors and
+        confidence intervals of simple random sampling within each country.
+        :param indices: Flat pixel indices of the sampled coverage entries (sorted).
+        :param zones: Zone index of the sampled entries.
+        :param weights: Weights (covered area fractions) of the sampled entries.
+        :param zone_pixels: Number of coverage entries of each zone.
+        :param zone_samples: Number of sampled entries of each zone.
+        :param shape: Raster shape (height, width).
+        """
+        self.indices = indices
+        self.zones = zones
+        self.weights = weights
+        self.zone_pixels = zone_pixels
+        self.zone_samples = zone_samples
+        self.shape = tuple(shape)
+
+    @classmethod
+    def draw(cls, coverage, fraction: float, design: str = 'random', seed: int = 0, min_samples: int = 2):
+        """
+        Draws a sample of the pixels of each country.
+        :param coverage: CountryCoverage assigning pixels to zones.
+        :param fraction: Sampled fraction of the pixels of each country (0 < fraction <= 1).
+        :param design: 'random' for a simple random sample of each country, 'lattice' for the pixels of a regular
+         lattice with a random offset (spacing round(1 / sqrt(fraction)) pixels). Countries with fewer than
+         min_samples lattice pixels are sampled at random.
+        :param seed: Seed of the random number generator.
+        :param min_samples: Minimal number of sampled pixels of a country (all pixels of smaller countries).
+        :return: ZonalSample.
+        """
+        if not 0 < fraction <= 1:
+            raise ValueError("Invalid sample fraction. Must be greater than 0 and at most 1.")
+        if design not in SAMPLE_DESIGNS:
+            raise ValueError(f"Invalid sample design {design}. Must be one of {SAMPLE_DESIGNS}.")
+        rng = np.random.default_rng(seed)
+        indices, zones, weights = coverage.sorted_entries()
+        zone_pixels = np.bincount(zones, minlength=coverage.num_zones)
+        zone_target = np.minimum(zone_pixels, np.maximum(min_samples, np.ceil(fraction * zone_pixels))).astype(
+            np.int64)
+
+        random_zones = np.ones(coverage.num_zones, dtype=bool)
+        if design == 'lattice':
+            spacing = max(1, int(round(1 / np.sqrt(fraction))))
+            row_offset, col_offset = rng.integers(0, spacing, size=2)
+            width = coverage.shape[1]
+            on_lattice = ((indices // width) % spacing == row_offset) & ((indices % width) % spacing == col_offset)
+            random_zones = np.bincount(zones[on_lattice], minlength=coverage.num_zones) < zone_target.clip(
+                max=min_samples)
+
+        # Random design: the entries of a zone with the smallest random keys are sampled
+        keys = rng.random(len(indices))
+        order = np.lexsort((keys, zones))
+        rank = np.empty(len(indices), dtype=np.int64)
+        zone_start = np.concatenate([[0], np.cumsum(zone_pixels)[:-1]])
+        rank[order] = np.arange(len(indices)) - zone_start[zones[order]]
+        selected = random_zones[zones] & (rank < zone_target[zones])
+        if design == 'lattice':
+            selected |= ~random_zones[zones] & on_lattice
+
+        zone_samples = np.bincount(zones[selected], minlength=coverage.num_zones)
+        return cls(indices[selected], zones[selected], weights[selected], zone_pixels, zone_samples, coverage.shape)
+
+    def read(self, dataset) -> np.ndarray:
+        """
+        Reads the values of the sampled pixels. Only the blocks of the raster holding sampled pixels are read.
+        :param dataset: Opened rasterio dataset on the grid of the sample (band 1 holds the classes).
+        :return: Array of the values of the sampled pixels.
+        """
+        if tuple(dataset.shape) != self.shape:
+            raise ValueError(f"Raster {dataset.name} does not match the sample grid {self.shape}.")
+        height, width = self.shape
+        block_rows, block_cols = dataset.block_shapes[0]
+        rows, cols = self.indices // width, self.indices % width
+        blocks = (rows // block_rows) * (-(-width // block_cols)) + cols // block_cols
+        order = np.argsort(blocks, kind='stable')
+        _, starts = np.unique(blocks[order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+
+        values = np.zeros(len(self.indices), dtype=dataset.dtypes[0])
+        for start, stop in zip(starts, stops):
+            entries = order[start:stop]
+            row_off = rows[entries[0]] // block_rows * block_rows
+            col_off = cols[entries[0]] // block_cols * block_cols
+            window = Window(col_off, row_off, min(block_cols, width - col_off), min(block_rows, height - row_off))
+            values[entries] = dataset.read(1, window=window)[rows[entries] - row_off, cols[entries] - col_off]
+        return values
+
+    def estimate(self, values: np.ndarray, num_classes: int, name: str = "") -> tuple:
+        """
+        Estimates the (weighted) pixel counts of each class in each country and their standard errors.
+        :param values: Values of the sampled pixels (see read).
+        :param num_classes: Number of classes (including class 0).
+        :param name: Name of the raster for error messages.
+        :return: Tuple of arrays (countries x classes) of estimated pixel counts and standard errors, and arrays
+         (countries) of the estimated non-zero pixel counts and their standard errors.
+        """
+        values = values.astype(np.int64)
+        if len(values) and (values.min() < 0 or values.max() >= num_classes):
+            raise ValueError(f"The image {name} has more than {num_classes} classes.")
+        num_zones = len(self.zone_pixels)
+        keys = self.zones.astype(np.int64) * num_classes + values
+        weights = self.weights.astype(np.float64)
+        class_sums = np.bincount(keys, weights=weights, minlength=num_zones * num_classes).reshape(num_zones, -1)
+        class_squares = np.bincount(keys, weights=weights ** 2, minlength=num_zones * num_classes).reshape(
+            num_zones, -1)
+        nonzero = values != 0
+        land_sums = np.bincount(self.zones[nonzero], weights=weights[nonzero], minlength=num_zones)
+        land_squares = np.bincount(self.zones[nonzero], weights=weights[nonzero] ** 2, minlength=num_zones)
+
+        totals, errors = self.expand(class_sums, class_squares)
+        land_totals, land_errors = self.expand(land_sums, land_squares)
+        return totals, errors, land_totals, land_errors
+
+    def expand(self, sums: np.ndarray, squares: np.ndarray) -> tuple:
+        """
+        Expands sample sums of each zone to estimated totals with the standard errors of simple random sampling
+        without replacement.
+        :param sums: Sample sums of each zone (zones or zones x classes).
+        :param squares: Sample sums of squares of each zone.
+        :return: Tuple of estimated totals and standard errors.
+        """
+        shape = (-1,) + (1,) * (sums.ndim - 1)
+        population = self.zone_pixels.astype(np.float64).reshape(shape)
+        samples = self.zone_samples.astype(np.float64).reshape(shape)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(samples > 0, sums / samples, 0)
+            variance = np.where(samples > 1, (squares - samples * mean ** 2) / (samples - 1), 0)
+            error = population * np.sqrt(np.clip(variance, 0, None) * (1 - samples / population) /
+                                         np.where(samples > 0, samples, 1))
+        return population * mean, np.where(population > 0, error, 0)
+
+
+def estimate_table(sample: ZonalSample, values: np.ndarray, names: np.ndarray, iso: np.ndarray, labels: list,
+                   pixel_area_km2: float, zones: np.ndarray = None, confidence: float = 0.95,
+                   name: str = "") -> pd.DataFrame:
+    """
+    Converts the estimates of a sample into the per-country table layout of ProcessingArea.get_pixel_values_by_country.
+    For each class and the total area, the standard error and the bounds of the confidence interval (normal
+    approximation, clipped at 0) are appended as columns '<label> SE', '<label> CI low' and '<label> CI high' (km²).
+    :param sample: ZonalSample of the raster grid.
+    :param values: Values of the sampled pixels (see ZonalSample.read).
+    :param names: Country names.
+    :param iso: ISO3 codes of the countries.
+    :param labels: Class labels (including NA for class 0).
+    :param pixel_area_km2: Area of a pixel in km².
+    :param zones: Boolean array selecting the countries listed in the table (default: countries with covered pixels).
+    :param confidence: Confidence level of the intervals.
+    :param name: Name of the raster for error messages.
+    :return: Dataframe with estimated km² for every country.
+    """
+    totals, errors, land_totals, land_errors = sample.estimate(values, num_classes=len(labels), name=name)
+    table = histogram_to_table(totals, names, iso, labels, pixel_area_km2, zones=zones)
+    covered = totals.sum(axis=1) > 0 if zones is None else zones
+
+    quantile = NormalDist().inv_cdf(0.5 + confidence / 2)
+    estimates = [(label, totals[covered, i], errors[covered, i]) for i, label in enumerate(labels) if i > 0]
+    estimates.append(('Total Area (km^2)', land_totals[covered], land_errors[covered]))
+    columns = {}
+    for label, estimate, error in estimates:
+        columns[f"{label} SE"] = error * pixel_area_km2
+        columns[f"{label} CI low"] = np.clip(estimate - quantile * error, 0, None) * pixel_area_km2
+        columns[f"{label} CI high"] = (estimate + quantile * error) * pixel_area_km2
+    return pd.concat([table, pd.DataFrame(columns, index=table.index)], axis=1)
@@ -0,0 +1,357 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from PNV.src.datapreprocces import partial_path, open_warped
+from PNV.src.occupancy import TileOccupancy, occupancy_path
+from PNV.src.zonal import tile_histogram
+
+TASK_STATES = ['pending', 'running', 'done', 'failed']
+
+
+def write_json(file_path: str, content: dict):
+    """
+    Writes a JSON file atomically (temporary file renamed when complete).
+    :param file_path: Path of the JSON file.
+    :param content: Content of the JSON file.
+    """
+    with open(partial_path(file_path), 'w') as file:
+        json.dump(content, file, indent=2)
+    os.replace(partial_path(file_path), file_path)
+
+
+def task_dir(work_dir: str, state: str) -> str:
+    return os.path.join(work_dir, 'tasks', state)
+
+
+def claim_task(work_dir: str, worker_id: str):
+    """
+    Claims a pending task by moving it to the running tasks. Renaming is atomic on a shared filesystem, such that each
+    task is claimed by exactly one worker.
+    :param work_dir: Work directory of the sharded job.
+    :param worker_id: Identifier of the claiming worker.
+    :return: Path of the claimed task file (None if no task is pending).
+    """
+    for task_file in sorted(os.listdir(task_dir(work_dir, 'pending'))):
+        if not task_file.endswith('.json'):
+            continue
+        running_file = os.path.join(task_dir(work_dir, 'running'), f"{task_file[:-5]}@{worker_id}.json")
+        try:
+            os.rename(os.path.join(task_dir(work_dir, 'pending'), task_file), running_file)
+        except FileNotFoundError:
+            continue  # claimed by another worker
+        os.utime(running_file)
+        return running_file
+    return None
+
+
+def process_task(work_dir: str, task: dict):
+    """
+    Computes the partial zone x class histogram and class counts of one tile (range of rows) of a raster. The partial
+    is saved in the partials directory of the work directory. With an occupancy index (see PNV.src.occupancy), empty
+    tiles of the index are not read.
+    :param work_dir: Work directory of the sharded job.
+    :param task: Task definition written by ShardedZonalStatistics.prepare.
+    """
+    num_classes = task['num_classes']
+    with open(os.path.join(work_dir, 'zones', 'zones.json'), 'r') as file:
+        num_zones = json.load(file)['num_zones']
+    entries = slice(task['entry_start'], task['entry_stop'])
+    indices = np.load(os.path.join(work_dir, 'zones', 'indices.npy'), mmap_mode='r')[entries]
+    zones = np.load(os.path.join(work_dir, 'zones', 'zones.npy'), mmap_mode='r')[entries]
+    weights = np.load(os.path.join(work_dir, 'zones', 'weights.npy'), mmap_mode='r')[entries]
+
+    occupancy = None
+    if task.get('occupancy'):
+        occupancy = TileOccupancy.load(occupancy_path(task['occupancy']), task['occupancy'])
+
+    with (open_warped(task['raster'], **task['warp']) if task.get('warp') else rasterio.open(task['raster'])) as src:
+        window = Window(0, task['row_start'], src.width, task['row_stop'] - task['row_start'])
+        if occupancy is not None and occupancy.matches(src):
+            values = occupancy.read(src, window).ravel()
+        else:
+            values = src.read(1, window=window).ravel()
+        pixel_offset = task['row_start'] * src.width
+
+    partial = tile_histogram(values, pixel_offset, indices, zones, weights, num_zones, num_classes, task['raster'])
+
+    partial_file = os.path.join(work_dir, 'partials', f"{task['id']}.npz")
+    with open(partial_path(partial_file), 'wb') as file:
+        np.savez(file, **partial)
+    os.replace(partial_path(partial_file), partial_file)
+
+
+class Heartbeat:
+    def __init__(self, running_file: str, interval: float):
+        """
+        Initialization of the class Heartbeat. While a task is processed, a background thread touches its running file
+        every interval seconds, such that the task is not taken for lost (see requeue_lost_tasks) however long it runs.
+        :param running_file: Path of the running task file.
+        :param interval: Seconds between two touches.
+        """
+        self.running_file = running_file
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, name="PNV-ShardHeartbeat", daemon=True)
+
+    def _beat(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(self.running_file)
+            except FileNotFoundError:
+                return  # requeued in the meantime
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def remove_task_file(file_path: str) -> bool:
+    """
+    Removes a task file which may have been moved or removed by another worker in the meantime.
+    :param file_path: Path of the task file.
+    :return: True if the file was removed, False if it did not exist.
+    """
+    try:
+        os.remove(file_path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def run_worker(work_dir: str, worker_id: str = None, heartbeat_interval: float = 60) -> int:
+    """
+    Processes pending tasks of a sharded job until no task is pending. Several workers (processes or machines sharing
+    the work directory) can run at the same time. A failed task is put back into the pending tasks until its retries
+    are used up, then it is moved to the failed tasks. The running file of a task is touched every heartbeat_interval
+    seconds while it is processed. If a task was requeued nevertheless (e.g., after a pause of the machine) and
+    completes, the requeued copy is dropped.
+    :param work_dir: Work directory of the sharded job.
+    :param worker_id: Identifier of the worker (host name and process id if None).
+    :param heartbeat_interval: Seconds between two touches of the running file (must be well below the task timeout).
+    :return: Number of completed tasks.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    completed = 0
+    while True:
+        running_file = claim_task(work_dir, worker_id)
+        if running_file is None:
+            return completed
+        try:
+            with open(running_file, 'r') as file:
+                task = json.load(file)
+        except FileNotFoundError:
+            continue  # requeued right after the claim
+        try:
+            with Heartbeat(running_file, heartbeat_interval):
+                process_task(work_dir, task)
+        except Exception as e:
+            if not remove_task_file(running_file):
+                continue  # requeued in the meantime, the requeued copy counts the attempt
+            task['attempts'] += 1
+            task['error'] = f"{type(e).__name__}: {e}"
+            state = 'failed' if task['attempts'] > task['max_retries'] else 'pending'
+            write_json(os.path.join(task_dir(work_dir, state), f"{task['id']}.json"), task)
+        else:
+            write_json(os.path.join(task_dir(work_dir, 'done'), f"{task['id']}.json"), task)
+            completed += 1
+            if not remove_task_file(running_file):
+                for state in ['pending', 'failed']:
+                    remove_task_file(os.path.join(task_dir(work_dir, state), f"{task['id']}.json"))
+
+
+class ShardedZonalStatistics:
+    def __init__(self, work_dir: str, tile_rows: int = 1024, max_retries: int = 2, task_timeout: float = 3600,
+                 logger=None):
+        """
+        Initialization of the class ShardedZonalStatistics. The raster grid is cut into tiles (ranges of rows). Each
+        tile of each raster is a task of a file-based queue in the work directory, processed by worker processes on
+        this machine or on other machines sharing the work directory (see run_worker). Every task emits a partial
+        zone x class histogram, which are merged by summation.
+        :param work_dir: Work directory of the sharded job.
+        :param tile_rows: Number of rows of a tile.
+        :param max_retries: Number of retries of a failed tile.
+        :param task_timeout: Seconds without heartbeat (see run_worker) after which a running task of another machine is
+         considered lost and requeued.
+        :param logger: Logger for progress messages.
+        """
+        if tile_rows < 1:
+            raise ValueError("Invalid number of tile rows. Must be at least 1.")
+        self.work_dir = work_dir
+        self.tile_rows = tile_rows
+        self.max_retries = max_retries
+        self.task_timeout = task_timeout
+        self.logger = logger
+        self.rasters = []
+
+    def prepare(self, rasters: list, coverage, num_classes: int, warp: dict = None, occupancy: list = None):
+        """
+        Writes the zone entries of the coverage and one task for each tile of each raster into the work directory.
+        Existing tasks and partials in the work directory are removed.
+        :param rasters: Paths of the rasters (readable by rasterio) on the grid of the coverage.
+        :param coverage: CountryCoverage assigning pixels to zones.
+        :param num_classes: Number of classes (including class 0).
+        :param warp: Arguments src_crs and dst_crs of open_warped if the rasters are reprojected on the fly (None:
+         rasters are read as they are).
+        :param occupancy: Paths of the TIFF or zip files of the rasters, next to which their occupancy indices are
+         stored (see PNV.src.occupancy). Tiles empty in the index are not read; a missing or outdated index is ignored
+         (None: all tiles are read).
+        """
+        if occupancy is not None and len(occupancy) != len(rasters):
+            raise ValueError("Invalid occupancy indices. Must be given for every raster.")
+        for directory in ['tasks', 'partials', 'zones']:
+            shutil.rmtree(os.path.join(self.work_dir, directory), ignore_errors=True)
+        for state in TASK_STATES:
+            os.makedirs(task_dir(self.work_dir, state))
+        os.makedirs(os.path.join(self.work_dir, 'partials'))
+        os.makedirs(os.path.join(self.work_dir, 'zones'))
+
+        indices, zones, weights = coverage.sorted_entries()
+        np.save(os.path.join(self.work_dir, 'zones', 'indices.npy'), indices)
+        np.save(os.path.join(self.work_dir, 'zones', 'zones.npy'), zones)
+        np.save(os.path.join(self.work_dir, 'zones', 'weights.npy'), weights)
+        write_json(os.path.join(self.work_dir, 'zones', 'zones.json'), {'num_zones': coverage.num_zones})
+
+        height, width = coverage.shape
+        row_starts = list(range(0, height, self.tile_rows))
+        row_stops = [min(row_start + self.tile_rows, height) for row_start in row_starts]
+        entry_starts = np.searchsorted(indices, [row_start * width for row_start in row_starts])
+        entry_stops = np.searchsorted(indices, [row_stop * width for row_stop in row_stops])
+
+        self.rasters = list(rasters)
+        for raster_index, raster in enumerate(self.rasters):
+            for tile_index, (row_start, row_stop) in enumerate(zip(row_starts, row_stops)):
+                task = {'id': f"r{raster_index:03d}_t{tile_index:05d}", 'raster': raster, 'raster_index': raster_index,
+                        'row_start': row_start, 'row_stop': row_stop, 'entry_start': int(entry_starts[tile_index]),
+                        'entry_stop': int(entry_stops[tile_index]), 'num_classes': num_classes, 'warp': warp,
+                        'occupancy': occupancy[raster_index] if occupancy is not None else None,
+                        'attempts': 0, 'max_retries': self.max_retries}
+                write_json(os.path.join(task_dir(self.work_dir, 'pending'), f"{task['id']}.json"), task)
+        if self.logger:
+            self.logger.info(f"Sharded job with {len(self.rasters) * len(row_starts)} tiles written to {self.work_dir}")
+
+    def task_files(self, state: str) -> list:
+        return sorted([file for file in os.listdir(task_dir(self.work_dir, state)) if file.endswith('.json')])
+
+    def requeue_lost_tasks(self, local_worker_prefix: str = None):
+        """
+        Puts running tasks back into the pending tasks if their worker is gone: tasks of finished local workers and
+        tasks without heartbeat (see Heartbeat) for longer than the task timeout. A lost task counts as a failed
+        attempt.
+        :param local_worker_prefix: Prefix of the identifiers of local workers which have finished.
+        """
+        for task_file in self.task_files('running'):
+            running_file = os.path.join(task_dir(self.work_dir, 'running'), task_file)
+            worker_id = task_file[:-5].split('@', 1)[1]
+            local_lost = local_worker_prefix is not None and worker_id.startswith(local_worker_prefix)
+            try:
+                timed_out = time.time() - os.path.getmtime(running_file) > self.task_timeout
+                if not (local_lost or timed_out):
+                    continue
+                with open(running_file, 'r') as file:
+                    task = json.load(file)
+            except FileNotFoundError:
+                continue  # finished in the meantime
+            task['attempts'] += 1
+            task['error'] = f"Worker {worker_id} lost"
+            state = 'failed' if task['attempts'] > task['max_retries'] else 'pending'
+            if remove_task_file(running_file):
+                write_json(os.path.join(task_dir(self.work_dir, state), f"{task['id']}.json"), task)
+
+    def run(self, workers: int = 1, poll_interval: float = 1.0):
+        """
+        Processes all tasks with local worker processes and waits for tasks claimed by workers on other machines.
+        :param workers: Number of local worker processes.
+        :param poll_interval: Seconds between checks of tasks running on other machines.
+        """
+        while True:
+            if self.task_files('pending'):
+                local_worker_prefix = f"local-{uuid.uuid4().hex[:8]}-"
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(run_worker, self.work_dir, f"{local_worker_prefix}{worker}")
+                               for worker in range(workers)]
+                    for future in futures:
+                        try:
+                            future.result()
+                        except Exception as e:
+                            if self.logger:
+                                self.logger.error(f"Sharded worker failed: {e}")
+                self.requeue_lost_tasks(local_worker_prefix=local_worker_prefix)
+            elif self.task_files('running'):
+                time.sleep(poll_interval)
+                self.requeue_lost_tasks()
+            else:
+                break
+
+    def reduce(self) -> list:
+        """
+        Merges the partials of all tiles of each raster by summation.
+        :return: List (one entry per raster) of dictionaries with the zone x class histogram, the class counts, the
+         number of pixels and the number of non-zero pixels.
+        """
+        failed_tasks = self.task_files('failed')
+        if failed_tasks:
+            errors = []
+            for task_file in failed_tasks[:5]:
+                with open(os.path.join(task_dir(self.work_dir, 'failed'), task_file), 'r') as file:
+                    task = json.load(file)
+                errors.append(f"{task['id']} ({task['raster']}, rows {task['row_start']}-{task['row_stop']}): "
+                              f"{task['error']}")
+            raise RuntimeError(f"{len(failed_tasks)} tiles failed after all retries (work directory {self.work_dir}): "
+                               f"{'; '.join(errors)}")
+
+        results = [None] * len(self.rasters)
+        for task_file in self.task_files('done'):
+            task_id = task_file[:-5]
+            raster_index = int(task_id.split('_')[0][1:])
+            with np.load(os.path.join(self.work_dir, 'partials', f"{task_id}.npz")) as partial:
+                partial = {key: partial[key] for key in partial.files}
+            if results[raster_index] is None:
+                results[raster_index] = partial
+            else:
+                for key in partial:
+                    results[raster_index][key] = results[raster_index][key] + partial[key]
+        return results
+
+    def clean(self):
+        """
+        Removes the work directory.
+        """
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def main(argv: list = None):
+    """
+    Command-line entry point to join a sharded job as an additional worker (e.g., on another machine sharing the work
+    directory).
+    :param argv: List of command-line arguments (defaults to sys.argv).
+    """
+    parser = argparse.ArgumentParser(description="Process tiles of a sharded PNV job.")
+    parser.add_argument('work_dir', help="Work directory of the sharded job.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes on this machine.")
+    args = parser.parse_args(argv)
+
+    worker_prefix = f"{socket.gethostname()}-{os.getpid()}-"
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        completed = sum(executor.map(run_worker, [args.work_dir] * args.workers,
+                                     [f"{worker_prefix}{worker}" for worker in range(args.workers)]))
+    print(f"Completed {completed} tiles.")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
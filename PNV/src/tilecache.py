@@ -0,0 +1,97 @@
+import hashlib
+import os
+
+import numpy as np
+from rasterio.windows import Window
+
+from PNV.src.datapreprocces import partial_path
+from PNV.src.zonal import tile_histogram
+
+
+class TileHistogramCache:
+    def __init__(self, cache_dir: str, key: str, num_classes: int, tile_rows: int = 256):
+        """
+        Initialization of the class TileHistogramCache. The raster grid is cut into tiles (ranges of rows). For each
+        tile, the partial zone x class histogram and class counts are cached under the checksum of the tile content.
+        Rasters are still read completely, but only tiles whose content is not in the cache are recomputed, e.g., the
+        corrected regions of a re-released raster. Cached tiles are shared by all rasters with the same content.
+        :param cache_dir: Directory of the tile caches.
+        :param key: Key of the zones (coverage) on the raster grid; a cache is only valid for its zones.
+        :param num_classes: Number of classes (including class 0).
+        :param tile_rows: Number of rows of a tile.
+        """
+        if tile_rows < 1:
+            raise ValueError("Invalid number of tile rows. Must be at least 1.")
+        self.num_classes = num_classes
+        self.tile_rows = tile_rows
+        self.directory = os.path.join(cache_dir, f"{key}_{num_classes}_{tile_rows}")
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def tile_checksum(values: np.ndarray) -> str:
+        """
+        Checksum of the content of a tile.
+        :param values: Pixel values of the tile.
+        :return: Hexadecimal BLAKE2b checksum.
+        """
+        checksum = hashlib.blake2b(digest_size=20)
+        checksum.update(f"{values.dtype.str}{values.shape}".encode())
+        checksum.update(np.ascontiguousarray(values).tobytes())
+        return checksum.hexdigest()
+
+    def tile_file(self, row_start: int, checksum: str) -> str:
+        return os.path.join(self.directory, f"{row_start:07d}_{checksum}.npz")
+
+    def load_tile(self, tile_file: str, num_zones: int) -> dict:
+        with np.load(tile_file) as cached:
+            histogram = np.zeros(num_zones * self.num_classes, dtype=np.float64)
+            histogram[cached['index']] = cached['count']
+            return {'histogram': histogram.reshape(num_zones, self.num_classes),
+                    'class_counts': cached['class_counts'], 'total_pixels': int(cached['total_pixels']),
+                    'nonzero_pixels': int(cached['nonzero_pixels'])}
+
+    def save_tile(self, tile_file: str, partial: dict):
+        """
+        Saves the partial of a tile (sparse histogram) atomically.
+        :param tile_file: Path of the cached tile.
+        :param partial: Partial of the tile (see tile_histogram).
+        """
+        histogram = partial['histogram'].ravel()
+        index = np.flatnonzero(histogram)
+        with open(partial_path(tile_file), 'wb') as file:
+            np.savez(file, index=index, count=histogram[index], class_counts=partial['class_counts'],
+                     total_pixels=partial['total_pixels'], nonzero_pixels=partial['nonzero_pixels'])
+        os.replace(partial_path(tile_file), tile_file)
+
+    def histograms(self, dataset, coverage) -> dict:
+        """
+        Computes the zonal histogram and class counts of a raster by merging cached and recomputed tiles.
+        :param dataset: Opened rasterio dataset on the grid of the coverage (band 1 holds the classes).
+        :param coverage: CountryCoverage assigning pixels to zones.
+        :return: Dictionary with the histogram (zones x classes), the class counts, the number of pixels, the number
+         of non-zero pixels and the numbers of recomputed and all tiles.
+        """
+        if not coverage.matches(dataset.shape, dataset.transform):
+            raise ValueError(f"Raster {dataset.name} does not match the coverage grid {coverage.shape}.")
+        height, width = coverage.shape
+        indices, zones, weights = coverage.sorted_entries()
+
+        result = {'histogram': np.zeros((coverage.num_zones, self.num_classes), dtype=np.float64),
+                  'class_counts': np.zeros(self.num_classes, dtype=np.int64), 'total_pixels': 0,
+                  'nonzero_pixels': 0, 'recomputed_tiles': 0, 'tiles': 0}
+        for row_start in range(0, height, self.tile_rows):
+            row_stop = min(row_start + self.tile_rows, height)
+            values = dataset.read(1, window=Window(0, row_start, width, row_stop - row_start)).ravel()
+            tile_file = self.tile_file(row_start, self.tile_checksum(values))
+            if os.path.exists(tile_file):
+                partial = self.load_tile(tile_file, coverage.num_zones)
+            else:
+                start, stop = np.searchsorted(indices, [row_start * width, row_stop * width])
+                partial = tile_histogram(values, row_start * width, indices[start:stop], zones[start:stop],
+                                         weights[start:stop], coverage.num_zones, self.num_classes, dataset.name)
+                self.save_tile(tile_file, partial)
+                result['recomputed_tiles'] += 1
+            result['tiles'] += 1
+            for key in ['histogram', 'class_counts', 'total_pixels', 'nonzero_pixels']:
+                result[key] = result[key] + partial[key]
+        return result
@@ -0,0 +1,546 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+from affine import Affine
+from rasterio.features import rasterize
+from rasterio.transform import array_bounds
+from rasterio.windows import Window, from_bounds
+from shapely.geometry import MultiPolygon
+
+COVERAGE_VERSION = 1
+
+
+def coverage_key(countries, shape: tuple, transform) -> str:
+    """
+    Key identifying a coverage by its raster grid and country layer.
+    :param countries: GeoDataFrame of countries in the coordinate system of the raster (columns 'name', 'iso_a3').
+    :param shape: Raster shape (height, width).
+    :param transform: Affine transform of the raster.
+    :return: Hexadecimal key.
+    """
+    key = hashlib.blake2b(digest_size=20)
+    key.update(repr((COVERAGE_VERSION, tuple(shape), tuple(transform)[:6], str(countries.crs))).encode())
+    for name, iso_code, geometry in zip(countries['name'], countries['iso_a3'], countries['geometry']):
+        key.update(f"{name}|{iso_code}".encode())
+        key.update(shapely.to_wkb(geometry))
+    return key.hexdigest()
+
+
+class CountryCoverage:
+    def __init__(self, names: np.ndarray, iso: np.ndarray, shape: tuple, transform,
+                 interior_indptr: np.ndarray, interior_indices: np.ndarray,
+                 boundary_indptr: np.ndarray, boundary_indices: np.ndarray, boundary_weights: np.ndarray):
+        """
+        Initialization of the class CountryCoverage. Sparse coverage of a raster grid by a country layer in CSR form
+        (one row per country, flat pixel indices as columns). Interior pixels lie entirely within a country and are
+        listed without weights. Boundary pixels are listed with the fraction of their area covered by the country.
+        :param names: Country names.
+        :param iso: ISO3 codes of the countries.
+        :param shape: Raster shape (height, width).
+        :param transform: Affine transform of the raster.
+        :param interior_indptr: Row pointers of the interior pixels.
+        :param interior_indices: Flat indices of the interior pixels.
+        :param boundary_indptr: Row pointers of the boundary pixels.
+        :param boundary_indices: Flat indices of the boundary pixels.
+        :param boundary_weights: Covered area fractions of the boundary pixels.
+        """
+        self.names = names
+        self.iso = iso
+        self.shape = tuple(shape)
+        self.transform = transform
+        self.interior_indptr = interior_indptr
+        self.interior_indices = interior_indices
+        self.boundary_indptr = boundary_indptr
+        self.boundary_indices = boundary_indices
+        self.boundary_weights = boundary_weights
+        self._interior_zones = None
+        self._boundary_zones = None
+
+    @property
+    def num_zones(self) -> int:
+        return len(self.iso)
+
+    @staticmethod
+    def zone_ids(indptr: np.ndarray) -> np.ndarray:
+        """
+        Expands CSR row pointers to the zone (country) index of every entry.
+        :param indptr: Row pointers.
+        :return: Zone index of every entry.
+        """
+        return np.repeat(np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr))
+
+    @property
+    def interior_zones(self) -> np.ndarray:
+        if self._interior_zones is None:
+            self._interior_zones = self.zone_ids(self.interior_indptr)
+        return self._interior_zones
+
+    @property
+    def boundary_zones(self) -> np.ndarray:
+        if self._boundary_zones is None:
+            self._boundary_zones = self.zone_ids(self.boundary_indptr)
+        return self._boundary_zones
+
+    def matches(self, shape: tuple, transform) -> bool:
+        """
+        Checks whether the coverage was computed for the given raster grid.
+        :param shape: Raster shape (height, width).
+        :param transform: Affine transform of the raster.
+        """
+        return self.shape == tuple(shape) and self.transform.almost_equals(transform)
+
+    @classmethod
+    def from_countries(cls, countries, shape: tuple, transform, strip_rows: int = 64):
+        """
+        Computes the coverage of a raster grid by the countries. Pixels touched by a country's boundary get their
+        exact covered area fraction; all other pixels with their center inside the country are interior pixels.
+        :param countries: GeoDataFrame of countries in the coordinate system of the raster (columns 'name', 'iso_a3').
+        :param shape: Raster shape (height, width).
+        :param transform: Affine transform of the raster.
+        :param strip_rows: Number of rows for which the boundary geometry is clipped at once.
+        :return: CountryCoverage.
+        """
+        height, width = shape
+        index_dtype = np.uint32 if height * width < np.iinfo(np.uint32).max else np.int64
+        pixel_area = abs(transform.a * transform.e)
+
+        interior_indices, boundary_indices, boundary_weights = [], [], []
+        interior_indptr, boundary_indptr = [0], [0]
+
+        for geometry in countries['geometry']:
+            interior, boundary, weights = np.empty(0, index_dtype), np.empty(0, index_dtype), np.empty(0, np.float32)
+            window = geometry_window(geometry, shape, transform)
+
+            if window is not None:
+                geometry = shapely.make_valid(geometry)
+                row_off, col_off = int(window.row_off), int(window.col_off)
+                window_shape = (int(window.height), int(window.width))
+                window_transform = transform * Affine.translation(col_off, row_off)
+
+                inside = rasterize([(geometry, 1)], out_shape=window_shape, transform=window_transform,
+                                   fill=0, all_touched=False, dtype='uint8').astype(bool)
+                touched = rasterize([(geometry.boundary, 1)], out_shape=window_shape, transform=window_transform,
+                                    fill=0, all_touched=True, dtype='uint8').astype(bool)
+
+                rows, cols = np.nonzero(inside & ~touched)
+                interior = ((rows + row_off) * width + cols + col_off).astype(index_dtype)
+
+                rows, cols = np.nonzero(touched)
+                fractions = np.empty(len(rows), dtype=np.float64)
+                for start in range(0, window_shape[0], strip_rows):
+                    in_strip = (rows >= start) & (rows < start + strip_rows)
+                    if not in_strip.any():
+                        continue
+                    # Clip the geometry to the strip to keep the intersections with the pixel boxes cheap
+                    strip_bounds = array_bounds(min(strip_rows, window_shape[0] - start), window_shape[1],
+                                                window_transform * Affine.translation(0, start))
+                    strip_geometry = shapely.clip_by_rect(geometry, *strip_bounds)
+                    x0, y0 = window_transform * (cols[in_strip], rows[in_strip])
+                    x1, y1 = window_transform * (cols[in_strip] + 1, rows[in_strip] + 1)
+                    boxes = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+                    fractions[in_strip] = shapely.area(shapely.intersection(boxes, strip_geometry)) / pixel_area
+
+                covered = fractions > 0
+                boundary = ((rows[covered] + row_off) * width + cols[covered] + col_off).astype(index_dtype)
+                weights = np.minimum(fractions[covered], 1).astype(np.float32)
+
+            interior_indices.append(interior)
+            boundary_indices.append(boundary)
+            boundary_weights.append(weights)
+            interior_indptr.append(interior_indptr[-1] + len(interior))
+            boundary_indptr.append(boundary_indptr[-1] + len(boundary))
+
+        return cls(names=np.asarray(countries['name'], dtype=str), iso=np.asarray(countries['iso_a3'], dtype=str),
+                   shape=shape, transform=transform,
+                   interior_indptr=np.asarray(interior_indptr, dtype=np.int64),
+                   interior_indices=np.concatenate(interior_indices),
+                   boundary_indptr=np.asarray(boundary_indptr, dtype=np.int64),
+                   boundary_indices=np.concatenate(boundary_indices),
+                   boundary_weights=np.concatenate(boundary_weights))
+
+    @classmethod
+    def from_country_masks(cls, countries, shape: tuple, transform):
+        """
+        Computes the pixels of each country with their center inside the country, as selected by rasterio.mask.mask.
+        All pixels are listed as interior pixels without weights. Countries may share pixels.
+        :param countries: GeoDataFrame of countries in the coordinate system of the raster (columns 'name', 'iso_a3').
+        :param shape: Raster shape (height, width).
+        :param transform: Affine transform of the raster.
+        :return: CountryCoverage.
+        """
+        height, width = shape
+        index_dtype = np.uint32 if height * width < np.iinfo(np.uint32).max else np.int64
+
+        interior_indices, interior_indptr = [], [0]
+        for geometry in countries['geometry']:
+            interior = np.empty(0, index_dtype)
+            window = geometry_window(geometry, shape, transform)
+
+            if window is not None:
+                row_off, col_off = int(window.row_off), int(window.col_off)
+                window_shape = (int(window.height), int(window.width))
+                inside = rasterize([(geometry, 1)], out_shape=window_shape,
+                                   transform=transform * Affine.translation(col_off, row_off),
+                                   fill=0, all_touched=False, dtype='uint8')
+                rows, cols = np.nonzero(inside)
+                interior = ((rows + row_off) * width + cols + col_off).astype(index_dtype)
+
+            interior_indices.append(interior)
+            interior_indptr.append(interior_indptr[-1] + len(interior))
+
+        return cls(names=np.asarray(countries['name'], dtype=str), iso=np.asarray(countries['iso_a3'], dtype=str),
+                   shape=shape, transform=transform,
+                   interior_indptr=np.asarray(interior_indptr, dtype=np.int64),
+                   interior_indices=np.concatenate(interior_indices),
+                   boundary_indptr=np.zeros(len(interior_indptr), dtype=np.int64),
+                   boundary_indices=np.empty(0, index_dtype), boundary_weights=np.empty(0, np.float32))
+
+    def save(self, file_path: str):
+        """
+        Saves the coverage as npz file. The file is written to a temporary file which is renamed when complete.
+        :param file_path: Path of the npz file.
+        """
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        partial_file_path = f"{file_path}.partial"
+        with open(partial_file_path, 'wb') as file:
+            np.savez(file, names=self.names, iso=self.iso, shape=np.asarray(self.shape),
+                     transform=np.asarray(tuple(self.transform)[:6]),
+                     interior_indptr=self.interior_indptr, interior_indices=self.interior_indices,
+                     boundary_indptr=self.boundary_indptr, boundary_indices=self.boundary_indices,
+                     boundary_weights=self.boundary_weights)
+        os.replace(partial_file_path, file_path)
+
+    @classmethod
+    def load(cls, file_path: str):
+        """
+        Loads a coverage saved with save().
+        :param file_path: Path of the npz file.
+        :return: CountryCoverage.
+        """
+        with np.load(file_path) as data:
+            return cls(names=data['names'], iso=data['iso'], shape=tuple(int(x) for x in data['shape']),
+                       transform=Affine(*data['transform']),
+                       interior_indptr=data['interior_indptr'], interior_indices=data['interior_indices'],
+                       boundary_indptr=data['boundary_indptr'], boundary_indices=data['boundary_indices'],
+                       boundary_weights=data['boundary_weights'])
+
+    @classmethod
+    def load_or_build(cls, countries, shape: tuple, transform, cache_dir: str, logger=None, method: str = 'coverage'):
+        """
+        Loads the coverage of the raster grid and country layer from the cache directory or computes and caches it.
+        :param countries: GeoDataFrame of countries in the coordinate system of the raster (columns 'name', 'iso_a3').
+        :param shape: Raster shape (height, width).
+        :param transform: Affine transform of the raster.
+        :param cache_dir: Directory in which coverages are cached.
+        :param logger: Logger for progress messages.
+        :param method: 'coverage' for fractional coverage weights (see from_countries) or 'mask' for the pixel centers
+         of each country (see from_country_masks).
+        :return: CountryCoverage.
+        """
+        file_path = os.path.join(cache_dir, f"{method}_{coverage_key(countries, shape, transform)}.npz")
+        if os.path.exists(file_path):
+            if logger:
+                logger.info(f"Load country coverage from {file_path}")
+            return cls.load(file_path)
+
+        if logger:
+            logger.info(f"Compute country coverage for grid {shape}, saved to {file_path}")
+        if method == 'mask':
+            coverage = cls.from_country_masks(countries, shape, transform)
+        else:
+            coverage = cls.from_countries(countries, shape, transform)
+        coverage.save(file_path)
+        return coverage
+
+    def bounding_window(self):
+        """
+        Window of the raster grid enclosing all covered pixels, i.e., the union of the bounding windows of the
+        countries.
+        :return: Window (None if no pixel is covered).
+        """
+        indices = np.concatenate([self.interior_indices, self.boundary_indices])
+        if indices.size == 0:
+            return None
+        rows, cols = np.divmod(indices.astype(np.int64), self.shape[1])
+        return Window(int(cols.min()), int(rows.min()), int(cols.max() - cols.min()) + 1,
+                      int(rows.max() - rows.min()) + 1)
+
+    def window_indices(self, indices: np.ndarray, window) -> np.ndarray:
+        """
+        Converts flat pixel indices of the grid into flat indices of an array read with a window.
+        :param indices: Flat pixel indices of the grid (within the window).
+        :param window: Window of the array.
+        :return: Flat indices of the array.
+        """
+        rows, cols = np.divmod(indices.astype(np.int64), self.shape[1])
+        return (rows - int(window.row_off)) * int(window.width) + (cols - int(window.col_off))
+
+    def zonal_histogram(self, img: np.ndarray, num_classes: int, window=None) -> np.ndarray:
+        """
+        Accumulates the covered pixels of each country and class with one weighted sparse accumulation.
+        :param img: Class raster on the grid of the coverage, or the part of it read with window.
+        :param num_classes: Number of classes (including class 0).
+        :param window: Window of img on the grid, enclosing all covered pixels (see bounding_window; None: img is
+         the whole grid).
+        :return: Array (countries x classes) of covered pixels.
+        """
+        if window is None:
+            if tuple(img.shape) != self.shape:
+                raise ValueError(f"Raster shape {img.shape} does not match the coverage grid {self.shape}.")
+            interior_indices, boundary_indices = self.interior_indices, self.boundary_indices
+        else:
+            if tuple(img.shape) != (int(window.height), int(window.width)):
+                raise ValueError(f"Raster shape {img.shape} does not match the window {window}.")
+            interior_indices = self.window_indices(self.interior_indices, window)
+            boundary_indices = self.window_indices(self.boundary_indices, window)
+        values = img.ravel()
+
+        interior_values = values[interior_indices].astype(np.int64)
+        boundary_values = values[boundary_indices].astype(np.int64)
+        for class_values in [interior_values, boundary_values]:
+            if class_values.size and (class_values.min() < 0 or class_values.max() >= num_classes):
+                raise ValueError(f"The image has more than {num_classes} classes.")
+
+        histogram = np.bincount(self.interior_zones * num_classes + interior_values,
+                                minlength=self.num_zones * num_classes).astype(np.float64)
+        histogram += np.bincount(self.boundary_zones * num_classes + boundary_values, weights=self.boundary_weights,
+                                 minlength=self.num_zones * num_classes)
+        return histogram.reshape(self.num_zones, num_classes)
+
+    def sorted_entries(self):
+        """
+        All coverage entries sorted by pixel, such that the entries of a range of rows are a contiguous slice.
+        :return: Flat pixel indices, zone index and weight (1 for interior pixels) of every entry.
+        """
+        indices = np.concatenate([self.interior_indices, self.boundary_indices]).astype(np.int64)
+        order = np.argsort(indices, kind='stable')
+        zones = np.concatenate([self.interior_zones, self.boundary_zones])[order]
+        weights = np.concatenate([np.ones(len(self.interior_indices), dtype=np.float32), self.boundary_weights])[order]
+        return indices[order], zones, weights
+
+    def stacked_histograms(self, datasets: list, num_classes: int, strip_rows: int = 256) -> list:
+        """
+        Accumulates the histograms of several co-registered rasters in a single pass over the grid. The coverage
+        entries are sorted by pixel once, such that the entries of each strip of rows are a contiguous slice. The
+        zone and weight lookups of a strip are shared by all rasters; only the bounding window of the covered pixels
+        is read.
+        :param datasets: Opened rasterio datasets on the grid of the coverage (band 1 holds the classes).
+        :param num_classes: Number of classes (including class 0).
+        :param strip_rows: Number of rows read at once from every raster.
+        :return: List of arrays (countries x classes) of covered pixels, one for each dataset.
+        """
+        for dataset in datasets:
+            if not self.matches(dataset.shape, dataset.transform):
+                raise ValueError(f"Raster {dataset.name} does not match the coverage grid {self.shape}.")
+        width = self.shape[1]
+        histograms = [np.zeros(self.num_zones * num_classes, dtype=np.float64) for _ in datasets]
+        bounds = self.bounding_window()
+        if bounds is None:
+            return [histogram.reshape(self.num_zones, num_classes) for histogram in histograms]
+
+        indices, zones, weights = self.sorted_entries()
+        bins = zones.astype(np.int64) * num_classes
+        del zones
+
+        for row_start in range(bounds.row_off, bounds.row_off + bounds.height, strip_rows):
+            row_stop = min(row_start + strip_rows, bounds.row_off + bounds.height)
+            start, stop = np.searchsorted(indices, [row_start * width, row_stop * width])
+            if start == stop:
+                continue
+            window = Window(bounds.col_off, row_start, bounds.width, row_stop - row_start)
+            pixels = self.window_indices(indices[start:stop], window)
+            for histogram, dataset in zip(histograms, datasets):
+                values = dataset.read(1, window=window).ravel()[pixels].astype(np.int64)
+                if values.min() < 0 or values.max() >= num_classes:
+                    raise ValueError(f"The image {dataset.name} has more than {num_classes} classes.")
+                histogram += np.bincount(bins[start:stop] + values, weights=weights[start:stop],
+                                         minlength=self.num_zones * num_classes)
+        return [histogram.reshape(self.num_zones, num_classes) for histogram in histograms]
+
+    def probability_histograms(self, stacks: list, scale: float = 1.0, strip_rows: int = 256) -> list:
+        """
+        Accumulates the expected covered pixels of each country and class from per-class probability rasters in a
+        single pass over the grid. Every dataset is read strip by strip with all its bands at once, and the
+        probabilities of the covered pixels are summed per country with float accumulators, weighted by the covered
+        area fractions, such that the memory does not grow with the grid. Nodata and NaN count as probability 0.
+        Class 0 holds the covered pixels not expected in any class (at least 0).
+        :param stacks: List of stacks, each a list of tuples (dataset, band) of the probability layers of classes 1,
+         2, ... (opened rasterio datasets on the grid of the coverage).
+        :param scale: Pixel value of probability 1 (e.g., 100 for percent).
+        :param strip_rows: Number of rows read at once from every layer.
+        :return: List of arrays (countries x classes) of expected covered pixels, one for each stack.
+        """
+        for layers in stacks:
+            for dataset, _ in layers:
+                if not self.matches(dataset.shape, dataset.transform):
+                    raise ValueError(f"Raster {dataset.name} does not match the coverage grid {self.shape}.")
+        width = self.shape[1]
+        histograms = [np.zeros((self.num_zones, len(layers) + 1), dtype=np.float64) for layers in stacks]
+        bounds = self.bounding_window()
+        if bounds is None:
+            return histograms
+
+        indices, zones, weights = self.sorted_entries()
+        weights = weights.astype(np.float64)
+        covered = np.bincount(zones, weights=weights, minlength=self.num_zones)
+
+        for row_start in range(bounds.row_off, bounds.row_off + bounds.height, strip_rows):
+            row_stop = min(row_start + strip_rows, bounds.row_off + bounds.height)
+            start, stop = np.searchsorted(indices, [row_start * width, row_stop * width])
+            if start == stop:
+                continue
+            window = Window(bounds.col_off, row_start, bounds.width, row_stop - row_start)
+            pixels = self.window_indices(indices[start:stop], window)
+            strips = {}  # all bands of a dataset are read at once per strip
+            for histogram, layers in zip(histograms, stacks):
+                for class_index, (dataset, band) in enumerate(layers, start=1):
+                    if id(dataset) not in strips:
+                        strips[id(dataset)] = dataset.read(window=window).reshape(dataset.count, -1)[:, pixels]
+                    values = strips[id(dataset)][band - 1]
+                    probabilities = values.astype(np.float64) / scale
+                    nodata = dataset.nodatavals[band - 1]
+                    if nodata is not None:
+                        probabilities[values == nodata] = 0
+                    probabilities[~np.isfinite(probabilities)] = 0
+                    histogram[:, class_index] += np.bincount(zones[start:stop],
+                                                             weights=weights[start:stop] * probabilities,
+                                                             minlength=self.num_zones)
+        for histogram in histograms:
+            histogram[:, 0] = np.clip(covered - histogram[:, 1:].sum(axis=1), 0, None)
+        return histograms
+
+
+def tile_histogram(values: np.ndarray, pixel_offset: int, indices: np.ndarray, zones: np.ndarray,
+                   weights: np.ndarray, num_zones: int, num_classes: int, name: str = "") -> dict:
+    """
+    Computes the partial zone x class histogram and the class counts of one tile (range of rows) of a raster. The
+    partials of all tiles of a raster sum up to its zonal histogram and class counts.
+    :param values: Flattened pixel values of the tile.
+    :param pixel_offset: Flat grid index of the first pixel of the tile.
+    :param indices: Sorted flat pixel indices of the coverage entries within the tile (see sorted_entries).
+    :param zones: Zone index of the entries.
+    :param weights: Weight of the entries.
+    :param num_zones: Number of zones.
+    :param num_classes: Number of classes (including class 0).
+    :param name: Name of the raster for error messages.
+    :return: Dictionary with the histogram (zones x classes), the class counts, the number of pixels and the number
+     of non-zero pixels of the tile.
+    """
+    in_range = (values >= 0) & (values < num_classes)
+    class_counts = np.bincount(values[in_range].astype(np.int64), minlength=num_classes)
+
+    zone_values = values[np.asarray(indices, dtype=np.int64) - pixel_offset].astype(np.int64)
+    if zone_values.size and (zone_values.min() < 0 or zone_values.max() >= num_classes):
+        raise ValueError(f"The image {name} has more than {num_classes} classes.")
+    histogram = np.bincount(np.asarray(zones, dtype=np.int64) * num_classes + zone_values, weights=weights,
+                            minlength=num_zones * num_classes)
+    return {'histogram': histogram.reshape(num_zones, num_classes), 'class_counts': class_counts,
+            'total_pixels': values.size, 'nonzero_pixels': np.count_nonzero(values)}
+
+
+def geometry_window(geometry, shape: tuple, transform):
+    """
+    Window of the raster grid covering the bounds of a geometry.
+    :param geometry: Geometry in the coordinate system of the raster.
+    :param shape: Raster shape (height, width).
+    :param transform: Affine transform of the raster.
+    :return: Window clipped to the raster grid (None if the geometry is empty or outside the grid).
+    """
+    if geometry is None or geometry.is_empty:
+        return None
+    window = from_bounds(*geometry.bounds, transform=transform).round_offsets(op='floor').round_lengths(op='ceil')
+    row_start, col_start = max(int(window.row_off), 0), max(int(window.col_off), 0)
+    row_stop = min(int(window.row_off + window.height) + 1, shape[0])
+    col_stop = min(int(window.col_off + window.width) + 1, shape[1])
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def bounds_area(bounds: np.ndarray) -> np.ndarray:
+    """
+    Area of bounds (minx, miny, maxx, maxy), given as array with the bounds as last axis.
+    """
+    return (bounds[..., 2] - bounds[..., 0]) * (bounds[..., 3] - bounds[..., 1])
+
+
+def merge_groups(groups: list, max_growth: float) -> list:
+    """
+    One pass of compact_parts. The groups are visited from the largest bounds to the smallest, and each group joins
+    the visited group whose merged bounds are the smallest among those growing at most max_growth times the summed
+    bounds of both groups (or is kept as its own group). The merged bounds of all candidates are computed at once.
+    :param groups: List of tuples (bounds array, list of parts).
+    :param max_growth: Maximal growth of the bounds area when two groups are merged.
+    :return: List of merged groups.
+    """
+    groups = sorted(groups, key=lambda group: -bounds_area(group[0]))
+    bounds = np.empty((len(groups), 4))
+    members = []
+    for group_bounds, parts in groups:
+        if members:
+            merged = np.concatenate([np.minimum(bounds[:len(members), :2], group_bounds[:2]),
+                                     np.maximum(bounds[:len(members), 2:], group_bounds[2:])], axis=1)
+            merged_area = bounds_area(merged)
+            allowed = merged_area <= max_growth * (bounds_area(bounds[:len(members)]) + bounds_area(group_bounds))
+            if allowed.any():
+                k = int(np.argmin(np.where(allowed, merged_area, np.inf)))
+                bounds[k] = merged[k]
+                members[k] = members[k] + parts
+                continue
+        bounds[len(members)] = group_bounds
+        members.append(parts)
+    return [(bounds[k], parts) for k, parts in enumerate(members)]
+
+
+def compact_parts(geometry, max_growth: float = 2.0) -> list:
+    """
+    Splits a multi-part geometry (e.g., a country with overseas territories or parts on both sides of the
+    antimeridian) into groups of nearby parts with compact bounds. Groups are merged greedily (see merge_groups) as
+    long as the bounds of the merged group are at most max_growth times the summed bounds of both groups, such that
+    each group is read with a tight window. Passes are repeated until no groups are merged.
+    :param geometry: Polygon or MultiPolygon.
+    :param max_growth: Maximal growth of the bounds area when two groups are merged.
+    :return: List of geometries (the geometry itself if it has a single group).
+    """
+    parts = list(getattr(geometry, 'geoms', [geometry]))
+    if len(parts) < 2:
+        return [geometry]
+
+    groups = [(np.asarray(part.bounds, dtype=np.float64), [part]) for part in parts]
+    while len(groups) > 1:
+        merged = merge_groups(groups, max_growth)
+        if len(merged) == len(groups):
+            break
+        groups = merged
+    if len(groups) == 1:
+        return [geometry]
+    return [group[0] if len(group) == 1 else MultiPolygon(group) for _, group in groups]
+
+
+def histogram_to_table(histogram: np.ndarray, names: np.ndarray, iso: np.ndarray, labels: list,
+                       pixel_area_km2: float, zones: np.ndarray = None):
+    """
+    Converts a zone x class histogram of (weighted) pixel counts into the per-country table layout of
+    ProcessingArea.get_pixel_values_by_country. Class 0 (NA) is not counted as country area. Countries without any
+    covered pixel are omitted unless selected by zones.
+    :param histogram: Array (countries x classes) of (weighted) pixel counts.
+    :param names: Country names.
+    :param iso: ISO3 codes of the countries.
+    :param labels: Class labels (including NA for class 0).
+    :param pixel_area_km2: Area of a pixel in km².
+    :param zones: Boolean array selecting the countries listed in the table (default: countries with covered pixels).
+    :return: Dataframe with km² for every country.
+    """
+    covered = histogram.sum(axis=1) > 0 if zones is None else zones
+    class_areas = histogram[covered] * pixel_area_km2
+    class_areas[:, 0] = 0
+
+    pixel_counts_df = pd.DataFrame(class_areas, columns=labels)
+    pixel_counts_df.insert(0, 'ISO', iso[covered])
+    pixel_counts_df.insert(0, 'country', names[covered])
+    pixel_counts_df['Total Pixels'] = histogram[covered, 1:].sum(axis=1)
+    pixel_counts_df['Total Area (km^2)'] = class_areas.sum(axis=1)
+    return pixel_counts_df
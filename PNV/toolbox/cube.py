@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+
+
+class PnvCube:
+    def __init__(self, values: np.ndarray, iso: list, pnv_classes: list, scenarios: list, years: list,
+                 regions: pd.DataFrame, total_area: np.ndarray):
+        """
+        Initialization of the class PnvCube. Dense labelled array of PNV areas [tsd ha] with the dimensions
+        ISO x pnv_class x scenario x year. Aggregations to continents and FAO regions are done with precomputed
+        membership matrices (regions x ISO).
+        :param values: Array (ISO x pnv_class x scenario x year) of PNV areas [tsd ha] (float32).
+        :param iso: Sorted ISO3 codes.
+        :param pnv_classes: PNV classes.
+        :param scenarios: Sorted scenarios (e.g., ['rcp26', 'rcp45', 'rcp85']).
+        :param years: Sorted years.
+        :param regions: Dataframe indexed by ISO with the columns 'continents' and 'fao_regions'.
+        :param total_area: Total area [tsd ha] of each ISO.
+        """
+        self.values = values
+        self.iso = list(iso)
+        self.pnv_classes = list(pnv_classes)
+        self.scenarios = list(scenarios)
+        self.years = list(years)
+        self.regions = regions
+        self.total_area = total_area
+
+        self.memberships = {"ISO": (self.iso, np.eye(len(self.iso), dtype=np.float32))}
+        for agg_lvl in ["continents", "fao_regions"]:
+            region_of_iso = regions[agg_lvl]
+            labels = sorted(region_of_iso.dropna().unique())
+            membership = np.array([region_of_iso.to_numpy() == label for label in labels], dtype=np.float32)
+            self.memberships[agg_lvl] = (labels, membership.reshape(len(labels), len(self.iso)))
+
+    @classmethod
+    def from_pnv_data(cls, pnv_data_extrapolated: dict, history_data: pd.DataFrame):
+        """
+        Builds the cube from the extrapolated PNV data of each scenario.
+        :param pnv_data_extrapolated: Dictionary of extrapolated pnv_data dataframes for each RCP scenario.
+        :param history_data: Reformated historic PNV data, providing total areas of each ISO.
+        :return: PnvCube.
+        """
+        scenarios = sorted(pnv_data_extrapolated.keys())
+        frames = [pnv_data_extrapolated[scenario] for scenario in scenarios]
+        years = sorted([column for column in frames[0].columns if isinstance(column, (int, np.integer))])
+        iso = sorted(set().union(*[set(frame["ISO"]) for frame in frames]))
+        pnv_classes = list(pd.unique(pd.concat([frame["pnv_class"] for frame in frames])))
+
+        values = np.zeros((len(iso), len(pnv_classes), len(scenarios), len(years)), dtype=np.float32)
+        full_index = pd.MultiIndex.from_product([iso, pnv_classes], names=["ISO", "pnv_class"])
+        for scenario_index, frame in enumerate(frames):
+            summed = frame.groupby(["ISO", "pnv_class"])[years].sum().reindex(full_index, fill_value=0)
+            values[:, :, scenario_index, :] = summed.to_numpy(dtype=np.float64).reshape(
+                len(iso), len(pnv_classes), len(years))
+
+        regions = pd.concat(frames)[["ISO", "continents", "fao_regions"]].drop_duplicates(subset="ISO")
+        regions = regions.set_index("ISO").reindex(iso)
+
+        total_area = history_data[["ISO", "continents", "fao_regions", "total_area_tsd_ha"]].drop_duplicates()
+        total_area = total_area.groupby("ISO")["total_area_tsd_ha"].sum().reindex(iso).to_numpy(dtype=np.float64)
+
+        return cls(values=values, iso=iso, pnv_classes=pnv_classes, scenarios=scenarios, years=years,
+                   regions=regions, total_area=total_area)
+
+    def select(self, year: int, scenarios: list = None, pnv_classes: list = None) -> np.ndarray:
+        """
+        Slices the cube for one year.
+        :param year: Selected year.
+        :param scenarios: Selected scenarios in the order of the returned array (all if None).
+        :param pnv_classes: Selected PNV classes in the order of the returned array (all if None).
+        :return: Array (ISO x pnv_class x scenario) of PNV areas [tsd ha] (float64).
+        """
+        scenario_index = [self.scenarios.index(scenario) for scenario in scenarios or self.scenarios]
+        class_index = [self.pnv_classes.index(pnv_class) for pnv_class in pnv_classes or self.pnv_classes]
+        year_slice = self.values[:, :, :, self.years.index(year)]
+        return year_slice[:, class_index][:, :, scenario_index].astype(np.float64)
+
+    def selected_scenarios(self, scenarios: list) -> list:
+        """
+        Scenarios of the selection which are held by the cube, in the sorted order of the cube.
+        :param scenarios: Selected scenarios.
+        :return: Sorted list of scenarios.
+        """
+        return [scenario for scenario in self.scenarios if scenario in scenarios]
+
+    def aggregate(self, data: np.ndarray, agg_lvl: str):
+        """
+        Aggregates data along the ISO axis (first axis) to the selected aggregation level. ISO without a region are
+        not considered.
+        :param data: Array with ISO as first axis.
+        :param agg_lvl: Aggregation level ('ISO', 'continents' or 'fao_regions').
+        :return: Region labels and aggregated array with regions as first axis.
+        """
+        labels, membership = self.memberships[agg_lvl]
+        aggregated = membership.astype(np.float64) @ data.reshape(len(self.iso), -1)
+        return labels, aggregated.reshape((len(labels),) + data.shape[1:])
+
+    def region_total_area(self, agg_lvl: str):
+        """
+        Total area [tsd ha] of each region of the aggregation level.
+        :param agg_lvl: Aggregation level ('ISO', 'continents' or 'fao_regions').
+        :return: Region labels and their total area.
+        """
+        return self.aggregate(np.nan_to_num(self.total_area), agg_lvl) if agg_lvl != "ISO" else (
+            self.iso, self.total_area)
@@ -5,26 +5,39 @@ import datetime as dt
 import pickle
 import pathlib
 import os.path
+import shutil
+import subprocess
+import tempfile
 
 import geopandas as gpd
+import matplotlib
 import matplotlib.pyplot as plt
 import seaborn as sns
 from matplotlib.lines import Line2D
 import matplotlib.patches as mpatches
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+from PIL import Image
+from tqdm import tqdm
 
 from PNV.paths.paths import OUTPUT_PATH, INPUT_RAW_DATA_PATH
 from PNV.user_input.default_parameters import TOOLBOX_INPUT
 from PNV.src.base_logger import get_logger
 from PNV.src.defines import PotentialNaturalVegetationArea, Coordinates
+from PNV.src.figures import FigureExport
+from PNV.toolbox.cube import PnvCube
 
 
 class PnvDataAnalysis:
-    def __init__(self, user_input: dict):
+    def __init__(self, user_input: dict, input_path: str = INPUT_RAW_DATA_PATH, output_path: str = OUTPUT_PATH,
+                 pnv_data: pd.DataFrame = None):
         """
         Initialization of the class PnvDataAnalysis and read-in of input data.
         :param user_input: Dictionary of input parameters.
+        :param input_path: Directory of the additional geographic data.
+        :param output_path: Directory holding the processed PNV data, in which the figures are saved.
+        :param pnv_data: Result table of ProcessingArea (see ProcessingArea.result_table) handed over in the same
+         process. If None, the latest processed PNV data are read from the output directory.
         """
 
         self.current_dt = dt.datetime.now().strftime("%Y%m%dT%H-%M-%S")
@@ -38,12 +51,18 @@ class PnvDataAnalysis:
         self.rel_val_tolerance = user_input['REL_VAL_TOLERANCE']
 
         self.save_figures = user_input['SAVE_FIGURE']
+        self.figure_export = FigureExport(max_workers=user_input.get('FIGURE_WORKERS', 2), logger=self.logger)
 
-        self.input_folder = INPUT_RAW_DATA_PATH
-        self.output_folder = OUTPUT_PATH
+        self.input_folder = input_path
+        self.output_folder = output_path
         self.output_name = user_input['OUTPUT_NAME']
 
-        self.pnv_raw_data = self.readin_pnv_data()
+        if pnv_data is None:
+            self.pnv_raw_data = self.readin_pnv_data()
+        else:
+            # Copied, since the table may still be exported by ProcessingArea
+            self.logger.info("PNV data handed over in process")
+            self.pnv_raw_data = pnv_data.copy()
         self.geo_data = self.readin_geo_data()
         self.fontsize = self.define_format(paper_format=user_input['PAPER_FORMAT'])
         self.color_palette = self.define_color_palette(selected_pnv_classes=user_input['SELECT_PNV_CLASS'])
@@ -51,6 +70,10 @@ class PnvDataAnalysis:
         self.pnv_data_extrapolated = {}
         self.pnv_forest_data_raw = {}
         self.pnv_forest_data_extrapolated = {}
+        self.forest_classes = []
+        self.pnv_cube = None
+        self.iso_forest_ranking = []
+        self.world_maps = {}
 
     def readin_pnv_data(self) -> pd.DataFrame:
         """
@@ -58,7 +81,7 @@ class PnvDataAnalysis:
         :return: Deserialized pnv_data dataframe.
         """
         filename_path = max([f for f in pathlib.Path(
-            os.path.abspath(OUTPUT_PATH)).glob(f'*_{self.selected_pnv_classes}_class_combined.pkl')],
+            os.path.abspath(self.output_folder)).glob(f'*_{self.selected_pnv_classes}_class_combined.pkl')],
                             key=os.path.getctime)
         self.logger.info(f"Readin PNV data from {filename_path}")
         with open(filename_path, "rb") as pkl_file:
@@ -251,6 +274,7 @@ class PnvDataAnalysis:
             forest_classes = PotentialNaturalVegetationArea.forest_classes_6.value
         if self.selected_pnv_classes == 20:
             forest_classes = PotentialNaturalVegetationArea.forest_classes_20.value
+        self.forest_classes = forest_classes
 
         for key in self.pnv_data_dict.keys():
             tmp_data = self.pnv_data_dict[key].copy()
@@ -274,6 +298,39 @@ class PnvDataAnalysis:
         self.pnv_data_extrapolation()
         self.land_surface_validation(rel_tolerance=self.rel_val_tolerance)
         self.filter_forest_pnv_data()
+        self.build_pnv_cube()
+
+    def build_pnv_cube(self):
+        """
+        Builds the cube (ISO x pnv_class x scenario x year) of the extrapolated PNV data, from which all figures are
+        generated, and ranks the ISO by their historic area of forest-related PNV classes.
+        """
+        self.logger.info(f"Build PNV data cube")
+        self.pnv_cube = PnvCube.from_pnv_data(pnv_data_extrapolated=self.pnv_data_extrapolated,
+                                              history_data=self.pnv_data_dict["history"])
+        forest_classes = [x for x in self.pnv_cube.pnv_classes if x in self.forest_classes]
+        history_forest_area = self.pnv_cube.select(year=self.pnv_cube.years[0], scenarios=self.pnv_cube.scenarios[:1],
+                                                   pnv_classes=forest_classes).sum(axis=(1, 2))
+        self.iso_forest_ranking = list(pd.Series(history_forest_area, index=self.pnv_cube.iso).nlargest(
+            len(history_forest_area)).index)
+
+    @staticmethod
+    def cube_to_frame(agg_lvl: str, labels: list, scenarios: list, values: np.ndarray, columns: list) -> pd.DataFrame:
+        """
+        Converts a slice of the PNV data cube into a dataframe with one row for each region and scenario.
+        :param agg_lvl: Name of the aggregation level column.
+        :param labels: Labels of the regions.
+        :param scenarios: Labels of the scenarios.
+        :param values: Array (regions x scenarios x columns).
+        :param columns: Names of the value columns.
+        :return: Dataframe with the columns agg_lvl, "scenario" and the value columns.
+        """
+        values = values.reshape(len(labels) * len(scenarios), len(columns))
+        frame = pd.DataFrame({agg_lvl: [label for label in labels for _ in scenarios],
+                              "scenario": [scenario for _ in labels for scenario in scenarios]})
+        for column_index, column in enumerate(columns):
+            frame[column] = values[:, column_index]
+        return frame
 
     def build_geolocalized_subfig(self, mapx: float, mapy: float, ax: int, width: float, data: pd.DataFrame, title: str,
                                   y_max: float, fig_option: str, bar_plot_col: int, fontsize: dict):
@@ -338,21 +395,117 @@ class PnvDataAnalysis:
             ax_h.patch.set_alpha(0.75)
             ax_h.set_facecolor('white')
 
-            if data["rescaled_data"][0] > 1.25:
-                x_pos = -0.15
-                y_pos = data["rescaled_data"][0] * 0.8
-            elif data["rescaled_data"][0] < 0.75:
-                x_pos = 0.20
-                y_pos = data["rescaled_data"][0] * 1.3
-            else:
-                x_pos = 0.15
-                y_pos = 1.05
-
+            x_pos, y_pos = self.pie_title_position(radius=data["rescaled_data"][0])
             ax_h.set_title(title, x=x_pos, y=y_pos, pad=-14, fontsize=fontsize['title'],
                            fontweight='bold')
 
         return ax_h
 
+    @staticmethod
+    def pie_title_position(radius: float):
+        """
+        Position of the sub-figure title depending on the radius of the pie chart.
+        :param radius: Radius of the pie chart.
+        :return: Position (x, y) of the title.
+        """
+        if radius > 1.25:
+            return -0.15, radius * 0.8
+        elif radius < 0.75:
+            return 0.20, radius * 1.3
+        else:
+            return 0.15, 1.05
+
+    def update_geolocalized_subfig(self, ax_h, data: pd.DataFrame, fig_option: str, bar_plot_col: int):
+        """
+        Updates the bars or pie wedges of a sub-figure built by build_geolocalized_subfig with new data of the same
+        layout, without rebuilding the sub-figure.
+        :param ax_h: Axes of the sub-figure.
+        :param data: Plotted data in the sub-figure.
+        :param fig_option: Chosen figure option by the user.
+        :param bar_plot_col: Year of the data that is plotted.
+        """
+        if fig_option == 'bar_chart':
+            if len(self.selected_rcp) > 1:
+                bottom = np.zeros(len(data))
+                for container, col in zip(ax_h.containers, data.columns[2:]):
+                    for bar, value, bar_bottom in zip(container.patches, np.array(data[col]), bottom):
+                        bar.set_y(bar_bottom)
+                        bar.set_height(value)
+                    bottom = bottom + np.array(data[col])
+            else:
+                for container, value in zip(ax_h.containers, data[int(bar_plot_col)]):
+                    container.patches[0].set_height(value)
+
+        if fig_option == 'pie_chart':
+            pnv_share = np.array(data["pnv_share"], dtype=float)
+            pnv_share = pnv_share / pnv_share.sum()
+            radius = data["rescaled_data"][0]
+            theta = np.concatenate([[0], np.cumsum(pnv_share)]) * 360
+            for wedge, theta1, theta2 in zip(ax_h.patches, theta[:-1], theta[1:]):
+                wedge.set_theta1(theta1)
+                wedge.set_theta2(theta2)
+                wedge.set_radius(radius)
+            x_pos, y_pos = self.pie_title_position(radius=radius)
+            ax_h.title.set_x(x_pos)
+            ax_h.title.set_y(y_pos)
+
+    def forest_pnv_data(self, year: int, scenarios: list, agg_lvl: str, selected_iso: list, plot_option: str,
+                        aggregate_forest: bool):
+        """
+        Selects forest-related PNV data from the PNV data cube for the given year, scenarios and aggregation level.
+        :param year: Selected year.
+        :param scenarios: Selected RCP scenarios.
+        :param agg_lvl: Aggregation level ('continents', 'fao_regions' or 'country').
+        :param selected_iso: Selection of countries if agg_lvl is 'country' (ISO3-list, ['big_n'] or continent names).
+        :param plot_option: Flag to select absolute forest-related PNV areas [tsd ha] (= "abs") or relative forest
+        covers [%] (= "rel").
+        :param aggregate_forest: Flag to select summed forest-related PNV classes (= True) or separate forest-related
+        PNV classes (= False).
+        :return: Name of the aggregation level column ('ISO' for countries) and dataframe with one row for each region
+         and scenario.
+        """
+        cube = self.pnv_cube
+        scenarios = cube.selected_scenarios(scenarios)
+        pnv_classes = sorted([x for x in cube.pnv_classes if x in self.forest_classes])
+        forest_data = cube.select(year=year, scenarios=scenarios, pnv_classes=pnv_classes)
+
+        if agg_lvl == "country":
+            agg_lvl = "ISO"
+            if all(["big_" in x for x in selected_iso]):
+                n_selected = int(selected_iso[0].split('_')[1])
+                selected_iso = self.iso_forest_ranking[:n_selected]
+
+            if all([x in cube.memberships["continents"][0] for x in selected_iso]):
+                selected_iso = [iso for iso, continent in zip(cube.iso, cube.regions["continents"])
+                                if continent in selected_iso]
+
+            iso_index = [k for k, iso in enumerate(cube.iso) if iso in selected_iso]
+            labels = [cube.iso[k] for k in iso_index]
+            forest_data = forest_data[iso_index]
+            total_area = cube.total_area[iso_index]
+        else:  # if agg_lvl == continents or fao_regions
+            labels, forest_data = cube.aggregate(forest_data, agg_lvl)
+            total_area = cube.region_total_area(agg_lvl)[1]
+
+        if plot_option == "rel":
+            x_var = "forest_cover"
+        else:
+            x_var = year
+
+        if aggregate_forest:
+            fig_columns = [x_var]
+            forest_data = forest_data.sum(axis=1)[:, :, np.newaxis]
+        else:
+            fig_columns = pnv_classes
+            forest_data = forest_data.transpose(0, 2, 1)
+
+        if plot_option == "rel":
+            forest_data = (forest_data / total_area[:, np.newaxis, np.newaxis]) * 100
+
+        fig_data = self.cube_to_frame(agg_lvl=agg_lvl, labels=labels, scenarios=scenarios, values=forest_data,
+                                      columns=fig_columns)
+        return agg_lvl, fig_data
+
     def pnv_bar_plot(self, plot_option: str, aggregate_forest: bool):
         """
         Generates a barplot of selected PNV data with different visualization options.
@@ -360,76 +513,19 @@ class PnvDataAnalysis:
         covers [%] (= "rel").
         :param aggregate_forest: Flag to plot summed forest-related PNV classes (= True) or separate forest-related PNV
         classes (= False).
+        :return: Future of the export returning the path of the PNG file, written in the background (None if figures
+         are not saved; the figure is then kept open).
         """
         self.logger.info(f"Generate barplot of PNV data for {self.selected_rcp} in {self.selected_year}")
         fontsize = self.fontsize
-        total_area = self.pnv_data_dict['history'][["ISO", "continents", "fao_regions", "total_area_tsd_ha"
-                                                    ]].drop_duplicates().reset_index(drop=True)
-        fig_data = pd.DataFrame()
-
-        for key in self.pnv_forest_data_extrapolated.keys():
-            if key in self.selected_rcp:
-                fig_data = pd.concat([fig_data, self.pnv_forest_data_extrapolated[key]], axis=0)
-
-        fig_data = fig_data[["ISO", "scenario", "pnv_class", "continents", "fao_regions", self.selected_year]]
-
-        if self.selected_agg_lvl == "country":
-            self.selected_agg_lvl = "ISO"
-            fig_data = fig_data[[self.selected_agg_lvl, "continents", "scenario", "pnv_class", self.selected_year]]
-            if all(["big_" in x for x in self.selected_iso]):
-                n_selected = int(self.selected_iso[0].split('_')[1])
-                selected_iso = self.pnv_forest_data_raw['history'].groupby(["ISO"])["area_tsd_ha"].sum().reset_index()
-                selected_iso["area_tsd_ha"] = pd.to_numeric(selected_iso["area_tsd_ha"], errors='coerce')
-                selected_iso = list(selected_iso.nlargest(n_selected, "area_tsd_ha")[self.selected_agg_lvl])
-                self.selected_iso = selected_iso
-
-            if all([x in total_area["continents"].unique() for x in self.selected_iso]):
-                selected_iso = list(fig_data[[x in self.selected_iso for x in fig_data["continents"]]]["ISO"].unique())
-                self.selected_iso = selected_iso
-
-            fig_data = fig_data[[x in self.selected_iso for x in fig_data["ISO"]]].reset_index(drop=True)
-            total_area = total_area[[x in self.selected_iso for x in total_area["ISO"]]].reset_index(drop=True)
-        else:  # if selected_agg_lvl == continents or fao_regions
-            fig_data = fig_data[[self.selected_agg_lvl, "scenario", "pnv_class", self.selected_year]]
-            total_area = total_area.groupby([self.selected_agg_lvl])["total_area_tsd_ha"].sum().reset_index()
+        self.selected_agg_lvl, fig_data = self.forest_pnv_data(
+            year=self.selected_year, scenarios=self.selected_rcp, agg_lvl=self.selected_agg_lvl,
+            selected_iso=self.selected_iso, plot_option=plot_option, aggregate_forest=aggregate_forest)
 
         if plot_option == "rel":
-            if aggregate_forest:
-                fig_data = fig_data.groupby([self.selected_agg_lvl, "scenario"])[self.selected_year].sum().reset_index()
-                fig_data = fig_data.merge(total_area, left_on=self.selected_agg_lvl, right_on=self.selected_agg_lvl,
-                                          how="left")
-                fig_data["forest_cover"] = (fig_data[self.selected_year] / fig_data["total_area_tsd_ha"]) * 100
-            else:
-                fig_data = fig_data.groupby([
-                    self.selected_agg_lvl, "scenario", "pnv_class"])[self.selected_year].sum().reset_index()
-                fig_data_new = fig_data[[self.selected_agg_lvl, "scenario"]].copy().drop_duplicates().reset_index(drop=True)
-                for pnv_class in fig_data["pnv_class"].unique():
-                    tmp_data = fig_data[fig_data["pnv_class"] == pnv_class][[self.selected_agg_lvl, self.selected_year
-                                                                             ]].reset_index(drop=True)
-                    tmp_data = tmp_data.merge(total_area, left_on=self.selected_agg_lvl, right_on=self.selected_agg_lvl,
-                                              how="left")
-                    tmp_data["forest_cover"] = (tmp_data[self.selected_year] / tmp_data["total_area_tsd_ha"]) * 100
-                    tmp_data = pd.DataFrame(tmp_data["forest_cover"]).rename(columns={"forest_cover": pnv_class}
-                                                                             ).reset_index(drop=True)
-                    fig_data_new = pd.concat([fig_data_new, tmp_data], axis=1)
-                fig_data = fig_data_new
-
             x_var = "forest_cover"
         else:
             x_var = self.selected_year
-            if aggregate_forest:
-                fig_data = fig_data.groupby([self.selected_agg_lvl, "scenario"])[self.selected_year].sum().reset_index()
-            else:
-                fig_data = fig_data.groupby([self.selected_agg_lvl, "scenario", "pnv_class"
-                                             ])[self.selected_year].sum().reset_index()
-
-                fig_data_new = fig_data[[self.selected_agg_lvl, "scenario"
-                                         ]].copy().drop_duplicates().reset_index(drop=True)
-                for pnv_class in fig_data["pnv_class"].unique():
-                    tmp_data = pd.DataFrame(fig_data[fig_data["pnv_class"] == pnv_class][self.selected_year]
-                                            ).rename(columns={self.selected_year: pnv_class}).reset_index(drop=True)
-                    fig_data_new = pd.concat([fig_data_new, tmp_data], axis=1)
-                fig_data = fig_data_new
 
         Agg_position = []
         agg_lvl_len = len(fig_data[self.selected_agg_lvl].unique())
@@ -490,45 +586,51 @@ class PnvDataAnalysis:
 
         if self.save_figures:
             self.logger.info(f"Save barplot")
-            plt.savefig(f"{self.output_folder}\\{self.current_dt}_bar_plot_{self.output_name}.png",
-                        dpi=300, bbox_inches='tight')
+            return self.figure_export.submit(
+                fig, os.path.join(self.output_folder, f"{self.current_dt}_bar_plot_{self.output_name}.png"),
+                dpi=300, bbox_inches='tight')
 
-    def pnv_world_map(self, fig_option: str, winkel_reproject: bool, dissolve_map_regions: bool):
+    def readin_world_map(self, winkel_reproject: bool) -> gpd.GeoDataFrame:
         """
-        Generates a world map with selected PNV data with different visualisation options.
-        :param fig_option: Flag to select the figure type ("bar_chart" or "pie_chart").
-        :param winkel_reproject: Flag to activate the reprojection to Winkel triple projection
-        :param dissolve_map_regions: Flag to activate the dissolution of country borders.
+        Read-in of the country borders from Natural Earth (without Antarctica). The borders are kept for later maps.
+        :param winkel_reproject: Flag to activate the reprojection to Winkel triple projection.
+        :return: GeoDataFrame of the country borders.
         """
-        self.logger.info(f"Generate world map with PNV data for {self.selected_rcp} in {self.selected_year}")
-        fontsize = self.fontsize
-        total_area = self.pnv_data_dict['history'][[
-            "ISO", "continents", "fao_regions", "total_area_tsd_ha"]].drop_duplicates().reset_index(drop=True)
-        total_area_agg_lvl = total_area.groupby([self.selected_agg_lvl])["total_area_tsd_ha"].sum().reset_index()
-        total_area_agg_lvl = total_area_agg_lvl.rename(columns={"total_area_tsd_ha": "total_area_region_tsd_ha"})
-        fig_data = pd.DataFrame()
-
-        for key in self.pnv_forest_data_extrapolated.keys():
-            if key in self.selected_rcp:
-                fig_data = pd.concat([fig_data, self.pnv_forest_data_extrapolated[key]], axis=0)
+        if winkel_reproject not in self.world_maps:
+            path_to_data = gpd.datasets.get_path('naturalearth_lowres')
+            world = gpd.read_file(path_to_data)
+            world = world[world['name'] != 'Antarctica']
+            if winkel_reproject:
+                world = world.to_crs("+proj=wintri")
+            self.world_maps[winkel_reproject] = world
+        return self.world_maps[winkel_reproject]
 
-        fig_data = fig_data[["ISO", "scenario", "pnv_class", "continents", "fao_regions", self.selected_year]]
+    def world_map_data(self, year: int):
+        """
+        Prepares the background data (forest cover of each ISO for the first selected RCP) and the foreground data
+        (forest-related PNV areas of each region, scenario and class) of the world map from the PNV data cube.
+        :param year: Selected year.
+        :return: Aggregation level of the background and the foreground, background data, foreground data in long
+         format and foreground data with one column for each PNV class.
+        """
+        cube = self.pnv_cube
+        if self.selected_agg_lvl == "country":
+            self.selected_agg_lvl = "ISO"
+        scenarios = cube.selected_scenarios(self.selected_rcp)
+        pnv_classes = sorted([x for x in cube.pnv_classes if x in self.forest_classes])
+        forest_data = cube.select(year=year, scenarios=scenarios, pnv_classes=pnv_classes)
 
         # Map background data (forest cover)
         agg_lvl_back = self.selected_agg_lvl
-        if "ISO" in agg_lvl_back:
-            fig_data_back = fig_data.groupby([agg_lvl_back, "scenario"]
-                                             )[self.selected_year].sum().reset_index()
-        else:
-            fig_data_back = fig_data.groupby(["ISO", agg_lvl_back, "scenario"])[self.selected_year].sum().reset_index()
-        fig_data_back = fig_data_back.merge(total_area[["ISO", "total_area_tsd_ha"]], left_on="ISO",
-                                            right_on="ISO", how="left")
-
-        # weights for each country in each region
-        fig_data_back = fig_data_back.merge(total_area_agg_lvl, left_on=agg_lvl_back,
-                                            right_on=agg_lvl_back, how="left")
-        fig_data_back = fig_data_back[fig_data_back["total_area_tsd_ha"] > 0].reset_index(drop=True)
-        fig_data_back["forest_cover"] = (fig_data_back[self.selected_year] / fig_data_back["total_area_tsd_ha"]) * 100
+        back_index = cube.total_area > 0
+        if "ISO" not in agg_lvl_back:
+            back_index &= cube.regions[agg_lvl_back].notna().to_numpy()
+        forest_area_back = cube.select(year=year, scenarios=self.selected_rcp[:1],
+                                       pnv_classes=pnv_classes).sum(axis=(1, 2))
+        fig_data_back = pd.DataFrame({"ISO": np.array(cube.iso, dtype=object)[back_index]})
+        if "ISO" not in agg_lvl_back:
+            fig_data_back[agg_lvl_back] = cube.regions[agg_lvl_back].to_numpy()[back_index]
+        fig_data_back["forest_cover"] = (forest_area_back[back_index] / cube.total_area[back_index]) * 100
 
         # Map foreground data (forest pnv class shares or forest pnv area)
         if "ISO" in self.selected_agg_lvl:
@@ -536,61 +638,67 @@ class PnvDataAnalysis:
         else:
             agg_lvl_fore = self.selected_agg_lvl
 
-        fig_data_fore = fig_data.groupby([agg_lvl_fore, "scenario", "pnv_class"]
-                                         )[self.selected_year].sum().reset_index()
-        fig_data_fore_summed = fig_data.groupby([agg_lvl_fore, "scenario"])[self.selected_year].sum().reset_index()
-        fig_data_fore_summed = fig_data_fore_summed.rename(columns={self.selected_year: f"{self.selected_year}_sum"})
-        fig_data_fore = fig_data_fore.merge(fig_data_fore_summed, left_on=[agg_lvl_fore, "scenario"],
-                                            right_on=[agg_lvl_fore, "scenario"], how="left")
-        fig_data_fore["pnv_share"] = fig_data_fore[self.selected_year] / fig_data_fore[f"{self.selected_year}_sum"]
+        fore_labels, fore_data = cube.aggregate(forest_data.transpose(0, 2, 1), agg_lvl_fore)
+        fig_data_fore = pd.DataFrame({
+            agg_lvl_fore: [label for label in fore_labels for _ in scenarios for _ in pnv_classes],
+            "scenario": [scenario for _ in fore_labels for scenario in scenarios for _ in pnv_classes],
+            "pnv_class": [pnv_class for _ in fore_labels for _ in scenarios for pnv_class in pnv_classes],
+            year: fore_data.ravel(),
+            f"{year}_sum": np.repeat(fore_data.sum(axis=2).ravel(), len(pnv_classes))})
+        fig_data_fore["pnv_share"] = fig_data_fore[year] / fig_data_fore[f"{year}_sum"]
+
+        # Transformation for barplot
+        fig_data_fore_new = self.cube_to_frame(agg_lvl=agg_lvl_fore, labels=fore_labels, scenarios=scenarios,
+                                               values=fore_data, columns=pnv_classes)
+
+        return agg_lvl_back, agg_lvl_fore, fig_data_back, fig_data_fore, fig_data_fore_new
+
+    def draw_world_map(self, year: int, fig_option: str, winkel_reproject: bool, dissolve_map_regions: bool,
+                       agg_lvl_back: str, agg_lvl_fore: str, fig_data_back: pd.DataFrame, fig_data_fore: pd.DataFrame,
+                       fig_data_fore_new: pd.DataFrame, y_axis_max: float, cover_limits: tuple = (None, None)):
+        """
+        Draws the world map with the forest cover as background and one sub-figure for each region.
+        :param year: Plotted year.
+        :param fig_option: Flag to select the figure type ("bar_chart" or "pie_chart").
+        :param winkel_reproject: Flag to activate the reprojection to Winkel triple projection
+        :param dissolve_map_regions: Flag to activate the dissolution of country borders.
+        :param agg_lvl_back: Aggregation level of the background.
+        :param agg_lvl_fore: Aggregation level of the sub-figures.
+        :param fig_data_back: Background data (forest cover of each ISO).
+        :param fig_data_fore: Foreground data in long format, including the rescaled data for pie charts.
+        :param fig_data_fore_new: Foreground data with one column for each PNV class.
+        :param y_axis_max: Maximal value of the y-axis of the sub-figures.
+        :param cover_limits: Limits (min, max) of the forest cover color scale (data range if None).
+        :return: Figure, map axes, colorbar, background data plotted on the map and sub-figure axes of each region.
+        """
+        fontsize = self.fontsize
 
         # Map background
-        path_to_data = gpd.datasets.get_path('naturalearth_lowres')
-        world = gpd.read_file(path_to_data)
-        world = world[world['name'] != 'Antarctica']
-        if winkel_reproject:
-            world = world.to_crs("+proj=wintri")
+        world = self.readin_world_map(winkel_reproject=winkel_reproject)
         sns.set_theme('paper')
         fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(15, 22))
         cmap = "YlGn"
 
-        fig_data_back = fig_data_back[fig_data_back["scenario"] == self.selected_rcp[0]].reset_index(drop=True)
         fig_data_back = world.merge(fig_data_back, left_on='iso_a3', right_on='ISO', how='left')
         if dissolve_map_regions:
             fig_data_back = fig_data_back[[agg_lvl_back, "geometry", "forest_cover"]]
             fig_data_back = fig_data_back[fig_data_back[agg_lvl_back] != 0].reset_index(drop=True)
             fig_data_back = fig_data_back.dissolve(by=agg_lvl_back, aggfunc="mean")
 
-        fig_data_back.plot(column="forest_cover", ax=ax, cmap=cmap, edgecolor="#04253a")
+        fig_data_back.plot(column="forest_cover", ax=ax, cmap=cmap, edgecolor="#04253a",
+                           vmin=cover_limits[0], vmax=cover_limits[1])
         # colorbar
         divider = make_axes_locatable(ax)  # for legend-colorbar
         cax = divider.append_axes("right", size="5%", pad=0.1)  # for legend-colorbar
         ax.axes.xaxis.set_visible(False)  # Set x-axis-labels invisible
         ax.axes.yaxis.set_visible(False)
-        cb_label = f"forest cover [%] in {self.selected_year} for {self.selected_rcp[0]}"
+        cb_label = f"forest cover [%] in {year} for {self.selected_rcp[0]}"
         cb = fig.colorbar(ax.get_children()[0], cax=cax, orientation='vertical')
         cb.ax.tick_params(axis='both', labelsize=fontsize['ticks'])
         cb.set_label(label=cb_label, size=fontsize['labels'])
         cb.formatter.set_useMathText(True)
         cb.outline.set_edgecolor('black')
 
-        # Rescaling for pie charts
-        interval_min = 0.5
-        interval_max = 1.5
-        forest_area_data = np.array([fig_data_fore[f"{self.selected_year}_sum"]])
-        rescaled_data = ((forest_area_data - np.min(forest_area_data)) /
-                         (np.max(forest_area_data) - np.min(forest_area_data)) *
-                         (interval_max - interval_min) + interval_min)
-        fig_data_fore["rescaled_data"] = pd.DataFrame(rescaled_data.T)
-
-        # Transformation for barplot
-        fig_data_fore_new = fig_data_fore[[agg_lvl_fore, "scenario"]].drop_duplicates().reset_index(drop=True)
-        for pnv_class in fig_data_fore["pnv_class"].unique():
-            tmp_data = pd.DataFrame(
-                fig_data_fore[fig_data_fore["pnv_class"] == pnv_class][
-                    self.selected_year]).rename(columns={self.selected_year: pnv_class}).reset_index(drop=True)
-            fig_data_fore_new = pd.concat([fig_data_fore_new, tmp_data], axis=1)
-
         if agg_lvl_fore == 'fao_regions':
             if winkel_reproject:
                 lon_lat_dict_new = Coordinates.coord_fao_reg_winkel_proj.value
@@ -602,8 +710,7 @@ class PnvDataAnalysis:
             else:
                 lon_lat_dict_new = Coordinates.coord_continents_default_proj.value
 
-        y_axis_max = max(fig_data_fore[self.selected_year])
-
+        sub_figures = {}
         title = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M']
         for agg_region, region_title in zip(fig_data_fore_new[agg_lvl_fore].unique(), title):
             if len(self.selected_rcp) > 1:
@@ -615,9 +722,9 @@ class PnvDataAnalysis:
 
             lat, lon = lon_lat_dict_new[agg_region][0], lon_lat_dict_new[agg_region][1]
 
-            bax = self.build_geolocalized_subfig(mapx=lon, mapy=lat, ax=ax, width=0.85, data=region_data,
-                                                 bar_plot_col=f"{self.selected_year}", title=region_title,
-                                                 y_max=y_axis_max, fig_option=fig_option, fontsize=fontsize)
+            sub_figures[agg_region] = self.build_geolocalized_subfig(
+                mapx=lon, mapy=lat, ax=ax, width=0.85, data=region_data, bar_plot_col=f"{year}", title=region_title,
+                y_max=y_axis_max, fig_option=fig_option, fontsize=fontsize)
         # Set legend
         patches = []
         patch_runner = 0
@@ -634,13 +741,173 @@ class PnvDataAnalysis:
             ax.legend(handles=patches, loc=8, title='PNV classes', title_fontsize=fontsize['title'],
                       fontsize=fontsize['labels'], bbox_to_anchor=(0.5, - 0.3), ncol=3)
         # todo short legend text
-        ax.set_title(f"PNV_world_map_{agg_lvl_fore}_{'_'.join(self.selected_rcp)}_{self.selected_year}")
+        ax.set_title(f"PNV_world_map_{agg_lvl_fore}_{'_'.join(self.selected_rcp)}_{year}")
+
+        return fig, ax, cb, fig_data_back, sub_figures
+
+    @staticmethod
+    def rescale_pie_radius(forest_area_data: np.ndarray, area_min: float, area_max: float) -> np.ndarray:
+        """
+        Rescales forest areas to the radius of the pie charts.
+        :param forest_area_data: Summed forest-related PNV areas of the regions.
+        :param area_min: Forest area mapped to the smallest radius.
+        :param area_max: Forest area mapped to the largest radius.
+        :return: Radius of the pie charts.
+        """
+        interval_min = 0.5
+        interval_max = 1.5
+        return ((forest_area_data - area_min) / (area_max - area_min) * (interval_max - interval_min) + interval_min)
+
+    def check_fig_option(self, fig_option: str):
+        """
+        Checks the figure type of the world map. Pie charts show the class shares of one scenario and are only
+        available for a single selected RCP.
+        :param fig_option: Flag to select the figure type ("bar_chart" or "pie_chart").
+        """
+        if fig_option not in ["bar_chart", "pie_chart"]:
+            raise ValueError(f"Invalid figure option {fig_option}. Must be 'bar_chart' or 'pie_chart'.")
+        if fig_option == "pie_chart" and len(self.selected_rcp) > 1:
+            raise ValueError(f"Pie charts are only available for a single RCP, not for {self.selected_rcp}. Select "
+                             f"one RCP or use 'bar_chart'.")
+
+    def pnv_world_map(self, fig_option: str, winkel_reproject: bool, dissolve_map_regions: bool):
+        """
+        Generates a world map with selected PNV data with different visualisation options.
+        :param fig_option: Flag to select the figure type ("bar_chart" or "pie_chart").
+        :param winkel_reproject: Flag to activate the reprojection to Winkel triple projection
+        :param dissolve_map_regions: Flag to activate the dissolution of country borders.
+        :return: Future of the export returning the path of the PNG file, written in the background (None if figures
+         are not saved; the figure is then kept open).
+        """
+        self.check_fig_option(fig_option)
+        self.logger.info(f"Generate world map with PNV data for {self.selected_rcp} in {self.selected_year}")
+        agg_lvl_back, agg_lvl_fore, fig_data_back, fig_data_fore, fig_data_fore_new = self.world_map_data(
+            year=self.selected_year)
+
+        # Rescaling for pie charts
+        forest_area_data = np.array([fig_data_fore[f"{self.selected_year}_sum"]])
+        rescaled_data = self.rescale_pie_radius(forest_area_data, area_min=np.min(forest_area_data),
+                                                area_max=np.max(forest_area_data))
+        fig_data_fore["rescaled_data"] = pd.DataFrame(rescaled_data.T)
+
+        y_axis_max = max(fig_data_fore[self.selected_year])
+
+        fig = self.draw_world_map(year=self.selected_year, fig_option=fig_option, winkel_reproject=winkel_reproject,
+                                  dissolve_map_regions=dissolve_map_regions, agg_lvl_back=agg_lvl_back,
+                                  agg_lvl_fore=agg_lvl_fore, fig_data_back=fig_data_back, fig_data_fore=fig_data_fore,
+                                  fig_data_fore_new=fig_data_fore_new, y_axis_max=y_axis_max)[0]
         if self.save_figures:
             self.logger.info(f"Save world map")
-            plt.savefig(
-                f"{self.output_folder}\\{self.current_dt}_world_map_{self.output_name}.png",
+            return self.figure_export.submit(
+                fig, os.path.join(self.output_folder, f"{self.current_dt}_world_map_{self.output_name}.png"),
                 dpi=300, bbox_inches='tight')
 
+    def pnv_world_map_series(self, years: list, fig_option: str, winkel_reproject: bool, dissolve_map_regions: bool,
+                             output_format: str = "gif", fps: int = 4, dpi: int = 100) -> str:
+        """
+        Generates an animated world map of selected PNV data over several years. The map, its polygons and the
+        sub-figures are built once and only the polygon colors, bar heights or pie wedges and the labels are updated
+        for each year. Color scale, y-axes and pie radii are fixed across all years to make the years comparable.
+        :param years: Years shown in the animation (e.g., list(range(2013, 2081))).
+        :param fig_option: Flag to select the figure type ("bar_chart" or "pie_chart").
+        :param winkel_reproject: Flag to activate the reprojection to Winkel triple projection
+        :param dissolve_map_regions: Flag to activate the dissolution of country borders.
+        :param output_format: Flag to select the output ("gif", "mp4" or "png" for a sequence of PNG files).
+        :param fps: Frames (years) per second of GIF and MP4 files.
+        :param dpi: Resolution of the frames.
+        :return: Path of the saved file (directory for PNG sequences).
+        """
+        self.check_fig_option(fig_option)
+        if output_format not in ["gif", "mp4", "png"]:
+            raise ValueError(f"Invalid output format {output_format}. Must be 'gif', 'mp4' or 'png'.")
+        ffmpeg_path = matplotlib.rcParams['animation.ffmpeg_path']
+        if output_format == "mp4" and shutil.which(ffmpeg_path) is None:
+            raise RuntimeError(f"ffmpeg ({ffmpeg_path}) is required to write MP4 files.")
+        self.logger.info(f"Generate world map series with PNV data for {self.selected_rcp} in {years[0]}-{years[-1]}")
+
+        map_data = {year: self.world_map_data(year=year) for year in years}
+        agg_lvl_back, agg_lvl_fore = map_data[years[0]][:2]
+
+        forest_cover = np.concatenate([map_data[year][2]["forest_cover"].to_numpy() for year in years])
+        forest_area_data = np.concatenate([map_data[year][3][f"{year}_sum"].to_numpy() for year in years])
+        y_axis_max = max([max(map_data[year][3][year]) for year in years])
+        for year in years:
+            fig_data_fore = map_data[year][3]
+            fig_data_fore["rescaled_data"] = self.rescale_pie_radius(
+                fig_data_fore[f"{year}_sum"].to_numpy(), area_min=np.min(forest_area_data),
+                area_max=np.max(forest_area_data))
+
+        fig, ax, cb, fig_data_back, sub_figures = self.draw_world_map(
+            year=years[0], fig_option=fig_option, winkel_reproject=winkel_reproject,
+            dissolve_map_regions=dissolve_map_regions, agg_lvl_back=agg_lvl_back, agg_lvl_fore=agg_lvl_fore,
+            fig_data_back=map_data[years[0]][2], fig_data_fore=map_data[years[0]][3],
+            fig_data_fore_new=map_data[years[0]][4], y_axis_max=y_axis_max,
+            cover_limits=(np.nanmin(forest_cover), np.nanmax(forest_cover)))
+
+        # Polygons without forest cover are not drawn and multi-polygons are drawn as one patch per part
+        world = pd.DataFrame(self.readin_world_map(winkel_reproject=winkel_reproject)[["iso_a3"]])
+
+        def background_cover(year_data_back: pd.DataFrame) -> np.ndarray:
+            year_cover = world.merge(year_data_back, left_on='iso_a3', right_on='ISO', how='left')
+            if dissolve_map_regions:
+                year_cover = year_cover[year_cover[agg_lvl_back] != 0]
+                return year_cover.groupby(agg_lvl_back)["forest_cover"].mean().reindex(fig_data_back.index).to_numpy()
+            return year_cover["forest_cover"].to_numpy()
+
+        plotted = ~np.isnan(background_cover(map_data[years[0]][2]))
+        geometry_parts = np.array([
+            0 if geometry is None or geometry.is_empty else
+            len(geometry.geoms) if geometry.geom_type.startswith("Multi") else 1
+            for geometry in fig_data_back.geometry[plotted]])
+
+        def update_frame(year: int):
+            _, _, year_data_back, fig_data_fore, fig_data_fore_new = map_data[year]
+            cb.mappable.set_array(np.repeat(background_cover(year_data_back)[plotted], geometry_parts))
+            cb.set_label(label=f"forest cover [%] in {year} for {self.selected_rcp[0]}", size=self.fontsize['labels'])
+            ax.set_title(f"PNV_world_map_{agg_lvl_fore}_{'_'.join(self.selected_rcp)}_{year}")
+            for agg_region, ax_h in sub_figures.items():
+                if len(self.selected_rcp) > 1:
+                    region_data = fig_data_fore_new[
+                        fig_data_fore_new[agg_lvl_fore] == agg_region].reset_index(drop=True)
+                else:
+                    region_data = fig_data_fore[fig_data_fore[agg_lvl_fore] == agg_region].reset_index(drop=True)
+                self.update_geolocalized_subfig(ax_h=ax_h, data=region_data, fig_option=fig_option,
+                                                bar_plot_col=f"{year}")
+
+        # All frames share the bounding box of the first frame
+        frame_bbox = fig.get_tightbbox().padded(0.1)
+        output_path = os.path.join(self.output_folder, f"{self.current_dt}_world_map_series_{self.output_name}")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            frame_dir = output_path if output_format == "png" else tmp_dir
+            os.makedirs(frame_dir, exist_ok=True)
+            frame_files = []
+            for year in tqdm(years, desc="Writing world map frames"):
+                update_frame(year)
+                if output_format == "png":
+                    frame_file = os.path.join(frame_dir, f"{self.current_dt}_world_map_{self.output_name}_{year}.png")
+                else:
+                    frame_file = os.path.join(frame_dir, f"frame_{len(frame_files):04d}.png")
+                fig.savefig(frame_file, dpi=dpi, bbox_inches=frame_bbox)
+                frame_files.append(frame_file)
+            plt.close(fig)
+
+            if output_format == "gif":
+                output_path = f"{output_path}.gif"
+                frames = [Image.open(frame_file) for frame_file in frame_files]
+                frames[0].save(output_path, save_all=True, append_images=frames[1:], duration=int(1000 / fps), loop=0)
+                for frame in frames:
+                    frame.close()
+
+            if output_format == "mp4":
+                output_path = f"{output_path}.mp4"
+                subprocess.run([ffmpeg_path, "-y", "-loglevel", "error", "-framerate", str(fps),
+                                "-i", os.path.join(frame_dir, "frame_%04d.png"),
+                                "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p", output_path],
+                               check=True)
+
+        self.logger.info(f"Saved world map series to {output_path}")
+        return output_path
+
     def toolbox_plot(self):
         """
         Bundles and executes all functions to process and visualize the data based on the user input.
@@ -656,8 +923,16 @@ class PnvDataAnalysis:
                            winkel_reproject=False,
                            dissolve_map_regions=True
                            )
+        self.wait_for_figures()
         self.logger.info(f"PNV data analysis completed")
 
+    def wait_for_figures(self) -> list:
+        """
+        Waits until the figures of pnv_bar_plot and pnv_world_map are written.
+        :return: Paths of the written PNG files.
+        """
+        return self.figure_export.wait()
+
 
 if __name__ == "__main__":
 
@@ -673,5 +948,6 @@ if __name__ == "__main__":
                                winkel_reproject=False,
                                dissolve_map_regions=True
                                )
+    pnv_analysis.wait_for_figures()
     pnv_analysis.logger.info(f"PNV data analysis completed")
 
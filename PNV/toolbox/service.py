@@ -0,0 +1,217 @@
+import argparse
+import functools
+import io
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+from PNV.paths.paths import OUTPUT_PATH, INPUT_RAW_DATA_PATH
+from PNV.user_input.default_parameters import TOOLBOX_INPUT
+from PNV.toolbox.data_analysis import PnvDataAnalysis
+
+AGG_LVL_OPTIONS = ['continents', 'fao_regions', 'country']
+VALUE_OPTIONS = ['abs', 'rel']
+FORMAT_OPTIONS = ['json', 'arrow']
+
+
+class PnvQueryService:
+    def __init__(self, pnv_analysis: PnvDataAnalysis, cache_size: int = 256):
+        """
+        Initialization of the class PnvQueryService. Answers aggregation queries on the forest-related PNV data of a
+        preprocessed PnvDataAnalysis, which is loaded once for the lifetime of the service. Encoded responses of
+        repeated queries are served from a bounded LRU cache.
+        :param pnv_analysis: PnvDataAnalysis after preprocess_pnv_data.
+        :param cache_size: Maximal number of cached responses.
+        """
+        if pnv_analysis.pnv_cube is None:
+            raise ValueError("The PNV data must be preprocessed (preprocess_pnv_data) before queries are answered.")
+        self.pnv_analysis = pnv_analysis
+        self.logger = pnv_analysis.logger
+        self.default_query = {'agg_lvl': pnv_analysis.selected_agg_lvl, 'iso': pnv_analysis.selected_iso,
+                              'rcp': pnv_analysis.selected_rcp, 'year': pnv_analysis.selected_year, 'value': 'abs',
+                              'aggregate_forest': True, 'format': 'json'}
+        self.response = functools.lru_cache(maxsize=cache_size)(self.encode_response)
+
+    def parse_query(self, query: dict) -> tuple:
+        """
+        Validates a query and converts it into a hashable key. Missing entries are taken from the toolbox input.
+        :param query: Dictionary of query parameters (lists are given as lists or comma-separated strings):
+         'agg_lvl' ('continents', 'fao_regions' or 'country'), 'iso' (non-empty ISO3-list, 'big_n' or continent
+         names), 'rcp', 'year', 'value' ('abs' or 'rel'), 'aggregate_forest' (true or false) and 'format' ('json' or
+         'arrow').
+        :return: Tuple (agg_lvl, iso, rcp, year, value, aggregate_forest, format).
+        """
+        unknown_keys = [key for key in query if key not in self.default_query]
+        if unknown_keys:
+            raise ValueError(f"Invalid query parameters {unknown_keys}. Must be one of {list(self.default_query)}.")
+        query = {**self.default_query, **query}
+
+        def as_list(entry) -> tuple:
+            if isinstance(entry, str):
+                entry = entry.split(',')
+            return tuple(str(x).strip() for x in entry if str(x).strip())
+
+        cube = self.pnv_analysis.pnv_cube
+        agg_lvl = str(query['agg_lvl'])
+        if agg_lvl not in AGG_LVL_OPTIONS:
+            raise ValueError(f"Invalid aggregation level {agg_lvl}. Must be one of {AGG_LVL_OPTIONS}.")
+        iso = as_list(query['iso']) if agg_lvl == 'country' else ()
+        if agg_lvl == 'country' and not iso:
+            raise ValueError("Invalid ISO selection. Must not be empty for the aggregation level 'country'.")
+        rcp = tuple(sorted(set(as_list(query['rcp']))))
+        if not rcp or any(scenario not in cube.scenarios for scenario in rcp):
+            raise ValueError(f"Invalid RCP selection {list(rcp)}. Must be a selection of {cube.scenarios}.")
+        try:
+            year = int(query['year'])
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid year {query['year']}.")
+        if year not in cube.years:
+            raise ValueError(f"Invalid year {year}. Must be between {cube.years[0]} and {cube.years[-1]}.")
+        value = str(query['value'])
+        if value not in VALUE_OPTIONS:
+            raise ValueError(f"Invalid value {value}. Must be one of {VALUE_OPTIONS}.")
+        aggregate_forest = query['aggregate_forest']
+        if isinstance(aggregate_forest, str):
+            if aggregate_forest.lower() not in ['true', 'false', '1', '0']:
+                raise ValueError(f"Invalid aggregate_forest {aggregate_forest}. Must be true or false.")
+            aggregate_forest = aggregate_forest.lower() in ['true', '1']
+        output_format = str(query['format'])
+        if output_format not in FORMAT_OPTIONS:
+            raise ValueError(f"Invalid format {output_format}. Must be one of {FORMAT_OPTIONS}.")
+        return agg_lvl, iso, rcp, year, value, bool(aggregate_forest), output_format
+
+    def query_data(self, agg_lvl: str, iso: tuple, rcp: tuple, year: int, value: str,
+                   aggregate_forest: bool) -> pd.DataFrame:
+        """
+        Selects forest-related PNV data (see PnvDataAnalysis.forest_pnv_data).
+        :return: Dataframe with one row for each region and scenario.
+        """
+        _, data = self.pnv_analysis.forest_pnv_data(year=year, scenarios=list(rcp), agg_lvl=agg_lvl,
+                                                    selected_iso=list(iso), plot_option=value,
+                                                    aggregate_forest=aggregate_forest)
+        data.columns = [str(column) for column in data.columns]
+        return data
+
+    def encode_response(self, agg_lvl: str, iso: tuple, rcp: tuple, year: int, value: str, aggregate_forest: bool,
+                        output_format: str) -> tuple:
+        """
+        Answers a parsed query (see parse_query) and encodes the result.
+        :return: Tuple of content type and encoded response.
+        """
+        data = self.query_data(agg_lvl, iso, rcp, year, value, aggregate_forest)
+        if output_format == 'arrow':
+            try:
+                import pyarrow.ipc
+            except ImportError:
+                raise ValueError("pyarrow is required for the format 'arrow'.")
+            sink = io.BytesIO()
+            table = pyarrow.Table.from_pandas(data, preserve_index=False)
+            with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            return 'application/vnd.apache.arrow.stream', sink.getvalue()
+
+        # Relative values of regions without area are not finite, they are encoded as null to keep the JSON valid
+        data = data.replace([np.inf, -np.inf], np.nan)
+        records = data.astype(object).where(data.notna(), None).to_dict(orient='records')
+        response = {'agg_lvl': agg_lvl, 'iso': list(iso), 'rcp': list(rcp), 'year': year, 'value': value,
+                    'unit': '%' if value == 'rel' else 'tsd ha', 'aggregate_forest': aggregate_forest,
+                    'columns': list(data.columns), 'data': records}
+        return 'application/json', json.dumps(response, allow_nan=False).encode('utf-8')
+
+    def query(self, query: dict) -> tuple:
+        """
+        Answers a query from the LRU cache or computes and caches the response.
+        :param query: Dictionary of query parameters (see parse_query).
+        :return: Tuple of content type and encoded response.
+        """
+        return self.response(*self.parse_query(query))
+
+    def cache_info(self) -> dict:
+        return self.response.cache_info()._asdict()
+
+    def make_server(self, host: str = '127.0.0.1', port: int = 8765) -> ThreadingHTTPServer:
+        """
+        Creates an HTTP server answering GET requests on /query (query parameters see parse_query), /health and
+        /cache.
+        :param host: Host address of the server.
+        :param port: Port of the server (0 for any free port).
+        :return: ThreadingHTTPServer, started with serve_forever.
+        """
+        service = self
+
+        class QueryHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                try:
+                    if url.path == '/query':
+                        query = {key: values[-1] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+                        content_type, body = service.query(query)
+                    elif url.path == '/health':
+                        content_type, body = 'application/json', json.dumps({'status': 'ok'}).encode('utf-8')
+                    elif url.path == '/cache':
+                        content_type, body = 'application/json', json.dumps(service.cache_info()).encode('utf-8')
+                    else:
+                        self.send_error_json(404, f"Unknown path {url.path}. Must be /query, /health or /cache.")
+                        return
+                except ValueError as e:
+                    self.send_error_json(400, str(e))
+                    return
+                except Exception as e:
+                    service.logger.error(f"Query {self.path} failed: {e}")
+                    self.send_error_json(500, str(e))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_error_json(self, status: int, message: str):
+                body = json.dumps({'error': message}).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                service.logger.debug(f"{self.address_string()} {format % args}")
+
+        return ThreadingHTTPServer((host, port), QueryHandler)
+
+
+def main(argv: list = None):
+    """
+    Command-line entry point starting the query service for the processed PNV data in the output directory.
+    :param argv: List of command-line arguments (defaults to sys.argv).
+    """
+    parser = argparse.ArgumentParser(description="Serve aggregation queries on processed PNV data.")
+    parser.add_argument('--host', default='127.0.0.1', help="Host address of the server.")
+    parser.add_argument('--port', type=int, default=8765, help="Port of the server.")
+    parser.add_argument('--cache-size', type=int, default=256, help="Maximal number of cached responses.")
+    parser.add_argument('--pnv-class', type=int, default=TOOLBOX_INPUT['SELECT_PNV_CLASS'],
+                        help="Number of biome classes of the processed PNV data (6 or 20).")
+    parser.add_argument('--input-path', default=INPUT_RAW_DATA_PATH, help="Directory of the geographic data.")
+    parser.add_argument('--output-path', default=OUTPUT_PATH, help="Directory holding the processed PNV data.")
+    args = parser.parse_args(argv)
+
+    pnv_analysis = PnvDataAnalysis(user_input={**TOOLBOX_INPUT, 'SELECT_PNV_CLASS': args.pnv_class},
+                                   input_path=args.input_path, output_path=args.output_path)
+    pnv_analysis.preprocess_pnv_data()
+    service = PnvQueryService(pnv_analysis, cache_size=args.cache_size)
+    server = service.make_server(host=args.host, port=args.port)
+    pnv_analysis.logger.info(f"PNV query service listening on http://{args.host}:{server.server_port}/query")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
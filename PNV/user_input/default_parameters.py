@@ -1,8 +1,50 @@
 USER_INPUT = {
     'PROCESS_DATA': False,  # False: no preprocessing and transformation of coordinate system; True: transforming
     # coordinate system to another
-    'CLASS_SELECTION': 20,  # 6 or 20 based on choosing hard classes
-    'ZIPPED_DATA': True
+    'CLASS_SELECTION': 20,  # 6 or 20 based on choosing hard classes; [6, 20] processes both in one run sharing the
+    # countries, zones and (stacked or sharded processing) the pass over the grid
+    'ZIPPED_DATA': True,
+    'PREFETCH_RASTERS': 0,  # Number of rasters read and decoded in the background while the current raster is
+    # processed (0: no read-ahead). Each prefetched raster is held uncompressed in memory in addition to the current one
+    'PYRAMID_LEVELS': [],  # Aggregation factors of coarser class rasters built during preprocessing (e.g., [2, 5, 10]
+    # for 2, 5 and 10 km at 1 km native resolution)
+    'WARP_INDEX': False,  # True: the nearest-neighbour mapping of the raw grid is computed once during preprocessing
+    # (stored in the preprocessed directory) and all further rasters are reprojected by a NumPy gather
+    'RESOLUTION_LEVEL': 1,  # 1: native resolution; otherwise one of PYRAMID_LEVELS for fast preview analyses
+    'ZONAL_METHOD': 'mask',  # 'mask': pixels are assigned to a country if their center lies within it; 'coverage':
+    # border pixels are split between countries by their covered area fraction (weights are cached and reused)
+    'STACKED_RASTERS': False,  # True: all rasters on a common grid are read as one stack and the country areas of all
+    # scenarios are computed in a single pass over the grid
+    'SHARD_WORKERS': 0,  # Number of local worker processes of the tile-sharded processing (0: no sharding). Rasters on
+    # a common grid are split into tiles processed as tasks of a file-based queue (see PNV.src.sharding)
+    'SHARD_TILE_ROWS': 1024,  # Number of raster rows of a tile of the sharded processing
+    'SHARD_DIR': None,  # Work directory of the sharded processing, shared with workers on other machines (None: output
+    # directory)
+    'WARPED_READS': False,  # True: raw rasters are reprojected on the fly when read, without writing preprocessed files
+    # (PROCESS_DATA and ZIPPED_DATA are not considered, only at RESOLUTION_LEVEL 1)
+    'MASK_THREADS': 0,  # Number of threads masking countries in parallel (ZONAL_METHOD 'mask' without stacked, sharded
+    # or tile-cached processing), each with its own dataset handle; 0: one country after another
+    'TILE_CACHE': False,  # True: partial country histograms of raster tiles are cached by tile content, such that only
+    # changed tiles of re-released rasters are recomputed (cache in the preprocessed directory)
+    'COUNTRY_SUBSET': None,  # List of ISO3 codes, country names or continents (e.g., ['DEU', 'Africa']) processed in a
+    # partial rerun, reading only the windows of the selected countries (None: all countries)
+    'SUBSET_MERGE': True,  # True: results of a country subset replace the matching rows of the results in
+    # SUBSET_BASE; False: only the country subset is saved
+    'SUBSET_BASE': None,  # Results file (..._class_combined.pkl) into which a country subset is merged, or a dictionary
+    # mapping each class selection to its results file (None: results of a previous run of the same ProcessingArea)
+    'OCCUPANCY_INDEX': False,  # True: tiles without any non-zero class (ocean, nodata) are indexed on the first read
+    # (index stored next to each raster) and skipped by all reads; their pixels are counted as class 0
+    'SAMPLE_FRACTION': None,  # Fraction of the pixels of each country sampled in the estimate mode (e.g., 0.01): class
+    # areas are estimated with standard errors and 95% confidence intervals, saved as ..._class_estimate_...;
+    # None: exact pixel counts
+    'SAMPLE_DESIGN': 'random',  # 'random': stratified random sample of each country; 'lattice': pixels of a regular
+    # lattice (spacing 1 / sqrt(SAMPLE_FRACTION) pixels), only blocks holding sampled pixels are read
+    'PROBABILITY_RASTERS': False,  # True: expected class areas from the per-class probability rasters (..._p_...,
+    # one multi-band raster or one raster per class for each scenario and period), saved as ..._class_probability_...
+    'PROBABILITY_SCALE': 100,  # Pixel value of probability 1 of the probability rasters (e.g., 100 for percent)
+    'FIGURE_WORKERS': 2  # Number of PNG maps held for rendering and writing by the background export thread while
+    # the processing continues (0: figures are written before the processing continues); each pending map holds its
+    # raster decimated to at most 2000 pixels on the longer side (about 4 MB)
 }
 
 SRC_CRS = 'EPSG:4326'
@@ -24,6 +66,7 @@ Information about TOOLBOX_INPUT:
 'REL_VAL_TOLERANCE': Relative tolerance applied for the validation of aggregated data with land surface data from WDI 
 'PAPER_FORMAT': Controls the fontsize in figures
 'SAVE_FIGURE': Controls if the figures are saved in the output directory
+'FIGURE_WORKERS': Number of saved figures held for rendering by the background export thread (0: written immediately)
 'OUTPUT_NAME': Name of output file
 """
 
@@ -36,5 +79,6 @@ TOOLBOX_INPUT = {
     'REL_VAL_TOLERANCE': 0.3,
     'PAPER_FORMAT': True,
     'SAVE_FIGURE': True,
+    'FIGURE_WORKERS': 2,
     'OUTPUT_NAME': 'test_test_output'
 }
@@ -0,0 +1,5 @@
+import logging
+
+# get_logger only attaches its handlers to a logger without handlers: the tests do not write log files into the
+# output directory of the repository
+logging.getLogger("PNV-Processing").addHandler(logging.NullHandler())
@@ -0,0 +1,52 @@
+import numpy as np
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+import rasterio
+
+TRANSFORM = from_origin(0, 1000, 10, 10)  # 10 m pixels, such that a pixel is 1e-4 km²
+CRS = 'EPSG:8857'
+
+
+def class_values(height: int, width: int, num_classes: int, seed: int = 0) -> np.ndarray:
+    """
+    Random class raster with an empty (class 0) margin of 3 rows and columns, as ocean around the land.
+    :param height: Number of rows.
+    :param width: Number of columns.
+    :param num_classes: Number of classes (including class 0).
+    :param seed: Seed of the random number generator.
+    :return: Array of classes.
+    """
+    values = np.random.default_rng(seed).integers(0, num_classes, size=(height, width)).astype(np.uint8)
+    values[:3], values[:, :3] = 0, 0
+    return values
+
+
+def raster_profile(values: np.ndarray, transform=TRANSFORM, crs: str = CRS, **profile) -> dict:
+    bands = values[np.newaxis] if values.ndim == 2 else values
+    return {'driver': 'GTiff', 'dtype': values.dtype.name, 'count': bands.shape[0], 'height': bands.shape[1],
+            'width': bands.shape[2], 'transform': transform, 'crs': crs, **profile}
+
+
+def write_raster(file_path: str, values: np.ndarray, transform=TRANSFORM, crs: str = CRS, **profile):
+    """
+    Writes a (multi-band) array as GeoTIFF.
+    :param file_path: Path of the GeoTIFF file.
+    :param values: Array (rows x columns or bands x rows x columns).
+    :param transform: Affine transform of the raster.
+    :param crs: Coordinate system of the raster.
+    :param profile: Further creation options (e.g., nodata or tiled).
+    """
+    with rasterio.open(file_path, 'w', **raster_profile(values, transform, crs, **profile)) as dst:
+        dst.write(values[np.newaxis] if values.ndim == 2 else values)
+
+
+def memory_raster(values: np.ndarray, transform=TRANSFORM, crs: str = CRS, **profile) -> MemoryFile:
+    """
+    Writes a (multi-band) array into an in-memory GeoTIFF.
+    :return: MemoryFile, opened with open().
+    """
+    memfile = MemoryFile()
+    with memfile.open(**raster_profile(values, transform, crs, **profile)) as dst:
+        dst.write(values[np.newaxis] if values.ndim == 2 else values)
+    return memfile
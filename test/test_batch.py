@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+from PNV.src.batch import load_job_file, run_batch
+from PNV.src.datamanager import labels_6
+from PNV.user_input.default_parameters import USER_INPUT, TOOLBOX_INPUT, SRC_CRS
+from test.synthetic import write_raster, class_values
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def write_job(self, file_name: str, content: str) -> str:
+        job_file = os.path.join(self.tmp_dir.name, file_name)
+        with open(job_file, 'w') as file:
+            file.write(content)
+        return job_file
+
+    def test_load_job_file(self):
+        """
+        Entries of a job file overwrite single entries of the default parameters.
+        """
+        job_file = self.write_job('my_job.toml', "plot_fig = true\n[user_input]\nCLASS_SELECTION = 6\n"
+                                                 "[toolbox_input]\nSELECT_YEAR = 2070\n")
+        job = load_job_file(job_file)
+        self.assertEqual(job['name'], 'my_job')
+        self.assertTrue(job['plot_fig'])
+        self.assertEqual(job['src_crs'], SRC_CRS)
+        self.assertEqual(job['user_input'], {**USER_INPUT, 'CLASS_SELECTION': 6})
+        self.assertEqual(job['toolbox_input'], {**TOOLBOX_INPUT, 'SELECT_YEAR': 2070})
+
+    def test_load_job_file_rejects_invalid_files(self):
+        """
+        Unknown keys and file types are rejected.
+        """
+        with self.assertRaises(ValueError):
+            load_job_file(self.write_job('job.toml', "CLASS_SELECTION = 6\n"))
+        with self.assertRaises(ValueError):
+            load_job_file(self.write_job('job.json', "{}"))
+
+
+class TestRunBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.preprocessed_path = os.path.join(self.tmp_dir.name, 'preprocessed')
+        self.output_root = os.path.join(self.tmp_dir.name, 'outputs')
+        os.makedirs(self.preprocessed_path)
+        write_raster(os.path.join(self.preprocessed_path, 'biomes_iucn.hcl_c_1km_a_19790101.tif'),
+                     class_values(50, 50, len(labels_6)))
+
+    def write_job(self, name: str, class_selection: int) -> str:
+        job_file = os.path.join(self.tmp_dir.name, f"{name}.toml")
+        with open(job_file, 'w') as file:
+            file.write(f"[user_input]\nCLASS_SELECTION = {class_selection}\nZIPPED_DATA = false\n"
+                       f"FIGURE_WORKERS = 0\n")
+        return job_file
+
+    def run_batch(self, job_files: list) -> dict:
+        return run_batch(job_files, workers=2, input_path=self.tmp_dir.name, preprocessed_path=self.preprocessed_path,
+                         output_root=self.output_root)
+
+    def test_isolated_outputs(self):
+        """
+        Every job writes its results into its own output directory; a failing job does not stop the other jobs.
+        """
+        results = self.run_batch([self.write_job('first', 6), self.write_job('second', 6),
+                                  self.write_job('failing', 7)])
+        self.assertEqual(sorted(results), ['failing', 'first', 'second'])
+        self.assertIsNone(results['failing'])
+        for name in ['first', 'second']:
+            self.assertEqual(results[name], os.path.join(self.output_root, name))
+            result_files = [file for file in os.listdir(results[name]) if file.endswith('_6_class_combined.pkl')]
+            self.assertEqual(len(result_files), 1)
+            self.assertIn('Total Pixels', pd.read_pickle(os.path.join(results[name], result_files[0])))
+
+    def test_duplicate_names(self):
+        """
+        Jobs with the same name are rejected before any job is run.
+        """
+        os.makedirs(os.path.join(self.tmp_dir.name, 'other'))
+        job_files = [self.write_job('job', 6), os.path.join(self.tmp_dir.name, 'other', 'job.toml')]
+        with open(job_files[1], 'w') as file:
+            file.write("[user_input]\nCLASS_SELECTION = 20\n")
+        with self.assertRaises(ValueError):
+            self.run_batch(job_files)
+        self.assertFalse(os.path.exists(self.output_root))
+
+
+if __name__ == '__main__':
+    unittest.main()
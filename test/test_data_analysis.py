@@ -0,0 +1,85 @@
+import logging
+import os
+import tempfile
+import unittest
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from PNV.src.figures import FigureExport
+from PNV.toolbox.cube import PnvCube
+from PNV.toolbox.data_analysis import PnvDataAnalysis
+
+ISO = ['CHN', 'DEU', 'FRA', 'IND']
+YEARS = [2020, 2050, 2080]
+
+
+def synthetic_analysis(output_path: str, selected_rcp: list) -> PnvDataAnalysis:
+    """
+    Preprocessed PnvDataAnalysis holding a small cube of four countries on two continents.
+    """
+    values = np.random.default_rng(0).uniform(100, 1000, size=(len(ISO), 2, 2, len(YEARS))).astype(np.float32)
+    regions = pd.DataFrame({'continents': ['Asia', 'Europe', 'Europe', 'Asia'],
+                            'fao_regions': ['East Asia', 'Europe', 'Europe', 'South and Southeast Asia']}, index=ISO)
+    analysis = PnvDataAnalysis.__new__(PnvDataAnalysis)
+    analysis.logger = logging.getLogger("PNV-Processing")
+    analysis.pnv_cube = PnvCube(values=values, iso=ISO, pnv_classes=['Forest', 'Woodland'],
+                                scenarios=['rcp26', 'rcp45'], years=YEARS, regions=regions,
+                                total_area=np.full(len(ISO), 5000.0))
+    analysis.forest_classes = ['Forest', 'Woodland']
+    analysis.selected_agg_lvl = 'country'
+    analysis.selected_rcp = selected_rcp
+    analysis.selected_year = 2050
+    analysis.selected_pnv_classes = 6
+    analysis.fontsize = analysis.define_format(paper_format=True)
+    analysis.color_palette = analysis.define_color_palette(selected_pnv_classes=6)
+    analysis.world_maps = {}
+    analysis.save_figures = False
+    analysis.figure_export = FigureExport(max_workers=0, logger=analysis.logger)
+    analysis.output_folder = output_path
+    analysis.output_name = 'test'
+    analysis.current_dt = '20260101T00-00-00'
+    return analysis
+
+
+class TestWorldMapSeries(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.output_path = tmp_dir.name
+
+    def test_png_series(self):
+        """
+        A PNG frame is written for every year, with bar charts for several RCPs and pie charts for a single RCP.
+        """
+        for fig_option, selected_rcp in [('bar_chart', ['rcp26', 'rcp45']), ('bar_chart', ['rcp45']),
+                                         ('pie_chart', ['rcp26'])]:
+            with self.subTest(fig_option=fig_option, selected_rcp=selected_rcp):
+                analysis = synthetic_analysis(self.output_path, selected_rcp)
+                frame_dir = analysis.pnv_world_map_series(years=YEARS, fig_option=fig_option, winkel_reproject=False,
+                                                          dissolve_map_regions=True, output_format='png', dpi=20)
+                frame_files = sorted(os.listdir(frame_dir))
+                self.assertEqual(frame_files, [f"20260101T00-00-00_world_map_test_{year}.png" for year in YEARS])
+                self.assertEqual(plt.get_fignums(), [])
+                for frame_file in frame_files:
+                    os.remove(os.path.join(frame_dir, frame_file))
+
+    def test_pie_chart_for_several_rcp(self):
+        """
+        Pie charts for several RCPs and unknown figure options are rejected before any figure is drawn.
+        """
+        analysis = synthetic_analysis(self.output_path, ['rcp26', 'rcp45'])
+        for fig_option in ['pie_chart', 'map']:
+            with self.subTest(fig_option=fig_option):
+                with self.assertRaises(ValueError):
+                    analysis.pnv_world_map_series(years=YEARS, fig_option=fig_option, winkel_reproject=False,
+                                                  dissolve_map_regions=True, output_format='png')
+                with self.assertRaises(ValueError):
+                    analysis.pnv_world_map(fig_option=fig_option, winkel_reproject=False, dissolve_map_regions=True)
+        self.assertEqual(plt.get_fignums(), [])
+        self.assertEqual(os.listdir(self.output_path), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from PNV.src import datapreprocces
+from PNV.src.datapreprocces import (process_all_files, load_manifest, MANIFEST_NAME, write_class_metadata,
+                                    read_class_metadata, CLASS_METADATA_TAG, mode_aggregate, partial_path,
+                                    epsg_reproject, open_warped, load_warp_index, gather_reproject)
+from test.synthetic import write_raster, class_values, raster_profile, TRANSFORM
+
+
+class TestPreprocessingManifest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.input_dir = os.path.join(tmp_dir.name, 'raw')
+        self.output_dir = os.path.join(tmp_dir.name, 'preprocessed')
+        os.makedirs(self.input_dir)
+        for name, seed in [('a_4326.tif', 0), ('b_4326.tif', 1)]:
+            write_raster(os.path.join(self.input_dir, name), class_values(20, 40, 7, seed=seed),
+                         transform=from_origin(-20, 10, 1, 1), crs='EPSG:4326')
+
+    def process(self) -> list:
+        """
+        Runs the preprocessing and returns the names of the reprojected files.
+        """
+        with mock.patch.object(datapreprocces, 'epsg_reproject', wraps=datapreprocces.epsg_reproject) as reproject:
+            process_all_files(self.input_dir, self.output_dir, 'EPSG:4326', 'EPSG:8857')
+        return sorted(os.path.basename(call.args[1]) for call in reproject.call_args_list)
+
+    def test_resume(self):
+        """
+        Complete outputs are skipped; outputs which are missing, incomplete or stale are processed again.
+        """
+        self.assertEqual(self.process(), ['a_8857.tif', 'b_8857.tif'])
+        manifest = load_manifest(self.output_dir)
+        self.assertEqual(sorted(manifest['outputs']), ['a_8857.tif', 'b_8857.tif'])
+        self.assertEqual(self.process(), [])
+
+        # Interrupted zipping: the zip file does not match the manifest
+        with open(os.path.join(self.output_dir, 'a_8857.zip'), 'ab') as file:
+            file.write(b'truncated')
+        self.assertEqual(self.process(), ['a_8857.tif'])
+
+        # Changed source content
+        write_raster(os.path.join(self.input_dir, 'b_4326.tif'), class_values(20, 40, 7, seed=2),
+                     transform=from_origin(-20, 10, 1, 1), crs='EPSG:4326')
+        self.assertEqual(self.process(), ['b_8857.tif'])
+        self.assertEqual(self.process(), [])
+        self.assertFalse([name for name in os.listdir(self.output_dir) if name.endswith('.partial')])
+
+    def test_corrupted_manifest(self):
+        """
+        A corrupted manifest leads to processing all files again.
+        """
+        self.process()
+        with open(os.path.join(self.output_dir, MANIFEST_NAME), 'w') as file:
+            file.write('{"version": 1, "outp')
+        self.assertEqual(self.process(), ['a_8857.tif', 'b_8857.tif'])
+        with open(os.path.join(self.output_dir, MANIFEST_NAME), 'r') as file:
+            self.assertEqual(len(json.load(file)['outputs']), 2)
+
+    def test_pyramid_levels(self):
+        """
+        Pyramid levels are recorded and resumed like the reprojected files.
+        """
+        process_all_files(self.input_dir, self.output_dir, 'EPSG:4326', 'EPSG:8857', pyramid_levels=[2])
+        self.assertIn('pyramid_2x/a_8857.tif', load_manifest(self.output_dir)['outputs'])
+        with mock.patch.object(datapreprocces, 'mode_aggregate') as aggregate:
+            process_all_files(self.input_dir, self.output_dir, 'EPSG:4326', 'EPSG:8857', pyramid_levels=[2])
+        aggregate.assert_not_called()
+
+
+# Raster of 5 x 7 pixels and its mode aggregation by factor 2: blocks with ties (lower class), class 0 (NA) blocks and
+# partial blocks at the right and lower edge
+NATIVE_VALUES = np.array([[1, 1, 2, 2, 3, 4, 5],
+                          [1, 2, 2, 2, 4, 3, 5],
+                          [0, 0, 6, 6, 0, 0, 1],
+                          [0, 0, 6, 5, 1, 0, 2],
+                          [3, 4, 0, 0, 2, 2, 6]], dtype=np.uint8)
+AGGREGATED_VALUES = np.array([[1, 2, 3, 5],
+                              [0, 6, 0, 1],
+                              [3, 0, 2, 6]], dtype=np.uint8)
+
+
+class TestModeAggregate(unittest.TestCase):
+    def test_mode_aggregate(self):
+        """
+        Each block is assigned its most frequent class, the grid is scaled and the class histogram is stored.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_tif, output_tif = os.path.join(tmp_dir, 'native.tif'), os.path.join(tmp_dir, 'aggregated.tif')
+            write_raster(input_tif, NATIVE_VALUES)
+            mode_aggregate(input_tif, output_tif, 2)
+            self.assertFalse(os.path.exists(partial_path(output_tif)))
+            with rasterio.open(output_tif) as src:
+                np.testing.assert_array_equal(src.read(1), AGGREGATED_VALUES)
+                self.assertEqual(src.transform, TRANSFORM * TRANSFORM.scale(2, 2))
+                self.assertEqual(src.dtypes[0], 'uint8')
+                np.testing.assert_array_equal(read_class_metadata(src)['histograms'][0],
+                                              np.bincount(AGGREGATED_VALUES.ravel()))
+
+
+def raw_raster(file_path: str, nodata: int = None):
+    """
+    Writes a raw class raster in EPSG:4326 whose reprojection has pixels outside the source footprint at its edges,
+    optionally with a block of nodata pixels.
+    """
+    values = class_values(60, 80, 7)
+    if nodata is not None:
+        values[20:30, 30:50] = nodata
+    write_raster(file_path, values, transform=from_origin(-20, 15, 0.5, 0.5), crs='EPSG:4326', nodata=nodata)
+
+
+class TestWarpedReads(unittest.TestCase):
+    def test_warped_equals_reprojected(self):
+        """
+        Warped reads of a raw raster equal the file written by epsg_reproject (grid, values and nodata), also for
+        windows.
+        """
+        for nodata in [None, 255]:
+            with self.subTest(nodata=nodata), tempfile.TemporaryDirectory() as tmp_dir:
+                input_tif, output_tif = os.path.join(tmp_dir, 'a_4326.tif'), os.path.join(tmp_dir, 'a_8857.tif')
+                raw_raster(input_tif, nodata)
+                epsg_reproject(input_tif, output_tif, 'EPSG:4326', 'EPSG:8857')
+                with rasterio.open(output_tif) as reprojected, \
+                        open_warped(input_tif, 'EPSG:4326', 'EPSG:8857') as warped:
+                    self.assertEqual(warped.crs, reprojected.crs)
+                    self.assertEqual(warped.transform, reprojected.transform)
+                    self.assertEqual(warped.shape, reprojected.shape)
+                    self.assertEqual(warped.nodata, reprojected.nodata)
+                    values = reprojected.read(1)
+                    if nodata is not None:
+                        self.assertTrue((values == nodata).any())
+                    np.testing.assert_array_equal(warped.read(1), values)
+                    window = Window(10, 5, 30, 20)
+                    np.testing.assert_array_equal(warped.read(1, window=window), values[5:25, 10:40])
+
+
+class TestWarpIndex(unittest.TestCase):
+    def test_gather_equals_reprojected(self):
+        """
+        Rasters gathered through the warp index equal the files written by epsg_reproject pixel for pixel (grid,
+        values, nodata and edge pixels outside the source footprint, class histograms), whatever the block of rows;
+        the index is built once per source grid.
+        """
+        for nodata in [None, 255]:
+            with self.subTest(nodata=nodata), tempfile.TemporaryDirectory() as tmp_dir:
+                input_tif, index_dir = os.path.join(tmp_dir, 'a_4326.tif'), os.path.join(tmp_dir, 'warp_index')
+                raw_raster(input_tif, nodata)
+                warped_tif, gathered_tif = os.path.join(tmp_dir, 'warped.tif'), os.path.join(tmp_dir, 'gathered.tif')
+                epsg_reproject(input_tif, warped_tif, 'EPSG:4326', 'EPSG:8857')
+                epsg_reproject(input_tif, gathered_tif, 'EPSG:4326', 'EPSG:8857', index_dir=index_dir)
+                self.assertEqual(len(os.listdir(index_dir)), 1)
+
+                blocks_tif = os.path.join(tmp_dir, 'blocks.tif')
+                with rasterio.open(input_tif) as src:
+                    index = load_warp_index(src, 'EPSG:4326', 'EPSG:8857', index_dir)
+                    self.assertTrue((index[0] == -1).any() and (index[:, 0] == -1).any())  # edges without source
+                    gather_reproject(src, blocks_tif, index, 'EPSG:8857', block_rows=7)
+                self.assertEqual(len(os.listdir(index_dir)), 1)
+
+                with rasterio.open(warped_tif) as warped:
+                    values = warped.read(1)
+                    if nodata is not None:
+                        self.assertTrue((values == nodata).any())
+                    for output_tif in [gathered_tif, blocks_tif]:
+                        with rasterio.open(output_tif) as gathered:
+                            self.assertEqual(gathered.crs, warped.crs)
+                            self.assertEqual(gathered.transform, warped.transform)
+                            self.assertEqual(gathered.shape, warped.shape)
+                            self.assertEqual(gathered.nodata, warped.nodata)
+                            np.testing.assert_array_equal(gathered.read(1), values)
+                            for histogram, expected in zip(read_class_metadata(gathered)['histograms'],
+                                                           read_class_metadata(warped)['histograms']):
+                                np.testing.assert_array_equal(histogram, expected)
+
+
+class TestClassMetadata(unittest.TestCase):
+    def setUp(self):
+        self.values = class_values(40, 30, 7)
+        self.histogram = np.bincount(self.values.ravel(), minlength=7)
+        with self.tagged_raster(self.values) as memfile, memfile.open() as src:
+            self.tag = src.tags()[CLASS_METADATA_TAG]
+
+    @staticmethod
+    def tagged_raster(values: np.ndarray, tag: str = None, transform=TRANSFORM) -> MemoryFile:
+        """
+        In-memory raster with the class metadata of write_class_metadata, or with the given tag.
+        """
+        memfile = MemoryFile()
+        with memfile.open(**raster_profile(values, transform)) as dst:
+            dst.write(values[np.newaxis] if values.ndim == 2 else values)
+            if tag is None:
+                write_class_metadata(dst, [np.bincount(band.ravel()) for band in dst.read()])
+            else:
+                dst.update_tags(**{CLASS_METADATA_TAG: tag})
+        return memfile
+
+    def read(self, values: np.ndarray, tag: str = None, transform=TRANSFORM):
+        with self.tagged_raster(values, tag, transform) as memfile, memfile.open() as src:
+            return read_class_metadata(src)
+
+    def changed_tag(self, **changes) -> str:
+        return json.dumps({**json.loads(self.tag), **changes})
+
+    def test_round_trip(self):
+        metadata = self.read(self.values, self.tag)
+        self.assertEqual((metadata['width'], metadata['height']), (30, 40))
+        self.assertEqual(len(metadata['histograms']), 1)
+        np.testing.assert_array_equal(metadata['histograms'][0], self.histogram)
+
+    def test_missing_or_invalid(self):
+        """
+        Missing, invalid or incomplete metadata and metadata of another version are not used.
+        """
+        with MemoryFile() as memfile:
+            with memfile.open(**raster_profile(self.values)) as dst:
+                dst.write(self.values[np.newaxis])
+            with memfile.open() as src:
+                self.assertIsNone(read_class_metadata(src))
+        metadata = json.loads(self.tag)
+        del metadata['histograms']
+        for tag in ['{"version": 1, "wid', 'null', '[1, 2]', json.dumps(metadata), self.changed_tag(version=0),
+                    self.changed_tag(histograms='counts')]:
+            with self.subTest(tag=tag):
+                self.assertIsNone(self.read(self.values, tag))
+
+    def test_stale(self):
+        """
+        Metadata of another grid, another number of bands or not matching the pixels are not used.
+        """
+        self.assertIsNone(self.read(self.values[:, :20], self.tag))
+        self.assertIsNone(self.read(self.values, self.tag, transform=from_origin(10, 1000, 10, 10)))
+        self.assertIsNone(self.read(np.stack([self.values, self.values]), self.tag))
+        counts = list(map(int, self.histogram))
+        counts[1] += 1
+        self.assertIsNone(self.read(self.values, self.changed_tag(histograms=[counts])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+import pandas as pd
+from xlsxwriter.exceptions import FileCreateError
+
+from PNV.src.export import ExcelExport, write_excel
+
+
+def result_table() -> pd.DataFrame:
+    """
+    Results of two sheets with a missing value.
+    """
+    return pd.DataFrame({'country': ['France', 'Kenya', 'France', 'Kenya'], 'ISO': ['FRA', 'KEN', 'FRA', 'KEN'],
+                         'Forest': [1.5, np.nan, 2.5, 4.0], 'Total Pixels': [10, 20, 30, 40],
+                         'Sheet Name': ['iucn.hcl_c_1km_a_19790101', 'iucn.hcl_c_1km_a_19790101', 'rcp26_2040',
+                                        'rcp26_2040']})
+
+
+class TestExcelExport(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.output_path = tmp_dir.name
+
+    def test_round_trip(self):
+        """
+        Sheets streamed from a groupby are written to one workbook each, the pickle equals the dataframe.
+        """
+        df = result_table()
+        export = ExcelExport(max_workers=2)
+        export.submit(os.path.join(self.output_path, 'sheets.xlsx'), df.groupby('Sheet Name', sort=False))
+        export.submit(os.path.join(self.output_path, 'combined.xlsx'), [('Results', df)])
+        export.submit_pickle(os.path.join(self.output_path, 'combined.pkl'), df)
+        self.assertEqual([os.path.basename(path) for path in export.wait()],
+                         ['sheets.xlsx', 'combined.xlsx', 'combined.pkl'])
+        self.assertEqual(sorted(os.listdir(self.output_path)), ['combined.pkl', 'combined.xlsx', 'sheets.xlsx'])
+
+        sheets = pd.read_excel(os.path.join(self.output_path, 'sheets.xlsx'), sheet_name=None)
+        self.assertEqual(list(sheets), ['iucn.hcl_c_1km_a_19790101', 'rcp26_2040'])
+        for sheet_name, sheet_df in df.groupby('Sheet Name', sort=False):
+            pd.testing.assert_frame_equal(sheets[sheet_name], sheet_df.reset_index(drop=True))
+        pd.testing.assert_frame_equal(pd.read_excel(os.path.join(self.output_path, 'combined.xlsx')), df)
+        pd.testing.assert_frame_equal(pd.read_pickle(os.path.join(self.output_path, 'combined.pkl')), df)
+
+    def test_long_sheet_names(self):
+        """
+        Sheet names are cut to the 31 characters allowed by Excel; rows are written chunk by chunk.
+        """
+        df = pd.DataFrame({'value': np.arange(25)})
+        output_file = write_excel(os.path.join(self.output_path, 'long.xlsx'), [('s' * 40, df)], chunk_size=10)
+        sheets = pd.read_excel(output_file, sheet_name=None)
+        self.assertEqual(list(sheets), ['s' * 31])
+        pd.testing.assert_frame_equal(sheets['s' * 31], df)
+
+    def test_failed_export(self):
+        """
+        The error of a failed export is raised from wait, after all other exports are finished.
+        """
+        export = ExcelExport()
+        export.submit(os.path.join(self.output_path, 'missing', 'sheets.xlsx'), [('Results', result_table())])
+        export.submit_pickle(os.path.join(self.output_path, 'combined.pkl'), result_table())
+        with self.assertRaises(FileCreateError):
+            export.wait()
+        self.assertTrue(os.path.exists(os.path.join(self.output_path, 'combined.pkl')))
+        self.assertEqual(export.wait(), [])
+
+    def test_bounded_workers(self):
+        """
+        At most max_workers exports are held at once; the worker threads are shut down by wait and started again by the
+        next submission.
+        """
+        export = ExcelExport(max_workers=2)
+        release = threading.Event()
+
+        def blocking_sheets():
+            release.wait(timeout=10)
+            yield 'Results', result_table()
+
+        export.submit(os.path.join(self.output_path, 'first.xlsx'), blocking_sheets())
+        export.submit(os.path.join(self.output_path, 'second.xlsx'), blocking_sheets())
+        third = threading.Thread(target=export.submit_pickle,
+                                 args=(os.path.join(self.output_path, 'third.pkl'), result_table()))
+        third.start()
+        third.join(timeout=0.5)
+        self.assertTrue(third.is_alive())  # waits for a free worker
+        self.assertFalse(os.path.exists(os.path.join(self.output_path, 'third.pkl')))
+        release.set()
+        third.join(timeout=10)
+        self.assertEqual(len(export.wait()), 3)
+        self.assertFalse([thread for thread in threading.enumerate() if thread.name.startswith('PNV-ExcelExport')])
+
+        export.submit_pickle(os.path.join(self.output_path, 'fourth.pkl'), result_table())
+        self.assertEqual(len(export.wait()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import matplotlib.pyplot as plt
+
+from PNV.src import figures
+from PNV.src.figures import FigureExport
+
+
+def line_figure():
+    """
+    Small pyplot figure.
+    """
+    fig = plt.figure(figsize=(2, 2))
+    plt.plot([0, 1], [1, 0])
+    return fig
+
+
+class TestFigureExport(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.output_path = tmp_dir.name
+
+    def test_written(self):
+        """
+        Submitted figures are closed in pyplot and written to their files.
+        """
+        export = FigureExport(max_workers=2)
+        output_files = [os.path.join(self.output_path, f"figure_{k}.png") for k in range(3)]
+        for output_file in output_files:
+            export.submit(line_figure(), output_file, dpi=20)
+        self.assertEqual(plt.get_fignums(), [])
+        self.assertEqual(export.wait(), output_files)
+        self.assertEqual(sorted(os.listdir(self.output_path)), ['figure_0.png', 'figure_1.png', 'figure_2.png'])
+        self.assertEqual(export.wait(), [])
+
+    def test_bounded_figures(self):
+        """
+        At most max_workers figures are held at once, and they are rendered one after the other by a single thread.
+        """
+        write_figure = figures.write_figure
+        release = threading.Event()
+        lock = threading.Lock()
+        rendering, overlaps, threads = [], [], set()
+
+        def blocking_write(fig, output_file, savefig_kwargs):
+            release.wait(timeout=10)
+            with lock:
+                overlaps.append(len(rendering))
+                rendering.append(output_file)
+            threads.add(threading.current_thread().name)
+            try:
+                return write_figure(fig, output_file, savefig_kwargs)
+            finally:
+                with lock:
+                    rendering.remove(output_file)
+
+        export = FigureExport(max_workers=2)
+        with mock.patch.object(figures, 'write_figure', side_effect=blocking_write):
+            export.submit(line_figure(), os.path.join(self.output_path, 'first.png'), dpi=20)
+            export.submit(line_figure(), os.path.join(self.output_path, 'second.png'), dpi=20)
+            third = threading.Thread(target=export.submit,
+                                     args=(line_figure(), os.path.join(self.output_path, 'third.png')),
+                                     kwargs={'dpi': 20})
+            third.start()
+            third.join(timeout=0.5)
+            self.assertTrue(third.is_alive())  # waits for a free slot
+            self.assertEqual(len(export.futures), 2)
+            release.set()
+            third.join(timeout=10)
+            self.assertEqual(len(export.wait()), 3)
+        self.assertEqual(overlaps, [0, 0, 0])
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(next(iter(threads)).startswith('PNV-FigureExport'))
+
+    def test_immediate(self):
+        """
+        Without workers, figures are written on the calling thread before the submission returns.
+        """
+        export = FigureExport(max_workers=0)
+        output_file = os.path.join(self.output_path, 'figure.png')
+        write_figure = figures.write_figure
+        threads = []
+
+        def recorded_write(fig, output_file, savefig_kwargs):
+            threads.append(threading.current_thread())
+            return write_figure(fig, output_file, savefig_kwargs)
+
+        with mock.patch.object(figures, 'write_figure', side_effect=recorded_write):
+            future = export.submit(line_figure(), output_file, dpi=20)
+            self.assertTrue(future.done())
+            self.assertTrue(os.path.exists(output_file))
+        self.assertEqual(threads, [threading.main_thread()])
+        self.assertEqual(export.wait(), [output_file])
+
+    def test_failed_export(self):
+        """
+        The error of a failed export is raised from wait, after all other figures are written.
+        """
+        for max_workers in [0, 2]:
+            with self.subTest(max_workers=max_workers):
+                export = FigureExport(max_workers=max_workers)
+                export.submit(line_figure(), os.path.join(self.output_path, 'missing', 'figure.png'), dpi=20)
+                export.submit(line_figure(), os.path.join(self.output_path, f"figure_{max_workers}.png"), dpi=20)
+                with self.assertRaises(FileNotFoundError):
+                    export.wait()
+                self.assertTrue(os.path.exists(os.path.join(self.output_path, f"figure_{max_workers}.png")))
+                self.assertEqual(export.wait(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
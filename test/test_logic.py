@@ -0,0 +1,375 @@
+import glob
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import geopandas as gpd
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from rasterio.mask import mask
+from shapely.geometry import box, mapping, MultiPolygon
+
+from PNV.src.datamanager import labels_6, labels_20
+from PNV.src.logic import ProcessingArea
+from PNV.src.occupancy import TileOccupancy, occupancy_path
+from PNV.src.zonal import CountryCoverage
+from PNV.user_input.default_parameters import USER_INPUT
+from PNV.src.datapreprocces import mode_aggregate, pyramid_dir
+from test.synthetic import memory_raster, class_values, write_raster
+from test.test_datapreprocces import NATIVE_VALUES, AGGREGATED_VALUES
+from test.test_zonal import synthetic_countries
+
+COUNTRIES = [('France', '-99', 'Europe'), ('Norway', '-99', 'Europe'), ('Kosovo', '-99', 'Europe'),
+             ('Germany', 'DEU', 'Europe'), ('Kenya', 'KEN', 'Africa')]
+
+
+def result_rows(sheet: str, countries: list, area: float) -> pd.DataFrame:
+    return pd.DataFrame({'country': [name for name, _, _ in countries], 'ISO': [iso for _, iso, _ in countries],
+                         'Forest': area, 'Total Area (km^2)': area, 'Sheet Name': sheet})
+
+
+def run_synthetic(preprocessed_path: str, output_path: str, **user_input) -> ProcessingArea:
+    """
+    Runs the processing of the rasters in preprocessed_path for the synthetic countries of the test grid.
+    :return: ProcessingArea after the run, with all exports written.
+    """
+    processing = ProcessingArea(user_input={**USER_INPUT, 'CLASS_SELECTION': 6, 'ZIPPED_DATA': False,
+                                            'FIGURE_WORKERS': 0, **user_input},
+                                preprocessed_path=preprocessed_path, output_path=output_path)
+    world = synthetic_countries()
+    world['continent'] = 'Europe'
+    processing._countries = ProcessingArea.select_countries(world, processing.country_subset or ['Europe'])
+    processing.run_processing()
+    processing.wait_for_exports()
+    return processing
+
+
+class TestMergeResults(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.output_path = tmp_dir.name
+        # Kenya is missing in the results of sheet s2
+        self.existing_df = pd.concat([result_rows('s1', COUNTRIES, 1.0), result_rows('s2', COUNTRIES[:4], 1.0)],
+                                     ignore_index=True)
+
+    def processing_area(self, country_subset: list, **user_input) -> ProcessingArea:
+        processing = ProcessingArea(user_input={**USER_INPUT, 'CLASS_SELECTION': 6, 'COUNTRY_SUBSET': country_subset,
+                                                **user_input}, output_path=self.output_path)
+        world = gpd.GeoDataFrame({'name': [name for name, _, _ in COUNTRIES],
+                                  'iso_a3': [iso for _, iso, _ in COUNTRIES],
+                                  'continent': [continent for _, _, continent in COUNTRIES]},
+                                 geometry=[box(k, 0, k + 1, 1) for k in range(len(COUNTRIES))])
+        processing._countries = ProcessingArea.select_countries(world, country_subset)
+        return processing
+
+    def test_shared_iso(self):
+        """
+        Only the rows of the selected country are replaced, not those of other countries with the ISO3 code -99.
+        """
+        processing = self.processing_area(['France'])
+        processing.results = {6: self.existing_df}
+        subset_df = pd.concat([result_rows('s1', COUNTRIES[:1], 2.0), result_rows('s2', COUNTRIES[:1], 2.0)],
+                              ignore_index=True)
+        merged_df = processing.merge_results(subset_df)
+
+        self.assertEqual(list(merged_df['country']), list(self.existing_df['country']))
+        self.assertEqual(list(merged_df['Sheet Name']), list(self.existing_df['Sheet Name']))
+        expected = [2.0 if country == 'France' else 1.0 for country in self.existing_df['country']]
+        self.assertEqual(list(merged_df['Forest']), expected)
+
+    def test_continent_from_file(self):
+        """
+        A continent is merged into an explicit results file; new rows are placed after the last row of their sheet.
+        """
+        base_file = os.path.join(self.output_path, 'base_6_class_combined.pkl')
+        self.existing_df.to_pickle(base_file)
+        # Newer results of another run in the output directory are not considered
+        result_rows('s1', COUNTRIES, 9.0).to_pickle(os.path.join(self.output_path, 'newer_6_class_combined.pkl'))
+
+        processing = self.processing_area(['Africa'], SUBSET_BASE={'6': base_file})
+        subset_df = pd.concat([result_rows('s1', COUNTRIES[4:], 2.0), result_rows('s2', COUNTRIES[4:], 2.0)],
+                              ignore_index=True)
+        merged_df = processing.merge_results(subset_df)
+
+        self.assertEqual(len(merged_df), len(self.existing_df) + 1)
+        self.assertEqual(list(merged_df['Forest']), [1.0] * 4 + [2.0] + [1.0] * 4 + [2.0])
+        self.assertEqual(list(merged_df['Sheet Name']), ['s1'] * 5 + ['s2'] * 5)
+        self.assertEqual(merged_df['country'].iloc[-1], 'Kenya')
+
+    def test_no_base(self):
+        """
+        Without explicit results file or previous run, only the country subset is kept.
+        """
+        processing = self.processing_area(['DEU'])
+        self.existing_df.to_pickle(os.path.join(self.output_path, 'old_6_class_combined.pkl'))
+        subset_df = result_rows('s1', COUNTRIES[3:4], 2.0)
+        self.assertIs(processing.merge_results(subset_df), subset_df)
+
+    def test_invalid_base(self):
+        with self.assertRaises(ValueError):
+            ProcessingArea(user_input={**USER_INPUT, 'CLASS_SELECTION': [6, 20], 'COUNTRY_SUBSET': ['DEU'],
+                                       'SUBSET_BASE': 'results.pkl'}, output_path=self.output_path)
+
+
+class TestMaskCountry(unittest.TestCase):
+    def test_multi_part_country(self):
+        """
+        A multi-part country is masked part group by part group and counts the pixels of all parts once.
+        """
+        processing = ProcessingArea(user_input={**USER_INPUT, 'CLASS_SELECTION': 6})
+        geometry = MultiPolygon([box(0, 900, 200, 1000), box(15, 800, 95, 890), box(800, 0, 1000, 150)])
+        country = pd.Series({'name': 'Split', 'iso_a3': 'SPL', 'geometry': geometry})
+        failures = []
+        with memory_raster(class_values(100, 100, len(labels_6))) as memfile, memfile.open() as src:
+            row_data = processing.mask_country(src, country, labels_6, failures)
+            out_image, _ = mask(src, [mapping(geometry)], crop=False, nodata=0)
+            self.assertEqual(len(processing.country_parts(src, geometry)), 2)
+
+        self.assertEqual(failures, [])
+        pixel_area_km2 = 1e-4
+        self.assertEqual(row_data['Total Pixels'], np.count_nonzero(out_image))
+        for value, label in enumerate(labels_6[1:], start=1):
+            self.assertAlmostEqual(row_data[label], np.count_nonzero(out_image == value) * pixel_area_km2)
+
+    def test_plot_decimated(self):
+        """
+        Maps are plotted from the raster decimated to max_size pixels on the longer side.
+        """
+        processing = ProcessingArea(user_input={**USER_INPUT, 'CLASS_SELECTION': 6, 'FIGURE_WORKERS': 0})
+        processing.figure_export.submit = lambda fig, output_path: fig
+        values = class_values(300, 120, len(labels_6))
+        with memory_raster(values) as memfile:
+            fig = processing.plot_tif(memfile, 'map.png', max_size=50)
+        try:
+            np.testing.assert_array_equal(fig.axes[0].images[0].get_array(), values[3::6, 3::6])  # pixel centres
+        finally:
+            plt.close(fig)
+
+    def test_plot_occupancy(self):
+        """
+        With the occupancy index, maps are plotted from the occupied tiles of the raster decimated to max_size pixels.
+        """
+        processing = ProcessingArea(user_input={**USER_INPUT, 'CLASS_SELECTION': 6, 'FIGURE_WORKERS': 0,
+                                                'ZIPPED_DATA': False, 'OCCUPANCY_INDEX': True})
+        processing.figure_export.submit = lambda fig, output_path: fig
+        values = class_values(300, 120, len(labels_6))
+        values[:, 60:] = 0
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            raster_file = os.path.join(tmp_dir, 'biomes_iucn.hcl_c_1km_a_19790101.tif')
+            write_raster(raster_file, values)
+            with mock.patch.object(TileOccupancy, 'read_decimated', autospec=True,
+                                   side_effect=TileOccupancy.read_decimated) as read_decimated:
+                fig = processing.plot_tif(raster_file, 'map.png', max_size=50)
+            self.assertTrue(os.path.exists(occupancy_path(raster_file)))
+        try:
+            self.assertEqual(read_decimated.call_count, 1)
+            np.testing.assert_array_equal(fig.axes[0].images[0].get_array(), values[3::6, 3::6])
+        finally:
+            plt.close(fig)
+
+
+class TestMaskCountriesThreaded(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.raster_file = os.path.join(tmp_dir.name, 'biomes_iucn.hcl_c_1km_a_19790101.tif')
+        write_raster(self.raster_file, class_values(100, 100, len(labels_6)))
+        # Countries of growing size, such that the largest countries scheduled first are the last ones of the layer;
+        # the geometry of BAD cannot be masked
+        geometries = [box(x, y, x + 50 + 10 * k, y + 50 + 10 * k)
+                      for k, (x, y) in enumerate([(20, 30), (600, 40), (30, 520), (450, 450), (120, 250), (500, 150)])]
+        self.world = gpd.GeoDataFrame({'name': [f'Country {k}' for k in range(len(geometries))] + ['Bad'],
+                                       'iso_a3': [f'C{k:02d}' for k in range(len(geometries))] + ['BAD']},
+                                      geometry=geometries + [None])
+
+    def pixel_values(self, mask_threads: int) -> tuple:
+        processing = ProcessingArea(user_input={**USER_INPUT, 'CLASS_SELECTION': 6, 'ZIPPED_DATA': False,
+                                                'MASK_THREADS': mask_threads})
+        processing._countries = self.world
+        with self.assertLogs('PNV-Processing', level='ERROR') as logs:
+            pixel_values_df = processing.get_pixel_values_by_country(self.raster_file)
+        return pixel_values_df, processing.error_summaries, logs.output
+
+    def test_threaded_equals_sequential(self):
+        """
+        The threaded masking yields the results of the sequential masking in the order of the countries; a failing
+        country is skipped and reported once in the summary of the raster.
+        """
+        sequential_df, sequential_summaries, _ = self.pixel_values(0)
+        threaded_df, threaded_summaries, logs = self.pixel_values(3)
+
+        pd.testing.assert_frame_equal(threaded_df, sequential_df)
+        self.assertEqual(list(threaded_df['ISO']), list(self.world['iso_a3'][:-1]))
+        self.assertTrue((threaded_df['Total Pixels'] > 0).all())
+
+        self.assertEqual(threaded_summaries, sequential_summaries)
+        summary = threaded_summaries[os.path.basename(self.raster_file)]
+        self.assertEqual([entry['iso'] for entry in summary.values()], [['BAD']])
+        self.assertEqual(len(logs), 1)
+        self.assertIn('1 countries skipped', logs[0])
+
+
+class TestResultTable(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.preprocessed_path = os.path.join(tmp_dir.name, 'preprocessed')
+        self.output_path = os.path.join(tmp_dir.name, 'outputs')
+        os.makedirs(self.preprocessed_path)
+        write_raster(os.path.join(self.preprocessed_path, 'biomes_iucn.hcl_c_1km_a_19790101.tif'),
+                     class_values(100, 100, len(labels_6)))
+
+    def run_processing(self, **user_input) -> ProcessingArea:
+        return run_synthetic(self.preprocessed_path, self.output_path, **user_input)
+
+    def test_complete_results(self):
+        """
+        Complete hard class results are handed over to the toolbox.
+        """
+        processing = self.run_processing()
+        pnv_data = processing.result_table(6)
+        self.assertIsNotNone(pnv_data)
+        self.assertEqual(list(pnv_data['ISO']), ['WST', 'EST', 'ISL'])
+        self.assertIsNone(processing.result_table(20))
+
+    def test_other_results_are_not_handed_over(self):
+        """
+        Estimates, expected areas and country subsets not merged into complete results are read from disk.
+        """
+        self.assertIsNone(self.run_processing(SAMPLE_FRACTION=0.5).result_table(6))
+
+        processing = self.run_processing(COUNTRY_SUBSET=['ISL'])
+        self.assertEqual(list(processing.results[6]['ISO']), ['ISL'])
+        self.assertIsNone(processing.result_table(6))
+        processing.run_processing()  # merged into the incomplete results of the previous run
+        self.assertIsNone(processing.result_table(6))
+
+        base_file = os.path.join(self.output_path, 'base_6_class_combined.pkl')
+        self.run_processing().result_table(6).to_pickle(base_file)
+        processing = self.run_processing(COUNTRY_SUBSET=['ISL'], SUBSET_BASE=base_file)
+        self.assertEqual(list(processing.result_table(6)['ISO']), ['WST', 'EST', 'ISL'])
+
+
+class TestStackedProcessing(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.preprocessed_path = os.path.join(tmp_dir.name, 'preprocessed')
+        os.makedirs(self.preprocessed_path)
+        names = ['hcl_c_1km_a_19790101', 'hcl.rcp26_c_1km_a_20400101', 'hcl.rcp85_c_1km_a_20400101']
+        for seed, name in enumerate(names):
+            write_raster(os.path.join(self.preprocessed_path, f'biomes_iucn.{name}.tif'),
+                         class_values(100, 100, len(labels_6), seed=seed))
+
+    def results(self, run_name: str, **user_input) -> pd.DataFrame:
+        processing = run_synthetic(self.preprocessed_path, os.path.join(self.tmp_dir, run_name), **user_input)
+        return processing.results[6].sort_values(['Sheet Name', 'ISO'], ignore_index=True)
+
+    def test_stacked_equals_per_file(self):
+        """
+        The stacked single pass over all rasters yields the results of the per-file processing for both zonal methods.
+        """
+        for zonal_method in ['mask', 'coverage']:
+            with self.subTest(zonal_method=zonal_method):
+                with mock.patch.object(CountryCoverage, 'stacked_histograms',
+                                       autospec=True, side_effect=CountryCoverage.stacked_histograms) as stacked, \
+                        mock.patch.object(ProcessingArea, 'get_pixel_values_by_country') as per_country:
+                    stacked_df = self.results(f'stacked_{zonal_method}', STACKED_RASTERS=True,
+                                              ZONAL_METHOD=zonal_method)
+                self.assertEqual(stacked.call_count, 1)
+                self.assertEqual(len(stacked.call_args.args[1]), 3)
+                per_country.assert_not_called()
+                per_file_df = self.results(f'per_file_{zonal_method}', ZONAL_METHOD=zonal_method)
+                pd.testing.assert_frame_equal(stacked_df, per_file_df, check_dtype=False)
+
+    def test_rasters_on_other_grids(self):
+        """
+        Rasters which are not co-registered are processed one after another.
+        """
+        write_raster(os.path.join(self.preprocessed_path, 'biomes_iucn.hcl.rcp26_c_1km_a_20610101.tif'),
+                     class_values(90, 100, len(labels_6)))
+        with mock.patch.object(CountryCoverage, 'stacked_histograms') as stacked:
+            stacked_df = self.results('stacked', STACKED_RASTERS=True)
+        stacked.assert_not_called()
+        self.assertEqual(stacked_df['Sheet Name'].nunique(), 4)
+        pd.testing.assert_frame_equal(stacked_df, self.results('per_file'), check_dtype=False)
+
+
+class TestClassSelections(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.preprocessed_path = os.path.join(tmp_dir.name, 'preprocessed')
+        os.makedirs(self.preprocessed_path)
+        for family, labels in [('iucn', labels_6), ('biome6k', labels_20)]:
+            for seed, name in enumerate(['hcl_c_1km_a_19790101', 'hcl.rcp45_c_1km_a_20400101']):
+                write_raster(os.path.join(self.preprocessed_path, f'biomes_{family}.{name}.tif'),
+                             class_values(100, 100, len(labels), seed=seed))
+
+    def test_both_class_selections(self):
+        """
+        Both class selections are processed in one run sharing the zones (and, stacked, the pass over the grid), with
+        the results and files of separate runs.
+        """
+        for user_input in [{}, {'STACKED_RASTERS': True, 'ZONAL_METHOD': 'coverage'}]:
+            with self.subTest(**user_input):
+                output_path = os.path.join(self.tmp_dir, f'both_{len(user_input)}')
+                with mock.patch.object(ProcessingArea, 'load_coverage', autospec=True,
+                                       side_effect=ProcessingArea.load_coverage) as load_coverage, \
+                        mock.patch.object(CountryCoverage, 'stacked_histograms', autospec=True,
+                                          side_effect=CountryCoverage.stacked_histograms) as stacked:
+                    processing = run_synthetic(self.preprocessed_path, output_path, CLASS_SELECTION=[6, 20],
+                                               **user_input)
+                self.assertEqual(sorted(processing.results), [6, 20])
+                if user_input:
+                    self.assertEqual(load_coverage.call_count, 1)
+                    self.assertEqual(stacked.call_count, 1)
+                    self.assertEqual(len(stacked.call_args.args[1]), 4)
+                for class_selection in [6, 20]:
+                    separate = run_synthetic(self.preprocessed_path, os.path.join(output_path, str(class_selection)),
+                                             CLASS_SELECTION=class_selection, **user_input)
+                    pd.testing.assert_frame_equal(
+                        processing.results[class_selection].sort_values(['Sheet Name', 'ISO'], ignore_index=True),
+                        separate.results[class_selection].sort_values(['Sheet Name', 'ISO'], ignore_index=True),
+                        check_dtype=False)
+                    result_files = glob.glob(os.path.join(output_path, f'*_{class_selection}_class_combined.pkl'))
+                    self.assertEqual(len(result_files), 1)
+
+    def test_invalid_class_selection(self):
+        with self.assertRaises(ValueError):
+            ProcessingArea(user_input={**USER_INPUT, 'CLASS_SELECTION': [6, 7]})
+
+
+class TestResolutionDeviation(unittest.TestCase):
+    def test_report_resolution_deviation(self):
+        """
+        The class areas of the historic raster at a pyramid level are compared with the native resolution.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            native_tif = os.path.join(tmp_dir, 'biomes_iucn.hcl_c_1km_a_19790101.tif')
+            coarse_tif = os.path.join(tmp_dir, pyramid_dir(2), os.path.basename(native_tif))
+            os.makedirs(os.path.dirname(coarse_tif))
+            write_raster(native_tif, NATIVE_VALUES)
+            mode_aggregate(native_tif, coarse_tif, 2)
+
+            processing = ProcessingArea(user_input={**USER_INPUT, 'CLASS_SELECTION': 6, 'ZIPPED_DATA': False,
+                                                    'PYRAMID_LEVELS': [2], 'RESOLUTION_LEVEL': 2},
+                                        preprocessed_path=tmp_dir, output_path=tmp_dir)
+            processing.tif_files = [coarse_tif]
+            deviation_df = processing.report_resolution_deviation()
+
+        pixel_area_km2 = 1e-4
+        native_area = np.bincount(NATIVE_VALUES.ravel(), minlength=len(labels_6)) * pixel_area_km2
+        coarse_area = np.bincount(AGGREGATED_VALUES.ravel(), minlength=len(labels_6)) * 4 * pixel_area_km2
+        np.testing.assert_allclose(deviation_df['Native Area (km²)'], native_area)
+        np.testing.assert_allclose(deviation_df['Area 2x (km²)'], coarse_area)
+        np.testing.assert_allclose(deviation_df['Deviation (%)'], (coarse_area - native_area) / native_area * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from PNV.src.occupancy import TileOccupancy, OccupiedRaster, occupancy_path
+from test.synthetic import memory_raster, write_raster
+
+NUM_CLASSES = 7
+
+
+def island_values() -> np.ndarray:
+    """
+    Raster of 100 x 130 pixels which is empty (class 0) except for two islands.
+    """
+    values = np.zeros((100, 130), dtype=np.uint8)
+    values[5:20, 20:60] = np.random.default_rng(0).integers(0, NUM_CLASSES, size=(15, 40))
+    values[70:75, 125:130] = 3
+    return values
+
+
+class TestTileOccupancy(unittest.TestCase):
+    def setUp(self):
+        self.values = island_values()
+        self.memfile = memory_raster(self.values)
+        self.addCleanup(self.memfile.close)
+        with self.memfile.open() as src:
+            self.occupancy = TileOccupancy.build(src, tile_size=16)
+
+    def test_build(self):
+        expected = np.zeros((7, 9), dtype=bool)
+        expected[0:2, 1:4] = True
+        expected[4, 7:9] = True
+        np.testing.assert_array_equal(self.occupancy.occupied, expected)
+        self.assertEqual(self.occupancy.occupied_tiles, 8)
+
+    def test_occupied_windows(self):
+        """
+        Adjacent occupied tiles of a band of tiles are merged into one window, windows are clipped to the raster and
+        to the requested window.
+        """
+        self.assertEqual(self.occupancy.occupied_windows(),
+                         [Window(16, 0, 48, 16), Window(16, 16, 48, 16), Window(112, 64, 18, 16)])
+        self.assertEqual(self.occupancy.occupied_windows(Window(30, 10, 90, 60)),
+                         [Window(30, 10, 34, 6), Window(30, 16, 34, 16), Window(112, 64, 8, 6)])
+        self.assertEqual(self.occupancy.occupied_windows(Window(0, 32, 100, 30)), [])
+
+    def test_read_and_class_counts(self):
+        """
+        Reads skipping empty tiles return the raster values; class counts add the empty tiles to class 0.
+        """
+        with self.memfile.open() as src:
+            raster = OccupiedRaster(src, self.occupancy)
+            np.testing.assert_array_equal(raster.read(1), self.values)
+            window = Window(50, 10, 80, 70)
+            np.testing.assert_array_equal(raster.read(1, window=window), self.values[10:80, 50:130])
+            class_counts, nonzero_pixels = raster.class_counts(NUM_CLASSES)
+        self.assertEqual(class_counts, list(np.bincount(self.values.ravel(), minlength=NUM_CLASSES)))
+        self.assertEqual(nonzero_pixels, np.count_nonzero(self.values))
+
+    def test_decimated_read(self):
+        """
+        Decimated reads (nearest neighbour) equal those of rasterio, whole raster and windows, without reading tiles
+        which are empty or hold no sampled pixel; other resamplings fall back to a full read.
+        """
+        with self.memfile.open() as src:
+            raster = OccupiedRaster(src, self.occupancy, logger=logging.getLogger("PNV-Processing"))
+            for out_shape in [(50, 65), (34, 44), (7, 9)]:
+                for window in [None, Window(7, 3, 101, 77)]:
+                    with self.subTest(out_shape=out_shape, window=window):
+                        np.testing.assert_array_equal(
+                            raster.read(1, window=window, out_shape=out_shape),
+                            src.read(1, window=window, out_shape=out_shape, resampling=Resampling.nearest))
+            with mock.patch.object(src, 'read', wraps=src.read) as read:
+                decimated = raster.read(1, out_shape=(4, 4), resampling=Resampling.nearest)
+            self.assertEqual([call.kwargs['window'] for call in read.call_args_list], [Window(16, 0, 48, 16)])
+            np.testing.assert_array_equal(decimated, self.values[np.ix_([12, 37, 62, 87], [16, 48, 81, 113])])
+
+            with self.assertLogs("PNV-Processing", level='DEBUG') as logs:
+                average = raster.read(1, out_shape=(50, 65), resampling=Resampling.average)
+            self.assertIn("Full read", logs.output[0])
+            np.testing.assert_array_equal(average, src.read(1, out_shape=(50, 65), resampling=Resampling.average))
+
+    def test_stored_index(self):
+        """
+        The index stored next to a raster is reused until the raster changes.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tif_file = os.path.join(tmp_dir, 'raster.tif')
+            write_raster(tif_file, self.values)
+            with rasterio.open(tif_file) as src:
+                TileOccupancy.load_or_build(tif_file, src, tile_size=16)
+            self.assertIsNotNone(TileOccupancy.load(occupancy_path(tif_file), tif_file))
+
+            write_raster(tif_file, np.ones((100, 130), dtype=np.uint8))
+            os.utime(tif_file, ns=(0, 0))
+            self.assertIsNone(TileOccupancy.load(occupancy_path(tif_file), tif_file))
+            with rasterio.open(tif_file) as src:
+                self.assertEqual(TileOccupancy.load_or_build(tif_file, src, tile_size=16).occupied_tiles, 63)
+
+
+if __name__ == '__main__':
+    unittest.main()
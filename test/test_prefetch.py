@@ -0,0 +1,81 @@
+import threading
+import time
+import unittest
+
+from PNV.src.prefetch import RasterPrefetcher
+
+
+class FakeRaster:
+    def __init__(self, name: str, live: list, lock: threading.Lock):
+        self.name = name
+        self.live = live
+        self.lock = lock
+        self.closed = False
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.live.remove(self.name)
+
+
+class TestRasterPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.live = []
+        self.max_live = 0
+        self.lock = threading.Lock()
+
+    def read_raster(self, tif_file: str) -> FakeRaster:
+        with self.lock:
+            self.live.append(tif_file)
+            self.max_live = max(self.max_live, len(self.live))
+        return FakeRaster(tif_file, self.live, self.lock)
+
+    def test_order_and_bound(self):
+        """
+        Rasters are yielded in the original order, and at most max_prefetched rasters are decoded in addition to the
+        raster currently processed.
+        """
+        tif_files = [f"raster_{i}.tif" for i in range(8)]
+        processed = []
+        for tif_file, raster in RasterPrefetcher(tif_files, self.read_raster, max_prefetched=2):
+            time.sleep(0.01)  # the background thread reads ahead as far as it may
+            self.assertEqual(raster.name, tif_file)
+            self.assertFalse(raster.closed)
+            processed.append(tif_file)
+        self.assertEqual(processed, tif_files)
+        self.assertLessEqual(self.max_live, 3)
+        self.assertEqual(self.live, [])
+
+    def test_early_stop_releases_rasters(self):
+        """
+        Rasters decoded ahead are closed when the iteration stops early.
+        """
+        prefetcher = RasterPrefetcher([f"raster_{i}.tif" for i in range(5)], self.read_raster, max_prefetched=1)
+        for _ in prefetcher:
+            time.sleep(0.01)
+            break
+        self.assertEqual(self.live, [])
+
+    def test_read_error(self):
+        """
+        Errors of the background read are raised in the order of the rasters.
+        """
+        def read_raster(tif_file: str) -> FakeRaster:
+            if tif_file == 'broken.tif':
+                raise OSError("broken")
+            return self.read_raster(tif_file)
+
+        processed = []
+        with self.assertRaises(OSError):
+            for tif_file, _ in RasterPrefetcher(['a.tif', 'broken.tif', 'c.tif'], read_raster, max_prefetched=1):
+                processed.append(tif_file)
+        self.assertEqual(processed, ['a.tif'])
+
+    def test_invalid_bound(self):
+        with self.assertRaises(ValueError):
+            RasterPrefetcher(['a.tif'], self.read_raster, max_prefetched=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+
+from PNV.src.sampling import ZonalSample, estimate_table
+from PNV.src.zonal import CountryCoverage, histogram_to_table
+from test.synthetic import memory_raster, class_values, TRANSFORM
+from test.test_zonal import synthetic_countries, NUM_CLASSES
+
+LABELS = ['NA'] + [f"Class {i}" for i in range(1, NUM_CLASSES)]
+
+
+class TestZonalSample(unittest.TestCase):
+    def setUp(self):
+        self.coverage = CountryCoverage.from_countries(synthetic_countries(), (100, 100), TRANSFORM)
+        self.values = class_values(100, 100, NUM_CLASSES)
+        self.memfile = memory_raster(self.values, tiled=True, blockxsize=32, blockysize=32)
+        self.addCleanup(self.memfile.close)
+
+    def sample_table(self, fraction: float, design: str):
+        sample = ZonalSample.draw(self.coverage, fraction, design=design)
+        with self.memfile.open() as src:
+            values = sample.read(src)
+        return sample, estimate_table(sample, values, self.coverage.names, self.coverage.iso, LABELS, 1.0)
+
+    def test_full_sample_equals_exact(self):
+        """
+        Sampling all pixels reproduces the exact areas with zero standard errors and collapsed intervals.
+        """
+        exact = histogram_to_table(self.coverage.zonal_histogram(self.values, NUM_CLASSES), self.coverage.names,
+                                   self.coverage.iso, LABELS, 1.0)
+        for design in ['random', 'lattice']:
+            with self.subTest(design=design):
+                sample, table = self.sample_table(1.0, design)
+                self.assertEqual(len(sample.indices), len(self.coverage.sorted_entries()[0]))
+                for column in exact.columns:
+                    if column in ['country', 'ISO']:
+                        self.assertEqual(list(table[column]), list(exact[column]))
+                    else:
+                        np.testing.assert_allclose(table[column], exact[column])
+                for label in LABELS[1:] + ['Total Area (km^2)']:
+                    np.testing.assert_allclose(table[f"{label} SE"], 0, atol=1e-9)
+                    np.testing.assert_allclose(table[f"{label} CI low"], exact[label])
+                    np.testing.assert_allclose(table[f"{label} CI high"], exact[label])
+
+    def test_partial_sample(self):
+        """
+        A partial sample draws the fraction of each country and reports non-zero standard errors.
+        """
+        for design in ['random', 'lattice']:
+            with self.subTest(design=design):
+                sample, table = self.sample_table(0.25, design)
+                np.testing.assert_allclose(sample.zone_samples / sample.zone_pixels, 0.25, atol=0.05)
+                self.assertTrue((table['Total Area (km^2) SE'] > 0).all())
+                self.assertTrue((table['Total Area (km^2) CI low'] <= table['Total Area (km^2)']).all())
+
+    def test_invalid_fraction(self):
+        for fraction in [0, 1.5]:
+            with self.assertRaises(ValueError):
+                ZonalSample.draw(self.coverage, fraction)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import json
+import logging
+import threading
+import unittest
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import numpy as np
+import pandas as pd
+
+from PNV.toolbox.cube import PnvCube
+from PNV.toolbox.data_analysis import PnvDataAnalysis
+from PNV.toolbox.service import PnvQueryService
+
+
+def synthetic_analysis() -> PnvDataAnalysis:
+    """
+    Preprocessed PnvDataAnalysis holding a small cube of three countries, one of them without area.
+    """
+    iso = ['AAA', 'BBB', 'CCC']
+    values = np.arange(3 * 2 * 2 * 2, dtype=np.float32).reshape(3, 2, 2, 2)
+    regions = pd.DataFrame({'continents': ['Europe', 'Europe', 'Asia'],
+                            'fao_regions': ['Europe', 'Europe', 'Asia and the Pacific']}, index=iso)
+    analysis = PnvDataAnalysis.__new__(PnvDataAnalysis)
+    analysis.logger = logging.getLogger("PNV-Processing")
+    analysis.pnv_cube = PnvCube(values=values, iso=iso, pnv_classes=['Forest', 'Grassland'],
+                                scenarios=['rcp26', 'rcp45'], years=[2020, 2050], regions=regions,
+                                total_area=np.array([100.0, 200.0, 0.0]))
+    analysis.forest_classes = ['Forest']
+    analysis.iso_forest_ranking = ['CCC', 'BBB', 'AAA']
+    analysis.selected_agg_lvl = 'country'
+    analysis.selected_iso = ['big_2']
+    analysis.selected_rcp = ['rcp26', 'rcp45']
+    analysis.selected_year = 2050
+    return analysis
+
+
+class TestPnvQueryService(unittest.TestCase):
+    def setUp(self):
+        self.service = PnvQueryService(synthetic_analysis(), cache_size=4)
+
+    def test_parse_query(self):
+        """
+        Missing entries are taken from the toolbox input, lists are given as comma-separated strings.
+        """
+        self.assertEqual(self.service.parse_query({}),
+                         ('country', ('big_2',), ('rcp26', 'rcp45'), 2050, 'abs', True, 'json'))
+        self.assertEqual(self.service.parse_query({'agg_lvl': 'continents', 'iso': '', 'rcp': 'rcp45,rcp26',
+                                                   'year': '2020', 'aggregate_forest': 'false'}),
+                         ('continents', (), ('rcp26', 'rcp45'), 2020, 'abs', False, 'json'))
+
+    def test_parse_query_rejections(self):
+        """
+        Invalid queries are rejected with a ValueError (HTTP 400).
+        """
+        for query in [{'unknown': 1}, {'agg_lvl': 'world'}, {'iso': ''}, {'iso': ' , '}, {'rcp': ''},
+                      {'rcp': 'rcp60'}, {'year': 'next'}, {'year': 2100}, {'value': 'share'},
+                      {'aggregate_forest': 'maybe'}, {'format': 'csv'}]:
+            with self.subTest(query=query), self.assertRaises(ValueError):
+                self.service.parse_query(query)
+
+    def test_json_without_area(self):
+        """
+        Relative values of countries without area are encoded as null in valid JSON.
+        """
+        content_type, body = self.service.query({'iso': 'AAA,CCC', 'value': 'rel', 'rcp': 'rcp26'})
+        self.assertEqual(content_type, 'application/json')
+        response = json.loads(body, parse_constant=lambda constant: self.fail(f"Invalid JSON constant {constant}"))
+        values = {row['ISO']: row['forest_cover'] for row in response['data']}
+        self.assertEqual(values['CCC'], None)
+        self.assertAlmostEqual(values['AAA'], 1.0)
+
+    def test_cache(self):
+        """
+        Repeated queries are answered from the cache.
+        """
+        self.service.query({'iso': 'AAA'})
+        self.service.query({'iso': ['AAA']})
+        self.assertEqual(self.service.cache_info()['hits'], 1)
+
+    def test_server_rejects_empty_iso(self):
+        """
+        An empty ISO selection is answered with HTTP 400.
+        """
+        server = self.service.make_server(port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            with self.assertRaises(HTTPError) as error:
+                urlopen(f"http://127.0.0.1:{server.server_port}/query?iso=", timeout=10)
+            self.assertEqual(error.exception.code, 400)
+            error.exception.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from unittest import mock
+
+import numpy as np
+import rasterio
+
+from PNV.src import sharding
+from PNV.src.occupancy import TileOccupancy
+from PNV.src.sharding import ShardedZonalStatistics, run_worker
+from PNV.src.zonal import CountryCoverage
+from test.synthetic import write_raster, class_values, TRANSFORM
+from test.test_zonal import synthetic_countries, NUM_CLASSES
+
+
+class TestShardedZonalStatistics(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.work_dir = os.path.join(tmp_dir.name, 'shards')
+        self.rasters = []
+        for seed in range(2):
+            raster = os.path.join(tmp_dir.name, f"raster_{seed}.tif")
+            write_raster(raster, class_values(100, 100, NUM_CLASSES, seed=seed))
+            self.rasters.append(raster)
+        self.coverage = CountryCoverage.from_countries(synthetic_countries(), (100, 100), TRANSFORM)
+
+    def prepare(self, **kwargs) -> ShardedZonalStatistics:
+        job = ShardedZonalStatistics(self.work_dir, tile_rows=7, **kwargs)
+        job.prepare(self.rasters, self.coverage, num_classes=NUM_CLASSES)
+        return job
+
+    def assert_single_pass(self, results: list):
+        """
+        The merged partials equal the histograms and class counts of a single pass over each raster.
+        """
+        datasets = [rasterio.open(raster) for raster in self.rasters]
+        try:
+            histograms = self.coverage.stacked_histograms(datasets, NUM_CLASSES)
+            values = [dataset.read(1) for dataset in datasets]
+        finally:
+            for dataset in datasets:
+                dataset.close()
+        self.assertEqual(len(results), len(self.rasters))
+        for result, histogram, raster_values in zip(results, histograms, values):
+            np.testing.assert_allclose(result['histogram'], histogram)
+            np.testing.assert_array_equal(result['class_counts'],
+                                          np.bincount(raster_values.ravel(), minlength=NUM_CLASSES))
+            self.assertEqual(int(result['total_pixels']), raster_values.size)
+            self.assertEqual(int(result['nonzero_pixels']), np.count_nonzero(raster_values))
+
+    def test_reduce_equals_single_pass(self):
+        """
+        Tiles processed by local worker processes sum up to the single-pass result.
+        """
+        job = self.prepare()
+        job.run(workers=2)
+        self.assertEqual(len(job.task_files('done')), 2 * 15)
+        self.assert_single_pass(job.reduce())
+
+    def test_retry(self):
+        """
+        A failed tile is retried on its own; a tile failing after all retries fails the reduce.
+        """
+        process_task = sharding.process_task
+        attempts = Counter()
+
+        def flaky_task(work_dir, task):
+            attempts[task['id']] += 1
+            if task['id'] == 'r000_t00003' and attempts[task['id']] == 1:
+                raise OSError("read error")
+            if task['id'] == 'r001_t00005':
+                raise OSError("corrupted tile")
+            process_task(work_dir, task)
+
+        job = self.prepare(max_retries=2)
+        with mock.patch.object(sharding, 'process_task', side_effect=flaky_task):
+            run_worker(self.work_dir, 'test')
+        self.assertEqual(attempts['r000_t00003'], 2)
+        self.assertEqual(attempts['r001_t00005'], 3)
+        self.assertEqual(job.task_files('failed'), ['r001_t00005.json'])
+        with self.assertRaises(RuntimeError):
+            job.reduce()
+
+        # Rerun of the failed tile
+        os.replace(os.path.join(self.work_dir, 'tasks', 'failed', 'r001_t00005.json'),
+                   os.path.join(self.work_dir, 'tasks', 'pending', 'r001_t00005.json'))
+        run_worker(self.work_dir, 'test')
+        self.assert_single_pass(job.reduce())
+
+    def test_heartbeat(self):
+        """
+        Tasks running longer than the task timeout are not requeued while their worker is alive.
+        """
+        process_task = sharding.process_task
+        processed = Counter()
+
+        def slow_task(work_dir, task):
+            processed[task['id']] += 1
+            if task['id'] == 'r000_t00000':
+                time.sleep(0.6)
+            process_task(work_dir, task)
+
+        job = self.prepare(task_timeout=0.3)
+        stop = threading.Event()
+        requeued = []
+
+        def requeue():
+            while not stop.is_set():
+                job.requeue_lost_tasks()
+                if processed['r000_t00000'] and 'r000_t00000.json' in job.task_files('pending'):
+                    requeued.append('r000_t00000')
+                time.sleep(0.02)
+
+        monitor = threading.Thread(target=requeue)
+        monitor.start()
+        try:
+            with mock.patch.object(sharding, 'process_task', side_effect=slow_task):
+                run_worker(self.work_dir, 'test', heartbeat_interval=0.05)
+        finally:
+            stop.set()
+            monitor.join()
+        self.assertEqual(requeued, [])
+        self.assertEqual(set(processed.values()), {1})
+        self.assert_single_pass(job.reduce())
+
+    def test_requeued_task_completes(self):
+        """
+        A task requeued while it runs completes without error, and its requeued copy is dropped.
+        """
+        process_task = sharding.process_task
+        processed = Counter()
+        job = self.prepare(task_timeout=0)
+
+        def lost_task(work_dir, task):
+            processed[task['id']] += 1
+            if task['id'] == 'r000_t00002':
+                job.requeue_lost_tasks()
+                self.assertEqual(job.task_files('running'), [])
+            process_task(work_dir, task)
+
+        with mock.patch.object(sharding, 'process_task', side_effect=lost_task):
+            run_worker(self.work_dir, 'test')
+        self.assertEqual(set(processed.values()), {1})
+        self.assertEqual(job.task_files('pending') + job.task_files('failed'), [])
+        self.assert_single_pass(job.reduce())
+
+    def test_occupancy_index(self):
+        """
+        With occupancy indices, tiles are read through the index and sum up to the single-pass result; an outdated
+        index is ignored.
+        """
+        for seed, raster in enumerate(self.rasters):
+            values = class_values(100, 100, NUM_CLASSES, seed=seed)
+            values[20:70] = 0
+            write_raster(raster, values)
+            with rasterio.open(raster) as src:
+                TileOccupancy.load_or_build(raster, src, tile_size=16)
+        write_raster(self.rasters[1], class_values(100, 100, NUM_CLASSES, seed=5))
+
+        job = ShardedZonalStatistics(self.work_dir, tile_rows=7)
+        job.prepare(self.rasters, self.coverage, num_classes=NUM_CLASSES, occupancy=self.rasters)
+        with mock.patch.object(TileOccupancy, 'read', autospec=True, side_effect=TileOccupancy.read) as read:
+            run_worker(self.work_dir, 'test')
+        self.assertEqual(read.call_count, 15)  # tiles of the first raster only
+        self.assert_single_pass(job.reduce())
+
+        with self.assertRaises(ValueError):
+            job.prepare(self.rasters, self.coverage, num_classes=NUM_CLASSES, occupancy=self.rasters[:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
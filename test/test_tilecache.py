@@ -0,0 +1,67 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from PNV.src.tilecache import TileHistogramCache
+from PNV.src.zonal import CountryCoverage
+from test.synthetic import memory_raster, class_values, TRANSFORM
+from test.test_zonal import synthetic_countries, NUM_CLASSES
+
+
+class TestTileHistogramCache(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cache_dir = tmp_dir.name
+        self.coverage = CountryCoverage.from_countries(synthetic_countries(), (100, 100), TRANSFORM)
+        self.values = class_values(100, 100, NUM_CLASSES)
+
+    def histograms(self, values: np.ndarray, key: str = 'grid') -> dict:
+        cache = TileHistogramCache(self.cache_dir, key=key, num_classes=NUM_CLASSES, tile_rows=16)
+        with memory_raster(values) as memfile, memfile.open() as src:
+            return cache.histograms(src, self.coverage)
+
+    def assert_exact(self, result: dict, values: np.ndarray):
+        np.testing.assert_allclose(result['histogram'], self.coverage.zonal_histogram(values, NUM_CLASSES))
+        np.testing.assert_array_equal(result['class_counts'], np.bincount(values.ravel(), minlength=NUM_CLASSES))
+        self.assertEqual(result['total_pixels'], values.size)
+        self.assertEqual(result['nonzero_pixels'], np.count_nonzero(values))
+
+    def test_invalidation(self):
+        """
+        Unchanged tiles are taken from the cache; only tiles with changed content are recomputed.
+        """
+        result = self.histograms(self.values)
+        self.assertEqual((result['recomputed_tiles'], result['tiles']), (7, 7))
+        self.assert_exact(result, self.values)
+
+        result = self.histograms(self.values)
+        self.assertEqual(result['recomputed_tiles'], 0)
+        self.assert_exact(result, self.values)
+
+        # Re-released raster with a corrected region in rows 40 to 44 (tile of rows 32 to 47)
+        corrected = self.values.copy()
+        corrected[40:45, 10:60] = (corrected[40:45, 10:60] + 1) % NUM_CLASSES
+        result = self.histograms(corrected)
+        self.assertEqual(result['recomputed_tiles'], 1)
+        self.assert_exact(result, corrected)
+
+        # The same content in another row range is not a cached tile
+        shifted = np.roll(self.values, 16, axis=0)
+        self.assertEqual(self.histograms(shifted)['recomputed_tiles'], 7)
+
+    def test_key(self):
+        """
+        Cached tiles are only valid for the zones of their key.
+        """
+        self.histograms(self.values, key='grid')
+        self.assertEqual(self.histograms(self.values, key='other_zones')['recomputed_tiles'], 7)
+
+    def test_grid_mismatch(self):
+        with self.assertRaises(ValueError):
+            self.histograms(self.values[:50])
+
+
+if __name__ == '__main__':
+    unittest.main()
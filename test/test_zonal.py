@@ -0,0 +1,184 @@
+import tempfile
+import unittest
+
+import geopandas as gpd
+import numpy as np
+from rasterio.mask import mask
+from shapely.geometry import box, mapping, MultiPolygon, Polygon
+
+from PNV.src.zonal import CountryCoverage, compact_parts
+from test.synthetic import memory_raster, class_values, TRANSFORM, CRS
+
+NUM_CLASSES = 7
+
+
+def synthetic_countries() -> gpd.GeoDataFrame:
+    """
+    Three countries on the 100 x 100 pixel grid of TRANSFORM: two neighbours sharing a border through the middle of a
+    pixel column, and an island whose border cuts through pixels on all sides.
+    """
+    return gpd.GeoDataFrame({'name': ['West', 'East', 'Island'], 'iso_a3': ['WST', 'EST', 'ISL']},
+                            geometry=[box(0, 500, 505, 1000), box(505, 500, 1000, 1000),
+                                      box(203, 103, 617, 388)], crs=CRS)
+
+
+class TestCountryCoverage(unittest.TestCase):
+    def setUp(self):
+        self.countries = synthetic_countries()
+        self.values = class_values(100, 100, NUM_CLASSES)
+        self.memfile = memory_raster(self.values)
+        self.addCleanup(self.memfile.close)
+
+    def masked_histogram(self) -> np.ndarray:
+        """
+        Pixel counts of each country and class from rasterio.mask.mask, as in ProcessingArea.mask_country.
+        """
+        histogram = np.zeros((len(self.countries), NUM_CLASSES))
+        with self.memfile.open() as src:
+            for i, geometry in enumerate(self.countries['geometry']):
+                out_image, _ = mask(src, [mapping(geometry)], crop=True, nodata=0)
+                histogram[i] = np.bincount(out_image[0].ravel(), minlength=NUM_CLASSES)
+        return histogram
+
+    def test_mask_method_equals_rasterio_mask(self):
+        """
+        The 'mask' zones select exactly the pixels of rasterio.mask.mask.
+        """
+        coverage = CountryCoverage.from_country_masks(self.countries, self.values.shape, TRANSFORM)
+        histogram = coverage.zonal_histogram(self.values, NUM_CLASSES)
+        np.testing.assert_array_equal(histogram[:, 1:], self.masked_histogram()[:, 1:])
+
+    def test_coverage_weights(self):
+        """
+        Fractional coverage weights sum up to the exact country areas and split shared border pixels between the
+        neighbours. Pixels inside a country are counted as by the mask method.
+        """
+        coverage = CountryCoverage.from_countries(self.countries, self.values.shape, TRANSFORM)
+        histogram = coverage.zonal_histogram(self.values, NUM_CLASSES)
+        pixel_area = abs(TRANSFORM.a * TRANSFORM.e)
+        np.testing.assert_allclose(histogram.sum(axis=1), self.countries.area / pixel_area)
+
+        # The neighbours split the border column in halves, together they cover each pixel of their rows once
+        np.testing.assert_allclose(histogram[:2].sum(axis=0),
+                                   np.bincount(self.values[:50].ravel(), minlength=NUM_CLASSES))
+
+        # Pixels entirely inside a country are its interior pixels, the pixels of rasterio.mask.mask of the
+        # pixel-aligned box they form
+        def country(geometry):
+            return gpd.GeoDataFrame({'name': ['Inner'], 'iso_a3': ['INN']}, geometry=[geometry], crs=CRS)
+
+        interior = CountryCoverage.from_countries(country(box(213, 113, 607, 378)), self.values.shape, TRANSFORM)
+        aligned = CountryCoverage.from_country_masks(country(box(220, 120, 600, 370)), self.values.shape, TRANSFORM)
+        np.testing.assert_array_equal(np.sort(interior.interior_indices), np.sort(aligned.interior_indices))
+
+    def test_window_and_cache(self):
+        """
+        The histogram of the bounding window equals the histogram of the whole grid, also after a cache round trip.
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            coverage = CountryCoverage.load_or_build(self.countries, self.values.shape, TRANSFORM, cache_dir)
+            cached = CountryCoverage.load_or_build(self.countries, self.values.shape, TRANSFORM, cache_dir)
+        self.assertTrue(cached.matches(self.values.shape, TRANSFORM))
+
+        window = cached.bounding_window()
+        rows, cols = window.toslices()
+        np.testing.assert_allclose(cached.zonal_histogram(self.values[rows, cols], NUM_CLASSES, window=window),
+                                   coverage.zonal_histogram(self.values, NUM_CLASSES))
+        with self.assertRaises(ValueError):
+            coverage.zonal_histogram(self.values, NUM_CLASSES - 1)
+
+    def test_stacked_histograms(self):
+        """
+        The histograms of co-registered rasters accumulated strip by strip in one pass equal their single histograms.
+        """
+        coverage = CountryCoverage.from_countries(self.countries, self.values.shape, TRANSFORM)
+        stack = [class_values(100, 100, NUM_CLASSES, seed=seed) for seed in range(3)]
+        memfiles = [memory_raster(values) for values in stack]
+        datasets = [memfile.open() for memfile in memfiles]
+        try:
+            histograms = coverage.stacked_histograms(datasets, num_classes=NUM_CLASSES, strip_rows=16)
+            self.assertEqual(len(histograms), len(stack))
+            for histogram, values in zip(histograms, stack):
+                np.testing.assert_allclose(histogram, coverage.zonal_histogram(values, NUM_CLASSES))
+            with self.assertRaises(ValueError):
+                coverage.stacked_histograms(datasets, num_classes=NUM_CLASSES - 1)
+        finally:
+            for dataset, memfile in zip(datasets, memfiles):
+                dataset.close()
+                memfile.close()
+
+        with memory_raster(self.values[:50]) as memfile, memfile.open() as dataset, self.assertRaises(ValueError):
+            coverage.stacked_histograms([dataset], num_classes=NUM_CLASSES)
+
+    def test_probability_histograms(self):
+        """
+        Expected covered pixels of multi-band probability rasters, read strip by strip, equal the weighted sums of the
+        probabilities over the whole grid; nodata and NaN count as probability 0.
+        """
+        coverage = CountryCoverage.from_countries(self.countries, self.values.shape, TRANSFORM)
+        rng = np.random.default_rng(1)
+        bands = rng.integers(0, 40, size=(3, 100, 100)).astype(np.float32)
+        bands[0, 40:60, 40:60] = np.nan
+        bands[2, 10:20] = 255
+        single = rng.integers(0, 100, size=(100, 100)).astype(np.float32)
+
+        indices, zones, weights = coverage.sorted_entries()
+
+        def expected(layers: list) -> np.ndarray:
+            histogram = np.zeros((len(self.countries), len(layers) + 1))
+            for class_index, layer in enumerate(layers, start=1):
+                probabilities = np.nan_to_num(np.where(layer == 255, 0, layer) / 100).ravel()[indices]
+                histogram[:, class_index] = np.bincount(zones, weights=weights * probabilities,
+                                                        minlength=len(self.countries))
+            covered = np.bincount(zones, weights=weights, minlength=len(self.countries))
+            histogram[:, 0] = np.clip(covered - histogram[:, 1:].sum(axis=1), 0, None)
+            return histogram
+
+        with memory_raster(bands, nodata=255) as stack_file, stack_file.open() as stack, \
+                memory_raster(single) as single_file, single_file.open() as single_src:
+            histograms = coverage.probability_histograms(
+                [[(stack, 1), (stack, 2), (stack, 3)], [(stack, 3), (single_src, 1), (stack, 1)]], scale=100,
+                strip_rows=16)
+        np.testing.assert_allclose(histograms[0], expected([bands[0], bands[1], bands[2]]))
+        np.testing.assert_allclose(histograms[1], expected([bands[2], single, bands[0]]))
+
+
+class TestCompactParts(unittest.TestCase):
+    def test_single_group(self):
+        """
+        Single polygons and multi-part geometries of nearby parts are kept as they are.
+        """
+        polygon = box(0, 0, 10, 10)
+        self.assertEqual(compact_parts(polygon), [polygon])
+        nearby = MultiPolygon([box(0, 0, 10, 10), box(11, 0, 20, 10), box(0, 11, 5, 15)])
+        self.assertEqual(compact_parts(nearby), [nearby])
+
+    def test_antimeridian(self):
+        """
+        Parts on both sides of the antimeridian are split into two groups with tight bounds.
+        """
+        geometry = MultiPolygon([box(-180, 60, -170, 70), box(170, 50, 180, 70), box(175, 45, 178, 49)])
+        groups = compact_parts(geometry)
+        self.assertEqual(sorted(group.bounds for group in groups), [(-180, 60, -170, 70), (170, 45, 180, 70)])
+        self.assertIsInstance(groups[0], (Polygon, MultiPolygon))
+        self.assertAlmostEqual(sum(group.area for group in groups), geometry.area)
+
+    def test_archipelago(self):
+        """
+        Islands next to the mainland join it, remote islands form their own groups. All parts are kept.
+        """
+        rng = np.random.default_rng(0)
+        coastal = [box(x, y, x + 0.5, y + 0.5) for x, y in rng.uniform(0, 100, size=(200, 2))]
+        remote = [box(x, 500, x + 1, 501) for x in range(0, 1000, 10)]
+        geometry = MultiPolygon([box(0, 0, 100, 100)] + coastal + remote)
+        groups = compact_parts(geometry)
+        self.assertEqual(sum(len(getattr(group, 'geoms', [group])) for group in groups), len(geometry.geoms))
+        mainland = [group for group in groups if group.bounds[:2] == (0, 0)]
+        self.assertEqual(len(mainland), 1)
+        self.assertEqual(len(mainland[0].geoms), 1 + len(coastal))
+        self.assertEqual(len(groups), 1 + len(remote))
+        self.assertAlmostEqual(sum(group.area for group in groups), geometry.area)
+
+
+if __name__ == '__main__':
+    unittest.main()